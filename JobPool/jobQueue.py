@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# persistent job queue of the job pool
+#
+# Each pool daemon (subJobs.py) keeps its jobs in its own SQLite database
+# (WAL mode) on the local disk of its host, in $JOBPOOL_DBDIR (default:
+# /tmp/jobpool-$USER). WAL mode needs all processes using a database to be on
+# one host, and the pool directory is on NFS, so the daemon is the only writer
+# of its database. Submitters on any host drop job scripts into the pool
+# directory (submit_job() below), and the daemon moves them into its queue.
+#
+# Each job is a shell command with a type (CPU/GPU), a priority, the working
+# directory and the submitter, and moves through the states
+#   queued -> running -> done | failed
+# The daemon claims jobs with an atomic UPDATE ... RETURNING. Waiting jobs age:
+# a job gains one priority level for every JOBPOOL_AGING seconds (default: 600)
+# it has been queued, so low-priority jobs are never starved forever by a
+# stream of high-priority ones.
+#
+# usage: python jobQueue.py submit -t CPU|GPU [-p PRIORITY] command ...
+#        python jobQueue.py list [-t CPU|GPU] [-s STATE ...]   (on the host of the daemon)
+
+import os
+import sys
+import time
+import socket
+import sqlite3
+import getpass
+import zlib
+import argparse
+import threading
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+AGING = float(os.environ.get("JOBPOOL_AGING", 600.0))
+STATES = ("queued", "running", "done", "failed")
+JOBTYPES = ("CPU", "GPU")
+# first line of a job script, with the type and priority of the job
+HEADER = "#jobpool"
+COLUMNS = ("id", "jobtype", "priority", "command", "workdir", "submitter", "state",
+           "submitted", "started", "finished", "host", "pid", "exit_status")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+  id          INTEGER PRIMARY KEY AUTOINCREMENT,
+  jobtype     TEXT NOT NULL,
+  priority    INTEGER NOT NULL DEFAULT 0,
+  command     TEXT NOT NULL,
+  workdir     TEXT,
+  submitter   TEXT,
+  state       TEXT NOT NULL DEFAULT 'queued' CHECK (state IN ('queued', 'running', 'done', 'failed')),
+  submitted   REAL NOT NULL,
+  started     REAL,
+  finished    REAL,
+  host        TEXT,
+  pid         INTEGER,
+  exit_status INTEGER
+);
+CREATE INDEX IF NOT EXISTS jobs_pending ON jobs (state, jobtype);
+"""
+
+# UPDATE ... RETURNING is available from SQLite 3.35
+HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+def default_submitter():
+  return f"{socket.gethostname().split('.')[0]}:{os.getpid()}"
+
+def db_file(jobtype):
+  """ Database of the daemon of a job type, on local disk; one per pool directory. """
+  dbdir = os.environ.get("JOBPOOL_DBDIR", os.path.join("/tmp", f"jobpool-{getpass.getuser()}"))
+  return os.path.join(dbdir, f"{os.path.basename(SCRIPT_DIR)}-{zlib.crc32(SCRIPT_DIR.encode()):08x}-{jobtype}.db")
+
+def job_header(jobtype, priority=0):
+  return f"{HEADER} {jobtype} {int(priority)}\n"
+
+def parse_header(command):
+  """ Return (jobtype, priority) of a job script with a header line, or (None, 0). """
+  s = command.split("\n", 1)[0].split()
+  if len(s) == 3 and s[0] == HEADER:
+    try:
+      return s[1], int(s[2])
+    except ValueError:
+      pass
+  return None, 0
+
+class JobQueue(object):
+  """
+  Queue of the pool daemon of one job type. Safe to share between threads of
+  the daemon; other processes may only open it read-only, on the same host.
+  """
+  def __init__(self, jobtype, dbfile=None, readonly=False):
+    self.dbfile = dbfile or db_file(jobtype)
+    self.readonly = readonly
+    self.local = threading.local()
+    if not readonly:
+      os.makedirs(os.path.dirname(self.dbfile), exist_ok=True)
+      db = self.db
+      db.execute("PRAGMA journal_mode=WAL")
+      db.executescript(SCHEMA)
+
+  @property
+  def db(self):
+    """ One connection per thread; transactions are managed explicitly. """
+    if getattr(self.local, "db", None) is None:
+      if self.readonly:
+        db = sqlite3.connect(f"file:{self.dbfile}?mode=ro", uri=True, timeout=60.0, isolation_level=None)
+      else:
+        db = sqlite3.connect(self.dbfile, timeout=60.0, isolation_level=None)
+        db.execute("PRAGMA synchronous=NORMAL")
+      self.local.db = db
+    return self.local.db
+
+  def submit(self, command, jobtype, workdir=None, priority=0, submitter=None):
+    """ Queue a shell command and return the job id. """
+    cur = self.db.execute(
+      "INSERT INTO jobs (jobtype, priority, command, workdir, submitter, submitted) VALUES (?, ?, ?, ?, ?, ?)",
+      (jobtype, int(priority), command, workdir or os.getcwd(), submitter or default_submitter(), time.time()))
+    return cur.lastrowid
+
+  def claim(self, jobtype):
+    """ Atomically move the most urgent queued job of a type to running and return it, or None. """
+    now = time.time()
+    host = socket.gethostname().split('.')[0]
+    order = "ORDER BY priority + (? - submitted) / ? DESC, id LIMIT 1"
+    db = self.db
+    db.execute("BEGIN IMMEDIATE")
+    try:
+      if HAS_RETURNING:
+        rows = db.execute(
+          "UPDATE jobs SET state = 'running', started = ?, host = ?, pid = ? "
+          "WHERE id = (SELECT id FROM jobs WHERE state = 'queued' AND jobtype = ? " + order + ") "
+          "RETURNING " + ", ".join(COLUMNS),
+          (now, host, os.getpid(), jobtype, now, AGING)).fetchall()
+      else:
+        rows = db.execute("SELECT " + ", ".join(COLUMNS) + " FROM jobs WHERE state = 'queued' AND jobtype = ? " + order,
+                          (jobtype, now, AGING)).fetchall()
+        if rows:
+          db.execute("UPDATE jobs SET state = 'running', started = ?, host = ?, pid = ? WHERE id = ?",
+                     (now, host, os.getpid(), rows[0][0]))
+      db.execute("COMMIT")
+    except BaseException:
+      db.execute("ROLLBACK")
+      raise
+    if not rows:
+      return None
+    job = dict(zip(COLUMNS, rows[0]))
+    job.update(state="running", started=now, host=host, pid=os.getpid())
+    return job
+
+  def finish(self, job_id, exit_status):
+    self.db.execute("UPDATE jobs SET state = ?, finished = ?, exit_status = ? WHERE id = ?",
+                    ("done" if exit_status == 0 else "failed", time.time(), exit_status, job_id))
+
+  def cancel(self, job_id):
+    """ Mark a queued job as failed so that it is never claimed; return whether it was still queued. """
+    cur = self.db.execute("UPDATE jobs SET state = 'failed', finished = ?, exit_status = -1 WHERE id = ? AND state = 'queued'",
+                          (time.time(), job_id))
+    return cur.rowcount > 0
+
+  def fail_orphans(self):
+    """
+    Mark running jobs whose daemon on this host has died as failed, and return them.
+    They are not run again: the command may already have started its remote
+    jobs (submitTinker.py), which would then run twice.
+    """
+    host = socket.gethostname().split('.')[0]
+    rows = self.db.execute("SELECT id, pid FROM jobs WHERE state = 'running' AND host = ?", (host,)).fetchall()
+    orphans = []
+    for job_id, pid in rows:
+      try:
+        os.kill(pid, 0)
+      except ProcessLookupError:
+        orphans.append(job_id)
+      except PermissionError:
+        pass
+    for job_id in orphans:
+      self.db.execute("UPDATE jobs SET state = 'failed', finished = ?, exit_status = -1 "
+                      "WHERE id = ? AND state = 'running'", (time.time(), job_id))
+    return [self.get(job_id) for job_id in orphans]
+
+  def get(self, job_id):
+    row = self.db.execute("SELECT " + ", ".join(COLUMNS) + " FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return dict(zip(COLUMNS, row)) if row else None
+
+  def jobs(self, states=None, jobtype=None):
+    query = "SELECT " + ", ".join(COLUMNS) + " FROM jobs WHERE 1"
+    args = []
+    if states:
+      query += " AND state IN (%s)" % ", ".join("?" * len(states))
+      args += list(states)
+    if jobtype:
+      query += " AND jobtype = ?"
+      args.append(jobtype)
+    return [dict(zip(COLUMNS, row)) for row in self.db.execute(query + " ORDER BY id", args)]
+
+  def wait(self, job_ids, timeout=None, interval=1.0):
+    """ Block until all jobs have finished (done or failed); return their records. """
+    start = time.time()
+    job_ids = list(job_ids)
+    while True:
+      jobs = [self.get(job_id) for job_id in job_ids]
+      if all(job["state"] in ("done", "failed") for job in jobs):
+        return jobs
+      if timeout is not None and time.time() - start > timeout:
+        raise TimeoutError(f"jobs {job_ids} not finished after {timeout} s")
+      time.sleep(interval)
+
+def submit_job(command, jobtype, priority=0):
+  """
+  Queue a command from any host: write it as a job script into the pool
+  directory, which the daemon of the job type moves into its queue.
+  Return the name of the script; removing it before the daemon has taken it
+  cancels the job.
+  """
+  hoststr = socket.gethostname().split('.')[0]
+  timestr = str(time.time()).replace('.', '')
+  fnm = os.path.join(SCRIPT_DIR, f"{hoststr}-{timestr}.sh")
+  tmp = os.path.join(SCRIPT_DIR, f".{hoststr}-{timestr}.sh.tmp")
+  with open(tmp, "w") as f:
+    f.write(job_header(jobtype, priority) + command + "\n")
+  os.rename(tmp, fnm)
+  return fnm
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  sub = parser.add_subparsers(dest="task")
+  p_submit = sub.add_parser("submit")
+  p_submit.add_argument("-t", dest="jobtype", required=True, choices=["CPU", "GPU"])
+  p_submit.add_argument("-p", dest="priority", type=int, default=0)
+  p_submit.add_argument("command", nargs="+")
+  p_list = sub.add_parser("list")
+  p_list.add_argument("-t", dest="jobtypes", nargs="*", choices=JOBTYPES, default=JOBTYPES)
+  p_list.add_argument("-s", dest="states", nargs="*", choices=STATES, default=None)
+  args = parser.parse_args()
+  if args.task == "submit":
+    print(submit_job(" ".join(args.command), args.jobtype, priority=args.priority))
+  elif args.task == "list":
+    for jobtype in args.jobtypes:
+      if not os.path.exists(db_file(jobtype)):
+        continue
+      for job in JobQueue(jobtype, readonly=True).jobs(args.states):
+        command = job['command'].split("\n", 1)[1] if parse_header(job['command'])[0] else job['command']
+        print(f"{job['id']:>8d} {job['jobtype']} {job['priority']:>4d} {job['state']:<8s} "
+              f"{time.ctime(job['submitted'])}  {job['submitter']}  {command.strip()}")
+  else:
+    parser.print_help()
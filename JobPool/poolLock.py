@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# lock manager of the job pool
+#
+# A named lock is a FIFO queue of owners kept in the file .lock_<name>.q next to
+# this script. The queue file is only ever modified under fcntl.flock, so taking
+# an uncontended lock costs one open/flock/read/write. The owner at the head of
+# the queue holds the lock; everybody else waits for their turn.
+#
+# Owners are process IDs (the calling shell script for the `lock` wrapper).
+# Dead owners on this host are dropped from the queue on sight; owners on other
+# hosts are dropped once they look stale (see JOBPOOL_LOCK_STALE).
+#
+# usage: python poolLock.py get|release|stats [name] [--owner PID] [--timeout SEC]
+
+import os
+import sys
+import json
+import time
+import fcntl
+import socket
+import argparse
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+# seconds after which a holder on another host is considered stale
+STALE_HOLDER = float(os.environ.get("JOBPOOL_LOCK_STALE", 3600.0))
+# seconds without a heartbeat after which a waiter on another host is considered gone
+STALE_WAITER = 60.0
+
+def pid_alive(pid):
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    pass
+  return True
+
+class PoolLock(object):
+  """ FIFO lock shared by all processes using the same job pool directory. """
+  def __init__(self, name="", owner=None, pooldir=SCRIPT_DIR):
+    self.name = name
+    self.owner = os.getpid() if owner is None else int(owner)
+    self.host = socket.gethostname()
+    self.fnm = os.path.join(pooldir, f".lock_{name}.q")
+
+  def _update(self, func):
+    """ Run func(state) under an exclusive flock and write the state back. """
+    with open(self.fnm, "a+") as f:
+      fcntl.flock(f, fcntl.LOCK_EX)
+      try:
+        f.seek(0)
+        content = f.read()
+        state = json.loads(content) if content else {}
+        state.setdefault("queue", [])
+        state.setdefault("stats", {"acquired": 0, "wait_total": 0.0, "wait_max": 0.0, "recovered": 0})
+        result = func(state)
+        f.seek(0)
+        f.truncate()
+        f.write(json.dumps(state))
+        f.flush()
+      finally:
+        fcntl.flock(f, fcntl.LOCK_UN)
+    return result
+
+  def _mine(self, entry):
+    return entry["pid"] == self.owner and entry["host"] == self.host
+
+  def _alive(self, entry, head, now):
+    if entry["host"] == self.host:
+      return pid_alive(entry["pid"])
+    if head:
+      return now - entry.get("granted", entry["beat"]) < STALE_HOLDER
+    return now - entry["beat"] < STALE_WAITER
+
+  def _prune(self, state, now):
+    alive = []
+    for entry in state["queue"]:
+      if self._mine(entry) or self._alive(entry, not alive, now):
+        alive.append(entry)
+      else:
+        state["stats"]["recovered"] += 1
+    state["queue"] = alive
+
+  def _poll(self, state):
+    """ Enqueue if needed, refresh our heartbeat and return True if we are at the head. """
+    now = time.time()
+    self._prune(state, now)
+    queue = state["queue"]
+    mine = [e for e in queue if self._mine(e)]
+    if mine:
+      mine[0]["beat"] = now
+    else:
+      queue.append({"pid": self.owner, "host": self.host, "since": now, "beat": now})
+    head = queue[0]
+    if not self._mine(head):
+      return False
+    if "granted" not in head:
+      head["granted"] = now
+      wait = now - head["since"]
+      stats = state["stats"]
+      stats["acquired"] += 1
+      stats["wait_total"] += wait
+      stats["wait_max"] = max(stats["wait_max"], wait)
+    return True
+
+  def acquire(self, timeout=None):
+    """ Block until the lock is held; return False if the timeout expires first. """
+    start = time.time()
+    delay = 0.001
+    while not self._update(self._poll):
+      if timeout is not None and time.time() - start > timeout:
+        self.release()
+        return False
+      time.sleep(delay)
+      delay = min(delay * 2, 0.1)
+    return True
+
+  def release(self):
+    def _remove(state):
+      state["queue"] = [e for e in state["queue"] if not self._mine(e)]
+    self._update(_remove)
+
+  def stats(self):
+    def _stats(state):
+      self._prune(state, time.time())
+      stats = dict(state["stats"])
+      stats["queued"] = len(state["queue"])
+      stats["holder"] = state["queue"][0] if state["queue"] else None
+      stats["wait_mean"] = stats["wait_total"] / stats["acquired"] if stats["acquired"] else 0.0
+      return stats
+    return self._update(_stats)
+
+  def __enter__(self):
+    self.acquire()
+    return self
+
+  def __exit__(self, *args):
+    self.release()
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("task", choices=["get", "release", "stats"])
+  parser.add_argument("name", nargs="?", default="")
+  parser.add_argument("--owner", type=int, default=os.getppid(), help="PID owning the lock, default: the calling process")
+  parser.add_argument("--timeout", type=float, default=None)
+  args = parser.parse_args()
+  lock = PoolLock(args.name, owner=args.owner)
+  if args.task == "get":
+    sys.exit(0 if lock.acquire(args.timeout) else 1)
+  elif args.task == "release":
+    lock.release()
+  else:
+    stats = lock.stats()
+    print(f"lock '{args.name}': acquired {stats['acquired']} times, "
+          f"mean wait {stats['wait_mean']:.6f} s, max wait {stats['wait_max']:.6f} s, "
+          f"{stats['recovered']} stale owners recovered, {stats['queued']} queued")
+    if stats["holder"]:
+      print(f"held by PID {stats['holder']['pid']} on {stats['holder']['host']} since {time.ctime(stats['holder']['granted'])}")
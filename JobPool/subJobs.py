@@ -1,37 +1,246 @@
 #!/usr/bin/env python
 # submit jobs if there are any in the pool
-# 
+#
+# The pool daemon watches the pool directory (inotify when available, polling
+# otherwise), keeps an in-memory index of the pending job scripts of its type
+# and moves them into its job queue (jobQueue.py) as soon as they are written.
+# The queue is a database on the local disk of this host, written only by this
+# daemon. Jobs are claimed from the queue, most urgent first, whenever one of
+# the bounded number of workers is free.
+#
+# usage: python subJobs.py CPU|GPU [submitters_id]
+#
+# Environment:
+#   JOBPOOL_WORKERS   max. number of job scripts run concurrently
+#                     (default: 4)
+#   JOBPOOL_RESCAN    seconds between full directory rescans (default: 5),
+#                     needed for scripts written from other hosts over NFS
+#
+# A job script may start with a header line "#jobpool CPU|GPU PRIORITY"
+# (jobQueue.submit_job); scripts without it are jobs of the type named in
+# their command and have priority 0.
 
 import os
 import sys
 import time
-import subprocess 
-from datetime import datetime
+import struct
+import ctypes
+import ctypes.util
+import select
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from jobQueue import JobQueue, parse_header
+
+RUNNING_PREFIX = ".running."
+
+# inotify event masks, see <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+class Inotify(object):
+  """ Minimal ctypes binding of the Linux inotify API, watching a single directory. """
+  _event = struct.Struct("iIII")
+
+  def __init__(self, path, mask=IN_CLOSE_WRITE | IN_MOVED_TO | IN_MODIFY):
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    wd = libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+    if wd < 0:
+      os.close(self.fd)
+      raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+
+  def wait(self, timeout, wakefd):
+    """ Block up to timeout seconds or until wakefd is readable;
+    return the file names that triggered events. """
+    ready, _, _ = select.select([self.fd, wakefd], [], [], timeout)
+    if wakefd in ready:
+      os.read(wakefd, 4096)
+    if self.fd not in ready:
+      return []
+    names = []
+    while True:
+      try:
+        buf = os.read(self.fd, 65536)
+      except BlockingIOError:
+        break
+      pos = 0
+      while pos < len(buf):
+        _, _, _, length = self._event.unpack_from(buf, pos)
+        pos += self._event.size
+        names.append(os.fsdecode(buf[pos:pos+length].rstrip(b"\0")))
+        pos += length
+    return names
+
+  def close(self):
+    os.close(self.fd)
+
+class Poller(object):
+  """ Fallback when inotify is not available: every wait() reports a full rescan. """
+  def __init__(self, interval=1.0):
+    self.interval = interval
+
+  def wait(self, timeout, wakefd):
+    ready, _, _ = select.select([wakefd], [], [], min(self.interval, timeout))
+    if ready:
+      os.read(wakefd, 4096)
+    return None
+
+  def close(self):
+    pass
+
+class JobIndex(object):
+  """ In-memory index of the job scripts of one type waiting in the pool directory. """
+  def __init__(self, jobtype):
+    self.jobtype = jobtype
+    self.pending = {}
+    # scripts that do not belong to this job type, keyed by name with their mtime
+    self.skipped = {}
+
+  def classify(self, fnm):
+    """ Return True if the script is a job of our type, None if it is not (yet) readable. """
+    try:
+      with open(fnm) as f:
+        command = f.read()
+    except (IOError, OSError, UnicodeDecodeError):
+      return None
+    tokens = command.split()
+    if not tokens:
+      return None
+    jobtype = parse_header(command)[0]
+    if jobtype is not None:
+      return jobtype == self.jobtype
+    return self.jobtype in tokens
+
+  def update(self, fnm):
+    if not fnm.endswith(".sh") or fnm.startswith(".") or fnm in self.pending:
+      return
+    try:
+      mtime = os.stat(fnm).st_mtime
+    except OSError:
+      self.skipped.pop(fnm, None)
+      return
+    if self.skipped.get(fnm) == mtime:
+      return
+    ours = self.classify(fnm)
+    if ours:
+      self.pending[fnm] = mtime
+      self.skipped.pop(fnm, None)
+    elif ours is False:
+      self.skipped[fnm] = mtime
+
+  def rescan(self):
+    names = set()
+    for entry in os.scandir("."):
+      names.add(entry.name)
+      self.update(entry.name)
+    for fnm in list(self.skipped):
+      if fnm not in names:
+        del self.skipped[fnm]
+
+  def pop_all(self):
+    """ Return pending scripts in submission order and clear the index. """
+    jobs = sorted(self.pending, key=lambda fnm: (self.pending[fnm], fnm))
+    self.pending = {}
+    return jobs
+
+def claim(fnm):
+  """ Atomically take ownership of a job script, so it is run exactly once
+  even with several pool daemons watching the same directory. """
+  claimed = RUNNING_PREFIX + fnm
+  try:
+    os.rename(fnm, claimed)
+  except OSError:
+    return None
+  return claimed
+
+def ingest(fnm, claimed, queue, jobtype):
+  """ Move a claimed job script into the job queue. """
+  with open(claimed) as f:
+    command = f.read()
+  submitter = fnm[:-len(".sh")].rsplit("-", 1)[0]
+  priority = parse_header(command)[1]
+  job_id = queue.submit(command, jobtype, workdir=os.getcwd(), priority=priority, submitter=submitter)
+  os.remove(claimed)
+  return job_id
+
+def run_job(job, queue):
+  print(f"[{time.asctime()}] job {job['id']} from {job['submitter']}: {job['command'].strip()}", flush=True)
+  status = -1
+  try:
+    status = subprocess.call(job["command"], shell=True, cwd=job["workdir"])
+  finally:
+    queue.finish(job["id"], status)
 
 if __name__ == "__main__":
-  sleeptime = 10.0
-  if sys.argv[1] == "GPU":
-    sleeptime += 10.0
+  jobtype = sys.argv[1]
   submitters_file = ".submitters"
   if len(sys.argv) > 2:
     submitters_file += sys.argv[2]
+  nworkers = int(os.environ.get("JOBPOOL_WORKERS", 4))
+  rescan = float(os.environ.get("JOBPOOL_RESCAN", 5.0))
 
-  def _worker():
-    os.system("./lock get "+sys.argv[1])
-    # print("Got Lock j", flush=True)
-    try:
-      cmd = "grep ' " + sys.argv[1] + " ' *.sh -l 2>/dev/null" 
-      sp_ret = subprocess.check_output(cmd, shell=True).decode("utf-8").split('\n')[:-1]
-      for sp in sp_ret:
-        subcmd = f"sh {sp}; rm {sp}"
-        os.system(subcmd)
-        print(f"[{time.asctime()}] {subcmd}", flush=True)
-    except:
-      pass
-    finally:
-      os.system("./lock release "+sys.argv[1])
-  
+  try:
+    watcher = Inotify(".")
+  except (OSError, AttributeError):
+    print(f"[{time.asctime()}] inotify not available, polling the pool directory", flush=True)
+    watcher = Poller()
+
+  queue = JobQueue(jobtype)
+  for job in queue.fail_orphans():
+    print(f"[{time.asctime()}] job {job['id']} from {job['submitter']} was running when the previous "
+          f"pool daemon died, marked as failed: {job['command'].strip()}", flush=True)
+  index = JobIndex(jobtype)
+  executor = ThreadPoolExecutor(max_workers=nworkers)
+  # workers write to this pipe when they finish, to wake up the main loop
+  wake_r, wake_w = os.pipe()
+  active = [0]
+  active_lock = threading.Lock()
+
+  def _done(future):
+    with active_lock:
+      active[0] -= 1
+    os.write(wake_w, b"x")
+
+  def _dispatch():
+    for fnm in index.pop_all():
+      claimed = claim(fnm)
+      if claimed is not None:
+        ingest(fnm, claimed, queue, jobtype)
+    while active[0] < nworkers:
+      job = queue.claim(jobtype)
+      if job is None:
+        break
+      with active_lock:
+        active[0] += 1
+      executor.submit(run_job, job, queue).add_done_callback(_done)
+
+  index.rescan()
+  _dispatch()
+  last_scan = time.time()
   while os.path.exists(submitters_file):
-    _worker()
-    time.sleep(sleeptime)
-  _worker()
+    names = watcher.wait(rescan, wake_r)
+    if names is None or time.time() - last_scan >= rescan:
+      index.rescan()
+      last_scan = time.time()
+    else:
+      for fnm in names:
+        index.update(fnm)
+    _dispatch()
+  # finish submitting the jobs that are pending before terminating
+  index.rescan()
+  _dispatch()
+  while active[0] > 0:
+    ready, _, _ = select.select([wake_r], [], [], rescan)
+    if ready:
+      os.read(wake_r, 4096)
+    _dispatch()
+  executor.shutdown(wait=True)
+  watcher.close()
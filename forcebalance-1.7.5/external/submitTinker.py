@@ -12,10 +12,16 @@
 import os
 import sys
 import time
+import json
+import fcntl
+import shlex
+import getpass
+import tempfile
 import datetime as dt
 import argparse
 import subprocess
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 # color
 RED = '\033[91m'
@@ -23,17 +29,118 @@ ENDC = '\033[0m'
 GREEN = '\033[92m'
 YELLOW = '\033[93m'
 
-def check_cpu_avail(node, nproc_required):
-  
+# reuse one ssh connection per node for all probes and submissions
+SSH = "ssh -o stricthostkeychecking=no -o ControlMaster=auto -o ControlPersist=10m -o ControlPath=/tmp/.submitTinker-%r@%h:%p"
+
+# node status is shared by all submitTinker processes of a user through this file
+STATUS_DIR = os.path.join(tempfile.gettempdir(), f"submitTinker-{getpass.getuser()}")
+STATUS_TTL = float(os.environ.get("SUBMITTINKER_PROBE_TTL", 10.0))
+PROBE_SEP = "@@@submitTinker@@@"
+
+# A GPU job holds its card for as long as it runs. A CPU job only needs its
+# lease until it shows up in the load reported by top; after that it would be
+# counted twice.
+LEASE_CPU = float(os.environ.get("SUBMITTINKER_LEASE_CPU", 120.0))
+LEASE_GPU = 7*24*3600.0
+# ssh processes started by this process, by PID
+children = {}
+# pack many small CPU jobs into one ssh call per node (-b)
+batch = False
+
+class StatusFile(object):
+  """ JSON file in STATUS_DIR, read and updated under an exclusive flock """
+  def __init__(self, name):
+    os.makedirs(STATUS_DIR, exist_ok=True)
+    self.fnm = os.path.join(STATUS_DIR, name)
+
+  def __enter__(self):
+    self.f = open(self.fnm, "a+")
+    fcntl.flock(self.f, fcntl.LOCK_EX)
+    self.f.seek(0)
+    content = self.f.read()
+    try:
+      self.data = json.loads(content) if content else {}
+    except ValueError:
+      self.data = {}
+    return self.data
+
+  def __exit__(self, *args):
+    self.f.seek(0)
+    self.f.truncate()
+    self.f.write(json.dumps(self.data))
+    self.f.flush()
+    fcntl.flock(self.f, fcntl.LOCK_UN)
+    self.f.close()
+
+def probe_node(node, jobtype):
+  """ Collect the raw status of one node with a single ssh call """
+  if jobtype == "CPU":
+    remote = f"top -n1 -b; echo {PROBE_SEP}; nproc"
+  else:
+    remote = f"nvidia-smi -a; echo {PROBE_SEP}; nvidia-smi"
+  try:
+    cmd = f'{SSH} {node} "{remote}" 2>/dev/null'
+    out = subprocess.check_output(cmd, timeout=10.0, shell=True).decode("utf-8")
+  except:
+    out = PROBE_SEP
+  part0, _, part1 = out.partition(PROBE_SEP)
+  return [part0.split('\n')[:-1], part1.strip().split('\n')]
+
+def new_lease(node, jobtype, card, nproc, job, pid, now):
+  """ Record of a placement made by us: a GPU card or a number of cores on a node """
+  expiry = now + (LEASE_CPU if jobtype == "CPU" else LEASE_GPU)
+  return {"node": node, "type": jobtype, "card": card, "nproc": nproc, "job": job, "pid": pid, "start": now, "expiry": expiry}
+
+def active_leases(leases, now):
+  """ Leases end when the job (its local ssh process) exits or when they expire """
+  active = []
+  for lease in leases:
+    if now > lease["expiry"]:
+      continue
+    if lease["pid"] in children:
+      # our own child: reap it, a zombie would look alive to kill(pid, 0)
+      if children[lease["pid"]].poll() is not None:
+        continue
+    else:
+      try:
+        os.kill(lease["pid"], 0)
+      except ProcessLookupError:
+        continue
+      except PermissionError:
+        pass
+    active.append(lease)
+  return active
+
+def probe_nodes(nodes, jobtype):
+  """ Status of all nodes, probing concurrently those not in the cache or expired """
+  status = {}
+  with StatusFile(f"probe-{jobtype}.json") as cache:
+    now = time.time()
+    for node in nodes:
+      host = node.split('-')[0]
+      if host in cache and now - cache[host]["time"] < STATUS_TTL:
+        status[host] = cache[host]["raw"]
+  todo = sorted(set(node.split('-')[0] for node in nodes) - set(status))
+  if todo:
+    with ThreadPoolExecutor(max_workers=len(todo)) as pool:
+      raws = list(pool.map(lambda host: probe_node(host, jobtype), todo))
+    now = time.time()
+    with StatusFile(f"probe-{jobtype}.json") as cache:
+      for host, raw in zip(todo, raws):
+        status[host] = raw
+        cache[host] = {"time": now, "raw": raw}
+  return status
+
+def cpu_usage(raw):
+  """ Return (usable nproc, occupied nproc) from the raw status of a CPU node """
+  top_lines, nproc_lines = raw
   # assume fully occupied
   tot_occ = 64.0 
-  
-  try:
-    # occupied nproc
-    cmd = f'ssh -o stricthostkeychecking=no {node} "top -n1 -b" | grep " R \| S " '
-    sp_ret = subprocess.check_output(cmd, timeout=10.0, shell=True).decode("utf-8").split('\n')[:-1]
+  if top_lines:
     tot_occ = 0 
-    for r in sp_ret:
+    for r in top_lines:
+      if (' R ' not in r) and (' S ' not in r):
+        continue
       if 'R'  in r:
         occ = r.split('R')[-1].split()[0]
         if occ.replace('.', '', 1).isdigit():
@@ -44,22 +151,19 @@ def check_cpu_avail(node, nproc_required):
           tot_occ += float(occ)/100.0
     tot_occ = round(tot_occ)
   
-  except:
-    pass
-  
   # assume no CPUs 
   nproc = 0
-  try:
-    # total nproc
-    cmd = f'ssh -o stricthostkeychecking=no {node} "nproc" '
-    sp_ret = subprocess.check_output(cmd, timeout=10.0, shell=True).decode("utf-8").split('\n')[0]
-    if sp_ret != '':
-      nproc = int(sp_ret) 
-  except:
-    pass
+  if nproc_lines and nproc_lines[0].isdigit():
+    nproc = int(nproc_lines[0]) 
 
   # limit the usage to 60%
   nproc = int(nproc*0.6)
+  return nproc, tot_occ
+
+def check_cpu_avail(node, nproc_required, raw=None):
+  if raw is None:
+    raw = probe_node(node, "CPU")
+  nproc, tot_occ = cpu_usage(raw)
   
   # available nproc
   avail = False
@@ -68,20 +172,13 @@ def check_cpu_avail(node, nproc_required):
     avail = True
   return avail
 
-def check_gpu_avail(node):
+def check_gpu_avail(node, raw=None):
   lim_card = None  # None means all
   if "-" in node:
     node, lim_card = node.split("-")
-  sp_ret0 = '  '
-  sp_ret1 = '  '
-  try:
-    # occupied nproc
-    cmd = f'ssh -o stricthostkeychecking=no {node} "nvidia-smi -a" 2>/dev/null'
-    sp_ret0 = subprocess.check_output(cmd, timeout=10.0, shell=True).decode("utf-8").split('\n')[:-1]
-    cmd = f'ssh -o stricthostkeychecking=no {node} "nvidia-smi" 2>/dev/null'
-    sp_ret1 = subprocess.check_output(cmd, timeout=10.0, shell=True).decode("utf-8").split('\n')[:-1]
-  except:
-    pass
+  if raw is None:
+    raw = probe_node(node, "GPU")
+  sp_ret0, sp_ret1 = raw
 
   tot_cards = []
   occ_cards = []
@@ -121,38 +218,102 @@ def check_gpu_avail(node):
         ava_cards.remove(c)
   return ava_cards 
 
+def launch(cmdstr):
+  """ Start an ssh job in the background and return its local PID """
+  print(f"[{time.asctime()}]   --> {cmdstr} &", flush=True)
+  proc = subprocess.Popen(shlex.split(cmdstr), stdin=subprocess.DEVNULL, start_new_session=True)
+  children[proc.pid] = proc
+  return proc.pid
+
+def launch_batch(node, cmds, nslots):
+  """ Run a batch of commands on one node with a single ssh call; the node
+  works through them with xargs, nslots at a time. Return the local PID. """
+  cmdstr = f"{SSH} {node} 'xargs -0 -n 1 -P {nslots} sh -c'"
+  print(f"[{time.asctime()}]   --> {cmdstr} &  ({len(cmds)} jobs)", flush=True)
+  for cmd in cmds:
+    print(f"[{time.asctime()}]       {cmd}", flush=True)
+  proc = subprocess.Popen(shlex.split(cmdstr), stdin=subprocess.PIPE, start_new_session=True)
+  proc.stdin.write(b"".join(cmd.encode("utf-8") + b"\0" for cmd in cmds))
+  proc.stdin.close()
+  children[proc.pid] = proc
+  return proc.pid
+
+def submit_batches(jobcmds, active, now):
+  """ Batch mode: hand all pending jobs to the nodes with free cores, in
+  proportion to the number of jobs each node can run at once, one batch
+  (one ssh call and one lease) per node. Return the number of jobs placed. """
+  status = probe_nodes(cpu_node_list, "CPU")
+  slots = []
+  for node in cpu_node_list:
+    host = node.split('-')[0]
+    nproc_avail, tot_occ = cpu_usage(status[host])
+    avail_nproc = nproc_avail - tot_occ - sum(l["nproc"] for l in active if l["node"] == host and l["type"] == "CPU")
+    nslots = 0
+    while avail_nproc > nproc:
+      nslots += 1
+      avail_nproc -= nproc
+    if nslots > 0:
+      slots.append((node, nslots))
+  if not slots:
+    return 0
+  # deal the jobs out slot by slot
+  batches = dict((node, []) for node, _ in slots)
+  order = [node for node, nslots in slots for _ in range(nslots)]
+  for j, cmd in enumerate(jobcmds):
+    batches[order[j % len(order)]].append(cmd)
+  for node, nslots in slots:
+    cmds = batches[node]
+    if cmds:
+      nslots = min(nslots, len(cmds))
+      pid = launch_batch(node, cmds, nslots)
+      active.append(new_lease(node.split('-')[0], "CPU", None, nslots*nproc, cmds, pid, now))
+  for j in range(len(jobcmds)):
+    jobcmds[j] = 'x'
+  return len(jobcmds)
+
 def submit_jobs(jobcmds, jobtype):
   njob_pointer = 0
-  if jobtype == "CPU":
-    for i in range(len(cpu_node_list)):
-      if njob_pointer >= len(jobcmds): break
-      if check_cpu_avail(cpu_node_list[i], nproc):
-        cmdstr = f"ssh -o stricthostkeychecking=no {cpu_node_list[i]} '" + jobcmds[njob_pointer] +  "' &"
-        subprocess.run(cmdstr, shell=True)
-        jobcmds[njob_pointer] = 'x'
-        print(f"[{time.asctime()}]   --> {cmdstr}")
-        njob_pointer += 1
-    # wait for 15 sec. to let job appear on a node
-    # i.e., shown by top command to avoid CPU overloading 
-    time.sleep(15.0)
-  else:
-    for i in range(len(gpu_node_list)): 
-      if njob_pointer >= len(jobcmds): break
-      ava_cards = check_gpu_avail(gpu_node_list[i]) 
-      if ava_cards != []:
-        for card in ava_cards:
-          cuda_device = f'export CUDA_VISIBLE_DEVICES="{card}"'
-          pci_bus_id = 'export CUDA_DEVICE_ORDER=PCI_BUS_ID'
-          if njob_pointer < len(jobcmds):
-            cmdstr = f"ssh -o stricthostkeychecking=no {gpu_node_list[i].split('-')[0]} '{pci_bus_id}; {cuda_device}; {jobcmds[njob_pointer]} ' &"
-            subprocess.run(cmdstr, shell=True)
-            jobcmds[njob_pointer] = 'x'
-            print(f"[{time.asctime()}]   --> {cmdstr}")
-            njob_pointer += 1
-    # wait for 30 sec. to let job appear on a node
-    # i.e., shown by nvidia-smi command
-    # to avoid submitting multiple jobs on one GPU card
-    time.sleep(30.0)
+  # decide and record placements under the lease lock, so that concurrent
+  # submitTinker processes never hand out the same cores or GPU cards
+  with StatusFile("leases.json") as leases:
+    now = time.time()
+    active = active_leases(leases.get("leases", []), now)
+    if jobtype == "CPU" and batch:
+      njob_pointer = submit_batches(jobcmds, active, now)
+    elif jobtype == "CPU":
+      status = probe_nodes(cpu_node_list, "CPU")
+      for i in range(len(cpu_node_list)):
+        if njob_pointer >= len(jobcmds): break
+        host = cpu_node_list[i].split('-')[0]
+        nproc_avail, tot_occ = cpu_usage(status[host])
+        # jobs placed recently may not show up in top yet
+        avail_nproc = nproc_avail - tot_occ - sum(l["nproc"] for l in active if l["node"] == host and l["type"] == "CPU")
+        while avail_nproc > nproc and njob_pointer < len(jobcmds):
+          cmdstr = f"{SSH} {cpu_node_list[i]} '" + jobcmds[njob_pointer] +  "'"
+          pid = launch(cmdstr)
+          active.append(new_lease(host, "CPU", None, nproc, jobcmds[njob_pointer], pid, now))
+          avail_nproc -= nproc
+          jobcmds[njob_pointer] = 'x'
+          njob_pointer += 1
+    else:
+      status = probe_nodes(gpu_node_list, "GPU")
+      for i in range(len(gpu_node_list)): 
+        if njob_pointer >= len(jobcmds): break
+        host = gpu_node_list[i].split('-')[0]
+        ava_cards = check_gpu_avail(gpu_node_list[i], status[host]) 
+        leased_cards = [l["card"] for l in active if l["node"] == host and l["type"] == "GPU"]
+        ava_cards = [c for c in ava_cards if c not in leased_cards]
+        if ava_cards != []:
+          for card in ava_cards:
+            cuda_device = f'export CUDA_VISIBLE_DEVICES="{card}"'
+            pci_bus_id = 'export CUDA_DEVICE_ORDER=PCI_BUS_ID'
+            if njob_pointer < len(jobcmds):
+              cmdstr = f"{SSH} {host} '{pci_bus_id}; {cuda_device}; {jobcmds[njob_pointer]} '"
+              pid = launch(cmdstr)
+              active.append(new_lease(host, "GPU", card, 1, jobcmds[njob_pointer], pid, now))
+              jobcmds[njob_pointer] = 'x'
+              njob_pointer += 1
+    leases["leases"] = active
      
   # return the remainig jobcmds
   tmp = [] 
@@ -201,6 +362,7 @@ if __name__ == '__main__':
   parser.add_argument('-t', dest = 'type',  help = "Job type", choices =['CPU', 'GPU'], required=True, type = str.upper) 
   parser.add_argument('-n', dest = 'nproc',  help = "Nproc requested", default=2, type=int) 
   parser.add_argument('-nodes', dest = 'nodes',  nargs='+', help = "node list", default = []) 
+  parser.add_argument('-b', dest = 'batch', action = 'store_true', help = "Batch mode for many small CPU jobs: one ssh call per node, which runs its share of jobs with xargs -P") 
   args = vars(parser.parse_args())
   jobshs = args["jobshs"]
   jobcmds = args["jobcmds"]
@@ -208,6 +370,7 @@ if __name__ == '__main__':
   global nproc,paths
   paths = args["paths"]
   nproc = args["nproc"]
+  batch = args["batch"]
   nodes = args["nodes"]  
 
   global gpu_node_list
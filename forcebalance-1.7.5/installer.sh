@@ -45,6 +45,12 @@ cp --remove-destination $modfileHOME/data/npt.py $fbHOME/data/npt.py
 cp --remove-destination $modfileHOME/data/md_ism_hfe.py $fbHOME/data/md_ism_hfe.py
 cp --remove-destination $modfileHOME/minimum_match.py $fbHOME/minimum_match.py
 cp --remove-destination $modfileHOME/solvation.py $fbHOME/solvation.py
+cp --remove-destination $modfileHOME/jobpool.py $fbHOME/jobpool.py
+cp --remove-destination $modfileHOME/tinker_analyze.py $fbHOME/tinker_analyze.py
+cp --remove-destination $modfileHOME/evalcache.py $fbHOME/evalcache.py
+cp --remove-destination $modfileHOME/tinker_deriv.py $fbHOME/tinker_deriv.py
+cp --remove-destination $modfileHOME/tinker_exec.py $fbHOME/tinker_exec.py
+cp --remove-destination $modfileHOME/executors.py $fbHOME/executors.py
 cp --remove-destination $modfileHOME/ForceBalance $condaHOME/bin/ForceBalance
 
 ###
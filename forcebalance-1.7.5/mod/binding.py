@@ -19,6 +19,8 @@ from forcebalance.finite_difference import fdwrap, f1d2p, f12d3p, in_fd
 from collections import OrderedDict
 from multiprocessing import Pool
 import time
+from forcebalance import jobpool
+from forcebalance.executors import get_executor
 from forcebalance.output import getLogger
 import pathos.multiprocessing as mp 
 logger = getLogger(__name__)
@@ -148,6 +150,9 @@ class BindingEnergy(Target):
         self.set_option(None, None, 'rmsd_denom', val=tgt_opts['rmsd_denom'])
 
         self.set_option(tgt_opts,'attenuate')
+        ## Backend running the analyze and optimize jobs
+        self.set_option(tgt_opts,'executor',default='local')
+        self.set_option(tgt_opts,'executor_workers')
         ## LPW 2018-02-11: This is set to True if the target calculates
         ## a single-point property over several existing snapshots.
         self.loop_over_snapshots = False
@@ -203,7 +208,7 @@ class BindingEnergy(Target):
 
             def Energy_RMSD(systems):
               tinkerhome = os.environ["TINKERPATH"]
-              cmdstrs = []
+              shfiles = []
               for sys_ in systems: 
                 opts = systems[sys_]
                 optimize = (opts['optimize'] if 'optimize' in opts else False)
@@ -211,21 +216,17 @@ class BindingEnergy(Target):
                   cmdstr = "rm -f %s.out; %s/analyze %s.xyz -k %s.key E > %s.out"%(sys_, os.environ["TINKERPATH"], sys_, sys_, sys_)
                 else:
                   cmdstr = "rm -f %s.xyz_2 %s.out; %s/optimize %s.xyz -k %s.key 0.0001 > %s.out"%(sys_, sys_, os.environ["TINKERPATH"], sys_, sys_, sys_)
-                cmdstrs.append(cmdstr)
+                jobpool.write_job_script("%s.sh" % sys_, [cmdstr])
+                shfiles.append("%s.sh" % sys_)
               
-              ncpu = os.cpu_count()
-              with open("run.sh", 'w') as f:
-                for i in range(len(cmdstrs)):
-                  if (i+1)%ncpu == 0:
-                    f.write(f"{cmdstrs[i]} \n")
-                  else:
-                    f.write(f"{cmdstrs[i]} &\n")
-                f.write(f"wait\n")
-              
-              os.system("sh run.sh")
-              for sys_ in systems:
-                while not os.path.isfile(os.path.join(os.getcwd(), sys_ + ".out")):
-                  time.sleep(1.0)
+              # run the systems in parallel with the executor of this target
+              jobpool.clear_status(shfiles)
+              executor = get_executor(self.executor, self.executor_workers)
+              executor.submit(shfiles, "CPU", ncpu=1, batch=True,
+                              inputs=dict(("%s.sh" % sys_, self.FF.fnms + ["%s.xyz" % sys_, "%s.key" % sys_]) for sys_ in systems),
+                              outputs=dict(("%s.sh" % sys_, ["%s.out" % sys_] + (["%s.xyz_2" % sys_] if systems[sys_].get('optimize', False) else []))
+                                           for sys_ in systems))
+              executor.wait_all(shfiles, poll=0.2)
               Es = {} 
               RMSDs = {} 
               for sys_ in systems:
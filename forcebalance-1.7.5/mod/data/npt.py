@@ -20,17 +20,24 @@ from builtins import zip
 from builtins import range
 import os
 import sys
+import time
 import glob
 import shutil
 import argparse
 import traceback
 import numpy as np
 from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
 from collections import namedtuple, OrderedDict
 from forcebalance.forcefield import FF
 from forcebalance.nifty import col, flat, lp_dump, lp_load, printcool, printcool_dictionary, statisticalInefficiency, which, _exec, isint, wopen, click
 from forcebalance.finite_difference import fdwrap, f1d2p, f12d3p, f1d7p, in_fd
 from forcebalance.molecule import Molecule
+from forcebalance import jobpool
+from forcebalance.tinker_analyze import read_analyze, merge_analyze, arc_shards, extract_command, shard_name
+from forcebalance.evalcache import EvalCache, digest, file_hash
+from forcebalance.tinker_deriv import linear_derivatives
+from forcebalance.executors import get_executor
 from forcebalance.output import getLogger
 logger = getLogger(__name__)
 
@@ -49,6 +56,8 @@ faststep         = 0.25                    # "fast" timestep (for MTS integrator
 temperature      = args.temperature        # temperature in kelvin
 pressure         = args.pressure           # pressure in atmospheres
 engname          = args.engine.lower()     # Name of the engine
+anashards        = 4                       # parallel jobs per analysis of the liquid trajectory (TINKER)
+linear_grad      = True                    # analytic derivatives of force constants of linear terms (TINKER)
 
 if engname == "openmm":
     try:
@@ -161,7 +170,114 @@ def energy_derivatives(engine, FF, mvals, h, pgrad, length, AGrad=True, dipole=F
     return G, GDx, GDy, GDz
 
 
-def energy_derivatives_TINKER(FF, mvals, h, pgrad, length, AGrad=True):
+def analyze_jobs(phase, keys, nshards=1, ncpu=1):
+  """
+  Write the job scripts analyzing the trajectory of a phase with perturbed key files.
+
+  The trajectory is split into nshards frame-contiguous shards, with one job
+  per shard for all key files. Each job reads its shard of <phase>-md.arc from
+  the shared file system once, into node-local scratch (in memory if /dev/shm
+  exists), and runs analyze on it for every key file, ncpu at a time. So the
+  shared-disk reads and the number of jobs scale with the frames, not with the
+  number of parameter sets. (analyze evaluates one parameter set per run, so
+  one analyze process per key file and shard is still started.)
+
+  @param[in] phase "liquid" or "gas"
+  @param[in] keys List of key files; the output of shard n for X.key is written to X.<n>.out
+  @param[in] nshards Number of shards of the trajectory
+  @param[in] ncpu Number of analyze runs at a time in each job
+  @return List of job scripts, and the number of shards actually used
+  """
+  arcfile = f"{phase}-md.arc"
+  shards = arc_shards(arcfile, nshards)
+  shfiles = []
+  if not keys:
+    return shfiles, len(shards)
+  roots = ' '.join([os.path.splitext(key)[0] for key in keys])
+  for n, shard in enumerate(shards):
+    shfile = shard_name(f"{phase}-fd.sh", n)
+    jobpool.write_job_script(shfile, ['_scratch=$(mktemp -d -p /dev/shm 2>/dev/null || mktemp -d)',
+                                      extract_command(arcfile, shard, f"$_scratch/{arcfile}"),
+                                      f"printf '%s\\n' {roots} | OMP_NUM_THREADS=1 xargs -P {ncpu} -I @ "
+                                      f"sh -c \"analyze $_scratch/{arcfile} -k ./@.key G,E,M > @.{n:02d}.out 2>&1\"; _status=$?",
+                                      'rm -rf $_scratch', 'test $_status -eq 0'])
+    shfiles.append(shfile)
+  return shfiles, len(shards)
+
+def read_shards(out, nshards, dipole=True):
+  """ Read and join the analyze outputs of all shards for one key file. """
+  return merge_analyze([read_analyze(shard_name(out, n), dipole=dipole) for n in range(nshards)])
+
+def cache_lookup(cache, phase, keys, prms, lines):
+  """
+  Look up the analyze results of perturbed parameter sets in the evaluation cache.
+
+  @param[in] cache EvalCache instance
+  @param[in] phase "liquid" or "gas"
+  @param[in] keys Key files, one per perturbed parameter set
+  @param[in] prms Parameter files of the key files
+  @param[in] lines Lines of the key files other than the parameters line
+  @return Dictionary of cached results (None if not cached) and dictionary of cache keys, both by key file
+  """
+  archash = file_hash(f"{phase}-md.arc")
+  digests = OrderedDict((key, digest(open(prm, 'rb').read(), ''.join(lines), archash, "analyze G,E,M")) for key, prm in zip(keys, prms))
+  results = OrderedDict((key, cache.get(digests[key])) for key in keys)
+  ncached = len([key for key in keys if results[key] is not None])
+  if ncached:
+    logger.info("%i of %i %s analyze results found in the evaluation cache\n" % (ncached, len(keys), phase))
+  return results, digests
+
+def fd_sides(scheme):
+  """ Perturbations run by a finite-difference scheme: minus and plus for central, plus only for forward. """
+  if scheme == 'central':
+    return ['m', 'p']
+  elif scheme == 'forward':
+    return ['p']
+  logger.error("Unknown finite-difference scheme %s\n" % scheme)
+  raise RuntimeError("Unknown finite-difference scheme")
+
+def fd_choose(TgtOptions):
+  """ Resolve the fd_scheme target option to central or forward differences for this iteration. """
+  scheme = TgtOptions.get('fd_scheme', 'central').lower()
+  if scheme == 'adaptive':
+    iteration = TgtOptions.get('iteration', 0)
+    scheme = 'forward' if iteration < TgtOptions.get('fd_forward_iters', 2) else 'central'
+    logger.info("Adaptive finite differences: iteration %i uses %s differences\n" % (iteration, scheme))
+  fd_sides(scheme)
+  return scheme
+
+def write_perturbed_prms(FF, mvals, h, pgrad, scheme='central'):
+  """
+  Write the parameter files of the finite-difference perturbations, X_<i>_<m|p>.prm
+  next to the parameter file X.prm named in liquid.key.
+
+  This is done once before any dynamics start: FF.make() writes X.prm, which
+  the jobs of the liquid and gas phases read while they run side by side.
+  """
+  for line in open("liquid.key").readlines():
+    if "PARAMETERS" in line.upper(): 
+      prmprefix = line.split()[1].split(".prm")[0]
+  #backup the current water.prm
+  os.rename(prmprefix +".prm", prmprefix + ".prm.org")
+  for i in pgrad:
+    for side in fd_sides(scheme):
+      mvals_ = mvals.copy()
+      mvals_[i] += abs(h) if side == 'p' else -abs(h)
+      FF.make(mvals_)
+      os.rename(prmprefix + ".prm", prmprefix + "_%02d_%s.prm"%(i,side))
+  # rename back the un-perturbed prm file
+  os.rename(prmprefix + ".prm.org", prmprefix + ".prm")
+
+def energy_derivatives_TINKER(FF, mvals, h, pgrad, length, AGrad=True, scheme='central', f0=None, executor=None):
+  """
+  Finite-difference derivatives of the liquid energies and dipoles, from analyze runs over liquid-md.arc
+  with the parameter files written by write_perturbed_prms.
+
+  @param[in] scheme "central" (error O(h^2)) or "forward" (error O(h), half as many analyze runs)
+  @param[in] f0 Unperturbed energies (kJ/mol) and dipoles (debye) from the MD post-processing, needed for forward differences
+  @param[in] executor Backend running the analyze jobs (see forcebalance.executors), defaults to the job pool
+  @return G, GDx, GDy, GDz Derivatives of the energies and dipole components, N_param x N_coord arrays
+  """
   # find the prm file name
   for line in open("liquid.key").readlines():
     if "PARAMETERS" in line.upper(): 
@@ -174,137 +290,65 @@ def energy_derivatives_TINKER(FF, mvals, h, pgrad, length, AGrad=True):
   if not AGrad:
     return G, GDx, GDy, GDz
 
-  tinkerpath = os.environ["TINKERPATH"]
   #Record key file except for the first line
   lines = open("liquid-md.key").readlines()[1:]
-  #backup the current water.prm
-  os.rename(prmprefix +".prm", prmprefix + ".prm.org")
 
-  # this will be used later
-  tinkercmds = []
+  keys = []
+  prms = []
   for i in pgrad:
-    #minus and plus
-    prmfile1 = open("liquid_%02d_m.key"%i, 'w')
-    prmfile2 = open("liquid_%02d_p.key"%i, 'w')
-    prmfile1.write("parameters ./%s_%02d_m.prm\n"%(prmprefix,i))
-    prmfile2.write("parameters ./%s_%02d_p.prm\n"%(prmprefix,i))
-    #use 1 core for each analyze job
-    for line in lines:
-      prmfile1.write(line)
-      prmfile2.write(line)
-    prmfile1.close()
-    prmfile2.close()
-    
-    mvals_= mvals
-    mvals_[i] += -abs(h) 
-    FF.make(mvals_)
-    os.rename(prmprefix + ".prm", prmprefix + "_%02d_m.prm"%i)
-    mvals_[i] += abs(h)*2.0 
-    FF.make(mvals_)
-    os.rename(prmprefix + ".prm", prmprefix + "_%02d_p.prm"%i)
-    mvals_[i] += -abs(h) 
-    
-    cmdstr1 = f"analyze ./liquid-md.arc -k ./liquid_%02d_m.key G,E,M > liquid_%02d_m.out 2>&1"%(i,i)
-    cmdstr2 = f"analyze ./liquid-md.arc -k ./liquid_%02d_p.key G,E,M > liquid_%02d_p.out 2>&1"%(i,i)
-    tinkercmds.append(cmdstr1)
-    tinkercmds.append(cmdstr2)
-
-  # rename back the un-perturbed prm file
-  os.rename(prmprefix + ".prm.org", prmprefix + ".prm")
+    for side in fd_sides(scheme):
+      #minus or plus
+      with open("liquid_%02d_%s.key"%(i,side), 'w') as keyfile:
+        keyfile.write("parameters ./%s_%02d_%s.prm\n"%(prmprefix,i,side))
+        for line in lines:
+          keyfile.write(line)
+      keys.append("liquid_%02d_%s.key"%(i,side))
+      prms.append(prmprefix + "_%02d_%s.prm"%(i,side))
+
+  # parameter sets seen before on this trajectory are not analyzed again
+  cache = EvalCache()
+  results, digests = cache_lookup(cache, "liquid", keys, prms, lines)
+  todo = [key for key in keys if results[key] is None]
  
   # write .sh files
   # reason is that we want to use env var from sh through ssh
-  shfiles = []
-  fbbashrc = os.environ["FBBASHRC"]
-  for i in range(len(tinkercmds)):
-    with open(f'liquid_{i:02d}.sh', 'w') as f:
-      f.write(f'source {fbbashrc}\n')
-      f.write(f'{tinkercmds[i]}\n')
-      shfiles.append(f"liquid_{i:02d}.sh")
+  shfiles, nshards = analyze_jobs("liquid", todo, anashards, ncpu=4)
   
-  # store some variables for later use 
-  workingdir = os.getcwd()
-  hoststr = os.getenv('HOSTNAME').split('.')[0]
-  jobpooldir = os.environ["JOBPOOL"]
-  timestr = str(time.time()).replace('.', '')
-  scriptfile = f"{jobpooldir}/{hoststr}-{timestr}.sh"
-  jobstr = '  '.join(shfiles)
-  shstr = f"python {tinkerpath}/submitTinker.py -x {jobstr} -t CPU -n 4 -p {workingdir}"
- 
-  # Check whether all analyze jobs finished!
-  readFlag = 0
-  cmdstr1 = "grep 'Dipole X,Y,Z-Components :' liquid_*_m.out >dipole_m.dat"
-  cmdstr2 = "grep 'Dipole X,Y,Z-Components :' liquid_*_p.out >dipole_p.dat"
-  os.system(cmdstr1)
-  os.system(cmdstr2)
-  nLinesDm = sum(1 for line in open("dipole_m.dat"))
-  nLinesDp = sum(1 for line in open("dipole_p.dat"))
-  if ((nLinesDm == length*len(pgrad)) and (nLinesDp == length*len(pgrad))):
-    readFlag = 1
-  if readFlag == 0:
-    with open(scriptfile, 'w') as f:
-      f.write(shstr)
+  # submit the jobs not finished yet
+  executor = executor or get_executor()
+  executor.submit([shfile for shfile in shfiles if jobpool.job_status(shfile) is None], "CPU", ncpu=4, batch=True,
+                  inputs=["liquid-md.arc"] + todo + [prms[keys.index(key)] for key in todo],
+                  outputs=[shard_name(os.path.splitext(key)[0] + ".out", n) for key in todo for n in range(nshards)])
   
-  # Keep checking if not all analyze jobs finished!
-  while readFlag == 0:
-    cmdstr1 = "grep 'Dipole X,Y,Z-Components :' liquid_*_m.out >dipole_m.dat"
-    cmdstr2 = "grep 'Dipole X,Y,Z-Components :' liquid_*_p.out >dipole_p.dat"
-    os.system(cmdstr1)
-    os.system(cmdstr2)
-    nLinesDm = sum(1 for line in open("dipole_m.dat"))
-    nLinesDp = sum(1 for line in open("dipole_p.dat"))
-    if ((nLinesDm == length*len(pgrad)) and (nLinesDp == length*len(pgrad))):
-      readFlag = 1
-      break
-    else:
-      time.sleep(15.0)
-  #If all jobs finished, calculate numerical gradients
-  if readFlag == 1:
-    for i in pgrad:
-      eanl_m = []
-      eanl_p = []
-      dip_px = []
-      dip_py = []
-      dip_pz = []
-      dip_mx = []
-      dip_my = []
-      dip_mz = []
-      lines = open("liquid_%02d_m.out"%i).readlines()
-      for line in lines:
-        s = line.split()
-        if 'Total Potential Energy : ' in line:
-          eanl_m.append(float(s[4]) * 4.184)
-        if 'Dipole X,Y,Z-Components :' in line:
-          dip_mx.append(float(s[-3]))
-          dip_my.append(float(s[-2]))
-          dip_mz.append(float(s[-1]))
-      lines = open("liquid_%02d_p.out"%i).readlines()
-      for line in lines:
-        s = line.split()
-        if 'Total Potential Energy : ' in line:
-          eanl_p.append(float(s[4]) * 4.184)
-        if 'Dipole X,Y,Z-Components :' in line:
-          dip_px.append(float(s[-3]))
-          dip_py.append(float(s[-2]))
-          dip_pz.append(float(s[-1]))
-      
-      #use np.array here 
-      eanl_p = np.array(eanl_p) 
-      eanl_m = np.array(eanl_m)
-      dip_px = np.array(dip_px)
-      dip_py = np.array(dip_py)
-      dip_pz = np.array(dip_pz)
-      dip_mx = np.array(dip_mx)
-      dip_my = np.array(dip_my)
-      dip_mz = np.array(dip_mz)
+  # Wait for all analyze jobs to finish
+  executor.wait_all(shfiles)
+  for key in todo:
+    results[key] = read_shards(os.path.splitext(key)[0] + ".out", nshards)
+    cache.put(digests[key], results[key])
+  # calculate numerical gradients
+  for i in pgrad:
+    anl_p = results["liquid_%02d_p.key"%i]
+    if scheme == 'central':
+      anl_m = results["liquid_%02d_m.key"%i]
       #2-sides numerical grad.
-      G[i,:]   = (eanl_p - eanl_m)/(2*h)
-      GDx[i,:] = (dip_px - dip_mx)/(2*h) 
-      GDy[i,:] = (dip_py - dip_my)/(2*h) 
-      GDz[i,:] = (dip_pz - dip_mz)/(2*h)
+      G[i,:]   = (anl_p["Energy"] - anl_m["Energy"])*4.184/(2*h)
+      GDx[i,:], GDy[i,:], GDz[i,:] = ((anl_p["Dipole"] - anl_m["Dipole"])/(2*h)).T
+    else:
+      #1-side numerical grad. from the unperturbed analyze run
+      G[i,:]   = (anl_p["Energy"]*4.184 - f0[0])/h
+      GDx[i,:], GDy[i,:], GDz[i,:] = ((anl_p["Dipole"] - f0[1])/h).T
   return G, GDx, GDy, GDz
 
-def energy_derivatives_gas(FF, h, pgrad, length, AGrad=True):
+def energy_derivatives_gas(FF, h, pgrad, length, AGrad=True, scheme='central', f0=None, executor=None):
+  """
+  Finite-difference derivatives of the gas energies, from analyze runs over gas-md.arc
+  with the parameter files written by write_perturbed_prms.
+
+  @param[in] scheme "central" or "forward", as for energy_derivatives_TINKER
+  @param[in] f0 Unperturbed energies (kJ/mol) from the MD post-processing, needed for forward differences
+  @param[in] executor Backend running the analyze jobs, as for energy_derivatives_TINKER
+  @return G Derivatives of the energies, N_param x N_coord array
+  """
   # find the prm file name
   lines = open("gas.key").readlines()
   for line in lines:
@@ -314,80 +358,50 @@ def energy_derivatives_gas(FF, h, pgrad, length, AGrad=True):
   G   = np.zeros((FF.np,length))
   if not AGrad:
     return G
-  tinkerpath = os.environ["TINKERPATH"]
   #Record key file except for the first line
   lines = open("gas-md.key").readlines()[1:]
   
-  # this will be used later
-  submitcmds = []
-  tinkercmds = []
-  currdir = os.getcwd()
-  
+  keys = []
+  prms = []
   for i in pgrad:
-    #minus and plus
-    prmfile1 = open("gas_%02d_m.key"%i, 'w')
-    prmfile2 = open("gas_%02d_p.key"%i, 'w')
-    prmfile1.write("parameters ./%s_%02d_m.prm\n"%(prmprefix, i))
-    prmfile2.write("parameters ./%s_%02d_p.prm\n"%(prmprefix, i))
-    for line in lines:
-      prmfile1.write(line)
-      prmfile2.write(line)
-    prmfile1.close()
-    prmfile2.close()
-    
-    cmdstr1 = f"nohup analyze ./gas-md.arc -k ./gas_%02d_m.key G,E,M > gas_%02d_m.out 2>&1"%(i,i)
-    cmdstr2 = f"nohup analyze ./gas-md.arc -k ./gas_%02d_p.key G,E,M > gas_%02d_p.out 2>&1"%(i,i)
-    tinkercmds.append(cmdstr1)
-    tinkercmds.append(cmdstr2)
+    for side in fd_sides(scheme):
+      #minus or plus
+      with open("gas_%02d_%s.key"%(i,side), 'w') as keyfile:
+        keyfile.write("parameters ./%s_%02d_%s.prm\n"%(prmprefix, i, side))
+        for line in lines:
+          keyfile.write(line)
+      keys.append("gas_%02d_%s.key"%(i,side))
+      prms.append("%s_%02d_%s.prm"%(prmprefix, i, side))
+  # parameter sets seen before on this trajectory are not analyzed again
+  cache = EvalCache()
+  results, digests = cache_lookup(cache, "gas", keys, prms, lines)
+  todo = [key for key in keys if results[key] is None]
   
   # write .sh files
   # reason is that we want to use env var from sh through ssh
-  fbbashrc = os.environ["FBBASHRC"]
-  for i in range(len(tinkercmds)):
-    with open(f'gas_{i:02d}.sh', 'w') as f:
-      f.write(f'source {fbbashrc}\n')
-      f.write(f'{tinkercmds[i]}\n')
-    submitcmds.append(f'sh gas_{i:02d}.sh')
+  shfiles, nshards = analyze_jobs("gas", todo, ncpu=2)
   
-  # use external API to submit 
-  submitcmds = [ '"' + cmd + '" ' for cmd in submitcmds]
-  submitstr = ' '.join(submitcmds)
-  os.system(f"python {tinkerpath}/submitTinker.py -c {submitstr} -t CPU -n 2 -p {currdir}")
-
-  #Check whether all analyze jobs finished!
-  readFlag = 0
-  while readFlag == 0:
-    cmdstr1 = "grep 'Total Potential Energy : ' gas_*_m.out >energy_m.dat"
-    cmdstr2 = "grep 'Total Potential Energy : ' gas_*_p.out >energy_p.dat"
-    os.system(cmdstr1)
-    os.system(cmdstr2)
-    nLinesDm = sum(1 for line in open("energy_m.dat"))
-    nLinesDp = sum(1 for line in open("energy_p.dat"))
-    if ((nLinesDm == length*len(pgrad)) and (nLinesDp == length*len(pgrad))):
-      readFlag = 1
-      break
-    else:
-      time.sleep(30.0)
-  #If all jobs finished, calculate numerical gradients
-  if readFlag==1:
-    for i in pgrad:
-      eanl_m = []
-      eanl_p = []
-      lines = open("gas_%02d_m.out"%i).readlines()
-      for line in lines:
-        s = line.split()
-        if 'Total Potential Energy : ' in line:
-          eanl_m.append(float(s[4]) * 4.184)
-      lines = open("gas_%02d_p.out"%i).readlines()
-      for line in lines:
-        s = line.split()
-        if 'Total Potential Energy : ' in line:
-          eanl_p.append(float(s[4]) * 4.184)
-      #use np.array here 
-      eanl_p = np.array(eanl_p) 
-      eanl_m = np.array(eanl_m)
+  # submit the jobs not finished yet
+  executor = executor or get_executor()
+  executor.submit([shfile for shfile in shfiles if jobpool.job_status(shfile) is None], "CPU", ncpu=2, batch=True,
+                  inputs=["gas-md.arc"] + todo + [prms[keys.index(key)] for key in todo],
+                  outputs=[shard_name(os.path.splitext(key)[0] + ".out", n) for key in todo for n in range(nshards)])
+
+  # Wait for all analyze jobs to finish
+  executor.wait_all(shfiles)
+  for key in todo:
+    results[key] = read_shards(os.path.splitext(key)[0] + ".out", nshards, dipole=False)
+    cache.put(digests[key], results[key])
+  # calculate numerical gradients
+  for i in pgrad:
+    anl_p = results["gas_%02d_p.key"%i]
+    if scheme == 'central':
+      anl_m = results["gas_%02d_m.key"%i]
       #2-sides numerical grad.
-      G[i,:]   = (eanl_p - eanl_m)/(2*h)
+      G[i,:]   = (anl_p["Energy"] - anl_m["Energy"])*4.184/(2*h)
+    else:
+      #1-side numerical grad. from the unperturbed analyze run
+      G[i,:]   = (anl_p["Energy"]*4.184 - f0)/h
   return G
 
 def property_derivatives(engine, FF, mvals, h, pgrad, kT, property_driver, property_kwargs, AGrad=True):
@@ -491,6 +505,8 @@ def main():
     # - Options from the Target object that launched this simulation
     # - Switch for whether to evaluate analytic derivatives.
     FF,mvals,TgtOptions,AGrad = lp_load('forcebalance.p')
+    # Tell Liquid.submit_jobs that this simulation is running.
+    jobpool.signal_started('npt.started')
     FF.ffdir = '.'
     # Write the force field file.
     FF.make(mvals)
@@ -521,6 +537,11 @@ def main():
     nbarostat = TgtOptions.get('n_mcbarostat', 25)
     anisotropic = TgtOptions.get('anisotropic_box', 0)
     minimize = TgtOptions.get('minimize_energy', 1)
+    # Backend of the dynamics and analyze jobs; under Work Queue this script already runs on a worker.
+    executor_name = TgtOptions.get('executor') or 'jobpool'
+    if executor_name.lower() == 'workqueue':
+        executor_name = 'local'
+    executor = get_executor(executor_name, TgtOptions.get('executor_workers', 0), TgtOptions.get('tinkerpath'))
 
     # Print all options.
     printcool_dictionary(TgtOptions, title="Options from ForceBalance")
@@ -628,11 +649,15 @@ def main():
                                     ("nsave", int(1000 * liquid_intvl / liquid_timestep)),
                                     ("verbose", True), ('save_traj', TgtOptions['save_traj']), 
                                     ("threads", threads), ("anisotropic", anisotropic), ("nbarostat", nbarostat),
-                                    ("mts", mts), ("rpmd_beads", rpmd_beads), ("faststep", faststep)])
+                                    ("mts", mts), ("rpmd_beads", rpmd_beads), ("faststep", faststep),
+                                    ("anashards", anashards)])
     MDOpts["gas"] = OrderedDict([("nsteps", gas_nsteps), ("timestep", gas_timestep),
                                  ("temperature", temperature), ("nsave", int(1000 * gas_intvl / gas_timestep)),
                                  ("nequil", gas_nequil), ("minimize", minimize), ("threads", 4), ("mts", mts),
                                  ("rpmd_beads", rpmd_beads), ("faststep", faststep)])
+    if engname == "tinker":
+        MDOpts["liquid"]["executor"] = executor
+        MDOpts["gas"]["executor"] = executor
 
     # Energy components analysis disabled for OpenMM MTS because it uses force groups
     if (engname == "openmm" and mts): logger.warn("OpenMM with MTS integrator; energy components analysis will be disabled.\n")
@@ -641,6 +666,42 @@ def main():
     Liquid = Engine(name="liquid", **EngOpts["liquid"])
     Gas = Engine(name="gas", **EngOpts["gas"])
 
+    logger.info("Calculating potential energy derivatives with finite difference step size: %f\n" % h)
+    fdscheme = fd_choose(TgtOptions)
+    fdnote = "%s differences, error O(h%s)" % (fdscheme, "^2" if fdscheme == 'central' else "")
+    logger.info("Energy derivatives by %s\n" % fdnote)
+    # The perturbed parameter files are written before any jobs start,
+    # since FF.make() overwrites the parameter file they read.
+    if AGrad:
+        write_perturbed_prms(FF, mvals, h, pgrad, scheme=fdscheme)
+
+    #==============================================#
+    # The gas phase runs alongside the liquid.     #
+    #==============================================#
+
+    def gas_phase():
+        """ Gas phase dynamics and energy derivatives; runs in a thread while the liquid is simulated. """
+        start = time.time()
+        mprop_return = Gas.molecular_dynamics(**MDOpts["gas"])
+        logger.info("Gas phase MD simulation took %.3f seconds\n" % (time.time() - start))
+        start = time.time()
+        mlinear = OrderedDict()
+        if AGrad and linear_grad:
+            mlinear = linear_derivatives(FF, mvals, pgrad, "gas", mprop_return['Ecomps'], executor=executor)
+            for i in mlinear:
+                logger.info("Parameter %i (%s): analytic gas phase derivative from the %s energy\n" % (i, FF.plist[i], mlinear[i][0]))
+        #mG, _, __, ___ = energy_derivatives(Gas, FF, mvals, h, pgrad, len(mEnergies), AGrad, dipole=False)
+        mG = energy_derivatives_gas(FF, h, [i for i in pgrad if i not in mlinear], len(mprop_return['Potentials']), AGrad,
+                                    scheme=fdscheme, f0=mprop_return.get('AnaEnergies'), executor=executor)
+        for i, (source, dE) in mlinear.items():
+            mG[i,:] = dE
+        logger.info("Gas phase energy derivatives took %.3f seconds\n" % (time.time() - start))
+        return mprop_return, mG
+
+    printcool("Gas phase molecular dynamics (in the background)", color=4, bold=True)
+    gas_thread = ThreadPoolExecutor(max_workers=1)
+    gas_future = gas_thread.submit(gas_phase)
+
     #=================================================================#
     # Run the simulation for the full system and analyze the results. #
     #=================================================================#
@@ -685,28 +746,9 @@ def main():
     Rho_avg, Rho_err = mean_stderr(Rhos)
     #PrintEDA(EDA, NMol)
 
-    #==============================================#
-    # Now run the simulation for just the monomer. #
-    #==============================================#
-
-    # Run the OpenMM simulation, gather information.
-
-    printcool("Gas phase molecular dynamics", color=4, bold=True)
-    click()
-    mprop_return = Gas.molecular_dynamics(**MDOpts["gas"])
-    logger.info("Gas phase MD simulation took %.3f seconds\n" % click())
-    mPotentials = mprop_return['Potentials']
-    mKinetics = mprop_return['Kinetics']
-    mEDA = mprop_return['Ecomps']
-
-    mEnergies = mPotentials + mKinetics
-    mEne_avg, mEne_err = mean_stderr(mEnergies)
-    #PrintEDA(mEDA, 1)
-
     #============================================#
     #  Compute the potential energy derivatives. #
     #============================================#
-    logger.info("Calculating potential energy derivatives with finite difference step size: %f\n" % h)
     # Switch for whether to compute the derivatives two different ways for consistency.
     FDCheck = False
 
@@ -721,13 +763,35 @@ def main():
     printcool("Condensed phase energy and dipole derivatives\nInitializing array to length %i" % len(Energies), color=4, bold=True)
     click()
     #G, GDx, GDy, GDz = energy_derivatives(Liquid, FF, mvals, h, pgrad, len(Energies), AGrad, dipole=True)
-    G, GDx, GDy, GDz = energy_derivatives_TINKER(FF, mvals, h, pgrad, len(Energies), AGrad)
+    # Force constants of linear terms are differentiated from the energies of their parameter lines, the rest by finite differences.
+    # Each phase decides this on its own system, so a term may be linear in one phase only.
+    linear = OrderedDict()
+    if AGrad and linear_grad:
+        linear = linear_derivatives(FF, mvals, pgrad, "liquid", EDA, executor=executor, nshards=anashards)
+        for i in linear:
+            logger.info("Parameter %i (%s): analytic derivative from the %s energy\n" % (i, FF.plist[i], linear[i][0]))
+    G, GDx, GDy, GDz = energy_derivatives_TINKER(FF, mvals, h, [i for i in pgrad if i not in linear], len(Energies), AGrad,
+                                                 scheme=fdscheme, f0=(prop_return.get('AnaEnergies'), Dips), executor=executor)
+    for i, (source, dE) in linear.items():
+        G[i,:] = dE
     logger.info("Condensed phase energy derivatives took %.3f seconds\n" % click())
+
+    #==============================================#
+    # Collect the simulation of just the monomer.  #
+    #==============================================#
+
+    printcool("Gas phase results", color=4, bold=True)
     click()
-    printcool("Gas phase energy derivatives", color=4, bold=True)
-    #mG, _, __, ___ = energy_derivatives(Gas, FF, mvals, h, pgrad, len(mEnergies), AGrad, dipole=False)
-    mG = energy_derivatives_gas(FF, h, pgrad, len(mEnergies), AGrad)
-    logger.info("Gas phase energy derivatives took %.3f seconds\n" % click())
+    mprop_return, mG = gas_future.result()
+    gas_thread.shutdown()
+    logger.info("Waited %.3f seconds for the gas phase\n" % click())
+    mPotentials = mprop_return['Potentials']
+    mKinetics = mprop_return['Kinetics']
+    mEDA = mprop_return['Ecomps']
+
+    mEnergies = mPotentials + mKinetics
+    mEne_avg, mEne_err = mean_stderr(mEnergies)
+    #PrintEDA(mEDA, 1)
 
     #==============================================#
     #  Condensed phase properties and derivatives. #
@@ -739,7 +803,7 @@ def main():
     # Build the first density derivative.
     GRho = mBeta * (flat(np.dot(G, col(Rhos))) / L - np.mean(Rhos) * np.mean(G, axis=1))
     # Print out the density and its derivative.
-    Sep = printcool("Density: % .4f +- % .4f kg/m^3\nAnalytic Derivative:" % (Rho_avg, Rho_err))
+    Sep = printcool("Density: % .4f +- % .4f kg/m^3\nAnalytic Derivative (%s):" % (Rho_avg, Rho_err, fdnote))
     FF.print_map(vals=GRho)
     logger.info(Sep)
 
@@ -789,7 +853,7 @@ def main():
     GHvap *= -1
     GHvap -= mBeta * (flat(np.dot(G, col(pV))) / L - np.mean(pV) * np.mean(G, axis=1)) / NMol
 
-    Sep = printcool("Enthalpy of Vaporization: % .4f +- %.4f kJ/mol\nAnalytic Derivative:" % (Hvap_avg, Hvap_err))
+    Sep = printcool("Enthalpy of Vaporization: % .4f +- %.4f kJ/mol\nAnalytic Derivative (%s):" % (Hvap_avg, Hvap_err, fdnote))
     FF.print_map(vals=GHvap)
 
     # Define some things to make the analytic derivatives easier.
@@ -825,7 +889,7 @@ def main():
     GAlpha3 = deprod(V)/avg(V) - Gbar
     GAlpha4 = Beta * covde(H)
     GAlpha  = (GAlpha1 + GAlpha2 + GAlpha3 + GAlpha4)/(kT*T)
-    Sep = printcool("Thermal expansion coefficient: % .4e +- %.4e K^-1\nAnalytic Derivative:" % (Alpha, Alpha_err))
+    Sep = printcool("Thermal expansion coefficient: % .4e +- %.4e K^-1\nAnalytic Derivative (%s):" % (Alpha, Alpha_err, fdnote))
     FF.print_map(vals=GAlpha)
     if FDCheck:
         GAlpha_fd = property_derivatives(Liquid, FF, mvals, h, pgrad, kT, calc_alpha, {'h_':H,'v_':V})
@@ -852,7 +916,7 @@ def main():
     Kappa_err = np.std(Kappaboot) * np.sqrt(statisticalInefficiency(V))
 
     # Isothermal compressibility analytic derivative
-    Sep = printcool("Isothermal compressibility:  % .4e +- %.4e bar^-1\nAnalytic Derivative:" % (Kappa, Kappa_err))
+    Sep = printcool("Isothermal compressibility:  % .4e +- %.4e bar^-1\nAnalytic Derivative (%s):" % (Kappa, Kappa_err, fdnote))
     GKappa1 = +1 * Beta**2 * avg(V**2) * deprod(V) / avg(V)**2
     GKappa2 = -1 * Beta**2 * avg(V) * deprod(V**2) / avg(V)**2
     GKappa3 = +1 * Beta**2 * covde(V)
@@ -889,7 +953,7 @@ def main():
     GCp2 = mBeta*covde(H**2) * 1000 / 4.184 / (NMol*kT*T)
     GCp3 = 2*Beta*avg(H)*covde(H) * 1000 / 4.184 / (NMol*kT*T)
     GCp  = GCp1 + GCp2 + GCp3
-    Sep = printcool("Isobaric heat capacity:  % .4e +- %.4e cal mol-1 K-1\nAnalytic Derivative:" % (Cp, Cp_err))
+    Sep = printcool("Isobaric heat capacity:  % .4e +- %.4e cal mol-1 K-1\nAnalytic Derivative (%s):" % (Cp, Cp_err, fdnote))
     FF.print_map(vals=GCp)
     if FDCheck:
         GCp_fd = property_derivatives(Liquid, FF, mvals, h, pgrad, kT, calc_cp, {'h_':H})
@@ -933,7 +997,7 @@ def main():
     GD2 += 2*(flat(np.dot(GDy,col(Dy)))/L - avg(Dy)*(np.mean(GDy,axis=1))) - Beta*(covde(Dy**2) - 2*avg(Dy)*covde(Dy))
     GD2 += 2*(flat(np.dot(GDz,col(Dz)))/L - avg(Dz)*(np.mean(GDz,axis=1))) - Beta*(covde(Dz**2) - 2*avg(Dz)*covde(Dz))
     GEps0 = prefactor*(GD2/avg(V) - mBeta*covde(V)*D2/avg(V)**2)/T
-    Sep = printcool("Dielectric constant:           % .4e +- %.4e\nAnalytic Derivative:" % (Eps0, Eps0_err))
+    Sep = printcool("Dielectric constant:           % .4e +- %.4e\nAnalytic Derivative (%s):" % (Eps0, Eps0_err, fdnote))
     FF.print_map(vals=GEps0)
     if FDCheck:
         GEps0_fd = property_derivatives(Liquid, FF, mvals, h, pgrad, kT, calc_eps0, {'d_':Dips,'v_':V})
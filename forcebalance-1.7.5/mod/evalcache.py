@@ -0,0 +1,114 @@
+""" @package forcebalance.evalcache Content-addressed cache of TINKER evaluations.
+
+Finite-difference derivatives evaluate the same parameter sets over and over,
+e.g. after a rejected optimization step or when a job is continued. The result
+of an evaluation (energies, dipoles, forces, ...) is stored under a hash of
+everything it depends on - the parameter file, the key file and the
+coordinates - so an identical evaluation is read back instead of run again.
+
+Entries are .npz files in $FB_CACHE_DIR (default: ~/.cache/forcebalance),
+shared by all ForceBalance processes of a user. Reading an entry marks it as
+recently used, and the least recently used entries are removed when the cache
+grows beyond $FB_CACHE_MB megabytes (default: 2048; 0 disables the cache).
+
+@author Chengwen Liu
+@date 10/2026
+"""
+import os
+import hashlib
+import tempfile
+import numpy as np
+from forcebalance.output import getLogger
+logger = getLogger(__name__)
+
+## Hashes of files already read by this process, by (path, size, mtime)
+_file_hashes = {}
+
+def file_hash(fnm):
+    """ SHA-256 of the contents of a file; large trajectories are only read once per process. """
+    st = os.stat(fnm)
+    memo = (os.path.realpath(fnm), st.st_size, st.st_mtime_ns)
+    if memo not in _file_hashes:
+        h = hashlib.sha256()
+        with open(fnm, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        _file_hashes[memo] = h.hexdigest()
+    return _file_hashes[memo]
+
+def digest(*parts):
+    """ Cache key of an evaluation from its inputs (strings or bytes, e.g. file contents and file_hash() values). """
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        # Hash each part separately, so that the boundaries between parts matter.
+        h.update(hashlib.sha256(part).digest())
+    return h.hexdigest()
+
+class EvalCache(object):
+    """ Directory of cached evaluation results with LRU eviction under a disk budget. """
+
+    def __init__(self, cachedir=None, budget=None):
+        """
+        @param[in] cachedir Cache directory, defaults to $FB_CACHE_DIR or ~/.cache/forcebalance
+        @param[in] budget Disk budget in megabytes, defaults to $FB_CACHE_MB or 2048
+        """
+        self.cachedir = cachedir or os.environ.get("FB_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "forcebalance"))
+        if budget is None:
+            budget = float(os.environ.get("FB_CACHE_MB", 2048))
+        self.budget = budget * 1024**2
+        self.enabled = self.budget > 0
+        if self.enabled:
+            os.makedirs(self.cachedir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.cachedir, key + ".npz")
+
+    def get(self, key):
+        """ Return the cached result as a dictionary of arrays, or None. """
+        if not self.enabled:
+            return None
+        fnm = self.path(key)
+        try:
+            with np.load(fnm) as data:
+                result = {k: data[k] for k in data.files}
+            os.utime(fnm)
+        except (IOError, OSError, ValueError):
+            return None
+        return result
+
+    def put(self, key, result):
+        """ Store a result given as a dictionary of arrays (or scalars). """
+        if not self.enabled:
+            return
+        fd, tmp = tempfile.mkstemp(dir=self.cachedir, prefix=".", suffix=".npz")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **{k: np.asarray(v) for k, v in result.items()})
+            os.rename(tmp, self.path(key))
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self.evict()
+
+    def evict(self):
+        """ Remove the least recently used entries until the cache fits in its budget. """
+        entries = []
+        for entry in os.scandir(self.cachedir):
+            if entry.name.endswith(".npz") and not entry.name.startswith("."):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, fnm in sorted(entries):
+            if total <= self.budget:
+                break
+            try:
+                os.remove(fnm)
+            except OSError:
+                pass
+            total -= size
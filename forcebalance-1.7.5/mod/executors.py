@@ -0,0 +1,251 @@
+""" @package forcebalance.executors Backends running the job scripts of the targets.
+
+The expensive work of the TINKER Liquid, Solvation, BindingEnergy and
+MinimumMatch targets is written as job scripts with
+jobpool.write_job_script(), which record their completion in a status file.
+An executor runs such scripts; all backends have the same interface:
+
+    submit(scripts, ...)   start a list of job scripts
+    status(script)         status record of a finished script, or None
+    wait_any(scripts)      block until one of the scripts has finished
+    wait_all(scripts)      block until all scripts have finished
+    cancel(scripts)        drop scripts that have not started yet
+
+The backend is chosen with the target option "executor":
+
+    jobpool    the Ren lab cluster, through submitTinker.py and the job pool
+               (default for Liquid)
+    local      a ProcessPoolExecutor on this machine, with executor_workers
+               processes, one per core by default (default for Solvation,
+               BindingEnergy and MinimumMatch)
+    workqueue  the Work Queue of the master (option wq_port), as in ForceBalance;
+               the scripts and their input files are sent to the workers
+
+so the same fit can run on one workstation or over the cluster.
+
+@author Chengwen Liu
+@date 10/2026
+"""
+import os
+import time
+import socket
+import threading
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from forcebalance import jobpool
+from forcebalance.nifty import getWorkQueue, getWQIds, queue_up_src_dest
+from forcebalance.output import getLogger
+logger = getLogger(__name__)
+
+_executors = {}
+
+def get_executor(name=None, workers=0, tinkerpath=None):
+    """
+    Return the executor of a backend, creating it on first use.
+
+    @param[in] name "jobpool" (default), "local" or "workqueue"
+    @param[in] workers Number of processes of the local backend (0: number of cores)
+    @param[in] tinkerpath Directory of submitTinker.py for the jobpool backend (default: $TINKERPATH)
+    """
+    name = (name or "jobpool").lower()
+    key = (name, workers, tinkerpath)
+    if key not in _executors:
+        if name == "jobpool":
+            _executors[key] = JobPoolExecutor(tinkerpath)
+        elif name == "local":
+            _executors[key] = LocalExecutor(workers)
+        elif name == "workqueue":
+            _executors[key] = WorkQueueExecutor()
+        else:
+            logger.error("Unknown executor %s (choose jobpool, local or workqueue)\n" % name)
+            raise RuntimeError
+    return _executors[key]
+
+def _run_script(script):
+    """ Run a job script in its directory; executed in a process of the local pool. """
+    return subprocess.call(["bash", os.path.basename(script)], cwd=os.path.dirname(script),
+                           stdin=subprocess.DEVNULL)
+
+def _files(spec, script):
+    """ Files of one script in the inputs or outputs argument of submit(). """
+    if isinstance(spec, dict):
+        return spec.get(script, [])
+    return list(spec)
+
+class Executor(object):
+    """ Common part of the backends; a job is identified by the absolute path of its script. """
+
+    def submit(self, scripts, jobtype="CPU", ncpu=None, priority=jobpool.PRIORITY_ANALYZE, batch=False, inputs=(), outputs=()):
+        """
+        Start job scripts written by jobpool.write_job_script().
+
+        @param[in] scripts List of job scripts, relative to the current directory
+        @param[in] jobtype "CPU" or "GPU"
+        @param[in] ncpu Number of cores per job (jobpool backend)
+        @param[in] priority Jobs with higher priority are started first (jobpool backend)
+        @param[in] batch Pack many small jobs on the nodes (submitTinker.py -b)
+        @param[in] inputs Files read by the scripts, relative to the current directory (workqueue backend);
+                   a list for all scripts, or a dictionary of lists keyed by script
+        @param[in] outputs Files written by the scripts, as inputs (workqueue backend)
+        @return List of the absolute paths of the scripts, to be passed to the other methods
+        """
+        raise NotImplementedError
+
+    def status(self, script):
+        """ Return the status record of a finished job script, or None if it has not finished. """
+        return jobpool.job_status(script)
+
+    def wait_all(self, scripts, poll=2.0, timeout=None, callback=None):
+        """ Block until all job scripts have finished; see jobpool.wait_for_jobs(). """
+        return jobpool.wait_for_jobs(scripts, poll=poll, timeout=timeout, callback=callback, status=self.status)
+
+    def wait_any(self, scripts, poll=2.0, timeout=None, callback=None):
+        """ Block until one of the job scripts has finished and return it. """
+        start = time.time()
+        while True:
+            for script in scripts:
+                status = self.status(script)
+                if status is None:
+                    continue
+                if status["exit"] != 0:
+                    logger.error("Job %s exited with code %i on %s after %i s\n" % (script, status["exit"], status["host"], status["wall"]))
+                    raise RuntimeError("Job %s failed" % script)
+                return script
+            if callback is not None:
+                callback()
+            if timeout is not None and time.time() - start > timeout:
+                logger.error("None of the jobs %s finished after %i s\n" % (' '.join(scripts), timeout))
+                raise RuntimeError("Timeout waiting for jobs")
+            time.sleep(poll)
+
+    def cancel(self, scripts):
+        """ Drop the job scripts that have not started yet. """
+        pass
+
+class JobPoolExecutor(Executor):
+    """ Submit the scripts to the job pool with submitTinker.py. """
+
+    def __init__(self, tinkerpath=None):
+        self.tinkerpath = tinkerpath
+        self.job_ids = {}
+
+    def submit(self, scripts, jobtype="CPU", ncpu=None, priority=jobpool.PRIORITY_ANALYZE, batch=False, inputs=(), outputs=()):
+        scripts = [os.path.abspath(script) for script in scripts]
+        if not scripts:
+            return scripts
+        tinkerpath = self.tinkerpath or os.environ["TINKERPATH"]
+        workdir = os.getcwd()
+        shstr = f"python {tinkerpath}/submitTinker.py -x {' '.join([os.path.relpath(script) for script in scripts])} -t {jobtype}"
+        if ncpu is not None:
+            shstr += f" -n {ncpu}"
+        if batch:
+            shstr += " -b"
+        shstr += f" -p {workdir}"
+        job_id = jobpool.submit(shstr, jobtype, workdir=workdir, priority=priority)
+        for script in scripts:
+            self.job_ids[script] = job_id
+        return scripts
+
+    def cancel(self, scripts):
+        # All scripts of one submitTinker.py call are dropped together.
+        for job_id in set([self.job_ids.pop(os.path.abspath(script), None) for script in scripts]):
+            jobpool.cancel(job_id)
+
+class LocalExecutor(Executor):
+    """ Run the scripts in a pool of processes on this machine. """
+
+    def __init__(self, workers=0):
+        self.workers = workers or os.cpu_count()
+        self.pool = None
+        self.futures = {}
+        # npt.py submits from the liquid and the gas phase at the same time.
+        self.lock = threading.Lock()
+
+    def submit(self, scripts, jobtype="CPU", ncpu=None, priority=jobpool.PRIORITY_ANALYZE, batch=False, inputs=(), outputs=()):
+        scripts = [os.path.abspath(script) for script in scripts]
+        with self.lock:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(max_workers=self.workers)
+            for script in scripts:
+                self.futures[script] = self.pool.submit(_run_script, script)
+        return scripts
+
+    def status(self, script):
+        status = jobpool.job_status(script)
+        future = self.futures.get(os.path.abspath(script))
+        if status is None and future is not None and future.done():
+            # The script may have finished since the status file was read.
+            status = jobpool.job_status(script)
+            if status is None:
+                # The script died before writing its status file.
+                code = 1 if future.cancelled() or future.exception() is not None else (future.result() or 1)
+                status = {"exit": code, "wall": 0, "host": socket.gethostname().split('.')[0]}
+        return status
+
+    def cancel(self, scripts):
+        for script in scripts:
+            future = self.futures.pop(os.path.abspath(script), None)
+            if future is not None:
+                future.cancel()
+
+class WorkQueueExecutor(Executor):
+    """ Send the scripts with their input files to the Work Queue workers. """
+
+    def __init__(self):
+        self.tags = set()
+        self.failed = {}
+
+    def queue(self):
+        wq = getWorkQueue()
+        if wq is None:
+            logger.error("The workqueue executor needs a Work Queue; set wq_port in the $options section\n")
+            raise RuntimeError
+        return wq
+
+    def submit(self, scripts, jobtype="CPU", ncpu=None, priority=jobpool.PRIORITY_ANALYZE, batch=False, inputs=(), outputs=()):
+        wq = self.queue()
+        workdir = os.getcwd()
+        for script in scripts:
+            name = os.path.basename(script)
+            status = os.path.basename(jobpool.status_file(script))
+            queue_up_src_dest(wq, command=f"sh {name}",
+                              input_files=[(os.path.abspath(script), name)] + [(os.path.join(workdir, f), f) for f in _files(inputs, script)],
+                              output_files=[(os.path.abspath(jobpool.status_file(script)), status)] + [(os.path.join(workdir, f), f) for f in _files(outputs, script)],
+                              tag=os.path.abspath(script))
+            self.tags.add(os.path.abspath(script))
+        return [os.path.abspath(script) for script in scripts]
+
+    def status(self, script):
+        # Collect the finished tasks; their output files are written back on collection.
+        wq = self.queue()
+        task = wq.wait(0)
+        while task:
+            if task.tag not in self.tags:
+                self.hand_back(wq, task)
+            elif task.result != 0 or task.return_status != 0:
+                self.failed[task.tag] = {"exit": task.return_status or 1, "wall": int(task.cmd_execution_time/1000000), "host": task.hostname}
+            task = wq.wait(0)
+        return jobpool.job_status(script) or self.failed.get(os.path.abspath(script))
+
+    def hand_back(self, wq, task):
+        """
+        Finish a task that was queued outside of this executor (e.g. a Liquid
+        simulation) as nifty.wq_wait1 would: drop it from the task list of its
+        target, and resubmit it if it failed.
+        """
+        WQIds = getWQIds()
+        tgtname = "None"
+        for tnm in WQIds:
+            if task.id in WQIds[tnm]:
+                tgtname = tnm
+                WQIds[tnm].remove(task.id)
+        if task.result != 0:
+            oldid = task.id
+            taskid = wq.submit(task)
+            logger.warning("Task '%s' (task %i) failed on host %s, resubmitted: taskid %i\n" % (task.tag, oldid, task.hostname, taskid))
+            WQIds[tgtname].append(taskid)
+
+    def cancel(self, scripts):
+        wq = self.queue()
+        for script in scripts:
+            wq.cancel_by_tasktag(os.path.abspath(script))
@@ -0,0 +1,189 @@
+""" @package forcebalance.jobpool Submission of jobs to the Ren lab job pool.
+
+The job pool lives in the directory $JOBPOOL (see JobPool/README.md). Jobs are
+queued by dropping a <host>-<time>.sh file into the pool directory, whose first
+line holds the job type and priority. The pool daemon moves it into its job
+queue, which only the daemon opens, since the queue database cannot be shared
+over NFS. Older pools without a job queue run the file as it is.
+
+Job scripts written by write_job_script() signal their completion: when the
+commands are done, they atomically create a status file next to the script
+(liquid-md.sh -> liquid-md.status), holding the exit code, the wall time and the host. wait_for_jobs()
+blocks on these files instead of parsing the job outputs.
+
+Programs that run next to ForceBalance (npt.py) are started as one batch with
+launch(). Each signals that it has read its input with signal_started(), and
+wait_for_start() waits for these handshakes instead of sleeping.
+
+@author Chengwen Liu
+@date 10/2026
+"""
+import os
+import shlex
+import time
+import json
+import socket
+import subprocess
+from forcebalance.output import getLogger
+logger = getLogger(__name__)
+
+## Long GPU dynamics go ahead of the many short analyze jobs of an iteration.
+PRIORITY_DYNAMIC = 10
+PRIORITY_ANALYZE = 0
+
+def submit(command, jobtype, workdir=None, priority=PRIORITY_ANALYZE):
+    """
+    Queue a shell command in the job pool.
+
+    @param[in] command Shell command, usually a call to submitTinker.py
+    @param[in] jobtype "CPU" or "GPU"
+    @param[in] workdir Directory the command is run in, defaults to the current directory
+    @param[in] priority Jobs with higher priority are started first
+    @return Job file in the pool directory, to be passed to cancel()
+    """
+    workdir = workdir or os.getcwd()
+    hoststr = socket.gethostname().split('.')[0]
+    timestr = str(time.time()).replace('.', '')
+    scriptfile = os.path.join(os.environ["JOBPOOL"], f"{hoststr}-{timestr}.sh")
+    tmpfile = os.path.join(os.environ["JOBPOOL"], f".{hoststr}-{timestr}.sh.tmp")
+    # there is a script responsible for submitting these jobs;
+    # it must not see the file before it is complete
+    with open(tmpfile, 'w') as f:
+        f.write(f"#jobpool {jobtype} {int(priority)}\ncd {shlex.quote(workdir)}\n{command}\n")
+    os.rename(tmpfile, scriptfile)
+    return scriptfile
+
+def cancel(job_id):
+    """ Remove a job file that the pool daemon has not taken yet; return whether it was removed. """
+    if job_id is None:
+        return False
+    try:
+        os.remove(job_id)
+    except OSError:
+        return False
+    return True
+
+def status_file(script):
+    """ Name of the status file written by a job script when it finishes. """
+    return os.path.splitext(script)[0] + ".status"
+
+def write_job_script(script, commands):
+    """
+    Write a job script that runs commands in the ForceBalance environment
+    and records its completion in status_file(script).
+
+    @param[in] script Name of the script, relative to the working directory of the job
+    @param[in] commands List of shell commands
+    """
+    status = os.path.basename(status_file(script))
+    content = f"source {os.environ['FBBASHRC']}\n"
+    content += "_jobstart=$(date +%s)\n"
+    for command in commands:
+        content += f"{command}\n"
+    content += "_jobexit=$?\n"
+    content += f"printf '{{\"exit\": %d, \"wall\": %d, \"host\": \"%s\"}}\\n' $_jobexit $(( $(date +%s) - _jobstart )) \"$(hostname -s)\" > .{status}.tmp\n"
+    content += f"mv -f .{status}.tmp {status}\n"
+    # A status file left by a different job under the same name is not ours.
+    if os.path.exists(script) and open(script).read() != content and os.path.exists(status_file(script)):
+        os.remove(status_file(script))
+    with open(script, 'w') as f:
+        f.write(content)
+
+def clear_status(scripts):
+    """ Remove the status files of job scripts that are run again with the same content. """
+    for script in scripts:
+        if os.path.exists(status_file(script)):
+            os.remove(status_file(script))
+
+def job_status(script):
+    """ Return the status record of a finished job script, or None if it has not finished. """
+    try:
+        with open(status_file(script)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+def wait_for_jobs(scripts, poll=2.0, timeout=None, callback=None, status=None):
+    """
+    Block until all job scripts have finished.
+
+    Each check only looks for the status files, so its cost does not depend on
+    the size of the job outputs.
+
+    @param[in] scripts List of job scripts written by write_job_script()
+    @param[in] poll Seconds between checks
+    @param[in] timeout Give up after this many seconds
+    @param[in] callback Called with no arguments after each check, e.g. to follow the progress of the jobs
+    @param[in] status Function returning the status record of a script, defaults to job_status()
+    @return Dictionary of status records keyed by script
+    """
+    status_of = status or job_status
+    start = time.time()
+    pending = list(scripts)
+    finished = {}
+    while True:
+        for script in pending:
+            status = status_of(script)
+            if status is None:
+                continue
+            finished[script] = status
+            if status["exit"] != 0:
+                logger.error("Job %s exited with code %i on %s after %i s\n" % (script, status["exit"], status["host"], status["wall"]))
+                raise RuntimeError("Job %s failed" % script)
+        pending = [script for script in pending if script not in finished]
+        if callback is not None:
+            callback()
+        if not pending:
+            return finished
+        if timeout is not None and time.time() - start > timeout:
+            logger.error("Jobs %s not finished after %i s\n" % (' '.join(pending), timeout))
+            raise RuntimeError("Timeout waiting for jobs")
+        time.sleep(poll)
+
+def launch(jobs):
+    """
+    Start a batch of commands in the background, detached from ForceBalance
+    like "nohup ... &", each in the ForceBalance environment.
+
+    @param[in] jobs List of (working directory, shell command, output file)
+    @return List of process handles, to be passed to wait_for_start()
+    """
+    procs = []
+    for workdir, command, outfile in jobs:
+        with open(os.path.join(workdir, outfile), 'w') as out:
+            procs.append(subprocess.Popen(["bash", "-c", f"source {os.environ['FBBASHRC']}; {command}"], cwd=workdir,
+                                          stdin=subprocess.DEVNULL, stdout=out, stderr=subprocess.STDOUT,
+                                          start_new_session=True))
+        logger.info("Running %s in %s\n" % (command, workdir))
+    return procs
+
+def signal_started(fnm):
+    """ Called by a launched program once it has read its input, to signal wait_for_start() that it is running. """
+    with open(f".{fnm}.tmp", 'w') as f:
+        json.dump({"pid": os.getpid(), "host": socket.gethostname().split('.')[0]}, f)
+    os.replace(f".{fnm}.tmp", fnm)
+
+def wait_for_start(procs, handshakes, poll=0.5, timeout=600):
+    """
+    Block until each process launched by launch() has signaled that it is running.
+
+    @param[in] procs Process handles returned by launch()
+    @param[in] handshakes Files written by signal_started(), one per process
+    @param[in] poll Seconds between checks
+    @param[in] timeout Give up after this many seconds
+    """
+    start = time.time()
+    pending = list(zip(procs, handshakes))
+    while pending:
+        for proc, handshake in pending:
+            # A program that finishes quickly may be gone before we look.
+            if not os.path.exists(handshake) and proc.poll() not in (None, 0):
+                logger.error("%s exited with code %i before starting\n" % (' '.join(proc.args), proc.returncode))
+                raise RuntimeError("Launched job failed")
+        pending = [(proc, handshake) for proc, handshake in pending if not os.path.exists(handshake) and proc.poll() is None]
+        if not pending:
+            return
+        if time.time() - start > timeout:
+            logger.error("No handshake from %s after %i s\n" % (' '.join([handshake for proc, handshake in pending]), timeout))
+            raise RuntimeError("Timeout waiting for jobs to start")
+        time.sleep(poll)
@@ -16,6 +16,8 @@ from forcebalance.finite_difference import *
 from forcebalance.nifty import *
 from forcebalance.nifty import _exec
 from forcebalance.target import Target
+from forcebalance import jobpool
+from forcebalance.evalcache import digest
 import numpy as np
 from forcebalance.molecule import Molecule
 from re import match, sub
@@ -83,6 +85,38 @@ def weight_info(W, PT, N_k, verbose=True, PTS=None):
         logger.info("InfoContent: % .2f snapshots (%.2f %%)\n" % (I, 100*I/len(W)))
     return C
 
+def reduced_potentials(E, V, rows, PTS, pvkj=0.0):
+    """
+    Reduced potentials u_kln of MBAR, from the energies (and volumes) of the simulations.
+
+    @param[in] E Energies (kJ/mol), one row of snapshots per simulation
+    @param[in] V Volumes (nm^3), as E, or None for the gas phase
+    @param[in] rows Row of E and V holding each simulation in PTS
+    @param[in] PTS Phase points (temperature, pressure, unit) of the simulations
+    @param[in] pvkj Conversion of atm * nm^3 into kJ/mol
+    @return U_kln Energy of snapshot n from simulation k at the conditions of simulation l, in kT
+    """
+    beta = np.array([1. / (kb * PT[0]) for PT in PTS])
+    # The correct Boltzmann factors include PV, with the pressure of simulation l.
+    U_kln = E[rows][:, np.newaxis, :]
+    if V is not None:
+        P = np.array([PT[1] / 1.01325 if PT[2] == 'bar' else PT[1] for PT in PTS])
+        U_kln = U_kln + P[np.newaxis, :, np.newaxis] * V[rows][:, np.newaxis, :] * pvkj
+    return U_kln * beta[np.newaxis, :, np.newaxis]
+
+def fill_weights(weights, phase_points, mbar_points, snapshots):
+    """ Fill in the weight matrix with MBAR weights where MBAR was run,
+    and equal weights otherwise. """
+    K = len(phase_points)
+    new_weights = np.zeros([K, snapshots, K])
+    if len(mbar_points) > 0:
+        rows = np.array([phase_points.index(PT) for PT in mbar_points])
+        new_weights[np.ix_(rows, np.arange(snapshots), rows)] = weights.reshape(len(mbar_points), snapshots, len(mbar_points))
+    for m, PT in enumerate(phase_points):
+        if PT not in mbar_points:
+            new_weights[m, :, m] = 1.0/snapshots
+    return new_weights.reshape(K*snapshots, K)
+
 # NPT_Trajectory = namedtuple('NPT_Trajectory', ['fnm', 'Rhos', 'pVs', 'Energies', 'Grads', 'mEnergies', 'mGrads', 'Rho_errs', 'Hvap_errs'])
 
 class Liquid(Target):
@@ -136,6 +170,12 @@ class Liquid(Target):
         self.set_option(tgt_opts,'adapt_errors',forceprint=True)
         # Minimize the energy prior to running any dynamics
         self.set_option(tgt_opts,'minimize_energy',forceprint=True)
+        # Finite-difference scheme for the energy derivatives (TINKER)
+        self.set_option(tgt_opts,'fd_scheme',forceprint=True)
+        self.set_option(tgt_opts,'fd_forward_iters')
+        # Backend running the simulations and the jobs of npt.py
+        self.set_option(tgt_opts,'executor',default='jobpool',forceprint=True)
+        self.set_option(tgt_opts,'executor_workers')
         # Isolated dipole (debye) for analytic self-polarization correction.
         self.set_option(tgt_opts,'self_pol_mu0',forceprint=True)
         # Molecular polarizability (ang**3) for analytic self-polarization correction.
@@ -228,6 +268,38 @@ class Liquid(Target):
         ## Saved results for all iterations
         # self.SavedMVals = []
         self.AllResults = defaultdict(lambda:defaultdict(list))
+        ## MBAR weights keyed on the reduced potentials, and the last free energies of each set of states
+        self.MBarWeights = OrderedDict()
+        self.MBarFreeEnergies = {}
+
+    def mbar_weights(self, U_kln, N_k, states, **kwargs):
+        """
+        Run MBAR and return the weights of the snapshots at each state.
+
+        The weights are cached on the reduced potentials, so that evaluating
+        the same simulation data again (e.g. in a line search) does not repeat
+        the solve. Otherwise the solve starts from the free energies found
+        last time for the same states.
+
+        @param[in] U_kln Reduced potentials, see reduced_potentials()
+        @param[in] N_k Number of snapshots of each simulation
+        @param[in] states Label of the set of states, e.g. the phase points
+        @return Weights, N x K array
+        """
+        key = digest(str(states), U_kln.tobytes(), N_k.tobytes())
+        if key in self.MBarWeights:
+            self.MBarWeights.move_to_end(key)
+            return self.MBarWeights[key]
+        f_k = self.MBarFreeEnergies.get(str(states))
+        if f_k is not None and len(f_k) == len(N_k):
+            kwargs['initial_f_k'] = f_k
+        mbar = pymbar.MBAR(U_kln, N_k, **kwargs)
+        W = mbar.getWeights()
+        self.MBarFreeEnergies[str(states)] = np.array(mbar.f_k)
+        self.MBarWeights[key] = W
+        while len(self.MBarWeights) > 8:
+            self.MBarWeights.popitem(last=False)
+        return W
 
     def post_init(self, options):
         # Prepare the temporary directory.
@@ -395,16 +467,30 @@ class Liquid(Target):
 # Feb 2022
 ##==============================================================================================================
     def npt_simulation(self, temperature, pressure, simnum):
+        """ Stage a NPT simulation in the current directory; return the job to launch, or None if it has finished. """
         link_dir_contents(os.path.join(self.root, self.rundir), os.getcwd())
         self.last_traj += [os.path.join(os.getcwd(), i) for i in self.extra_output]
         self.liquid_mol[simnum%len(self.liquid_mol)].write(self.liquid_coords, ftype='tinker' if self.engname == 'tinker' else None)
-        fbbashrc = os.environ["FBBASHRC"]
-        if not os.path.isfile('npt_result.p'):
-          cmdstr = f'source {fbbashrc}; cd %s; nohup %s python -u npt.py %s %.3f %.3f > npt.out 2>&1 &' % (os.getcwd(), self.nptpfx, self.engname, temperature, pressure)
-          os.system(cmdstr)
-          logger.info(f"Running {cmdstr}.\n")
-          # this is to let the job appear on a node
-          time.sleep(30.0)
+        if os.path.isfile('npt_result.p'):
+          return None
+        cmdstr = '%s python -u npt.py %s %.3f %.3f' % (self.nptpfx, self.engname, temperature, pressure)
+        if self.executor.lower() == 'workqueue':
+          # The whole simulation runs on a Work Queue worker, and Objective waits for the queue.
+          if hasattr(self, 'mol2'):
+            if hasattr(self, 'FF'):
+              mol2_send = list(set(self.mol2).difference(set(self.FF.fnms)))
+            else:
+              mol2_send = self.mol2
+          else:
+            mol2_send = []
+          queue_up(getWorkQueue(), command = cmdstr+' > npt.out 2>&1 ',
+                   input_files = self.nptfiles + self.scripts + mol2_send + ['forcebalance.p'],
+                   output_files = ['npt_result.p', 'npt.out'] + self.extra_output, tgt=self)
+          return None
+        # npt.py writes npt.started when it has read forcebalance.p
+        if os.path.exists('npt.started'):
+          os.remove('npt.started')
+        return (os.getcwd(), cmdstr, 'npt.out')
 
     def nvt_simulation(self, temperature):
         """ Submit a NVT simulation to the Work Queue. """
@@ -563,6 +649,8 @@ class Liquid(Target):
         if 'surf_ten' in self.RefData:
             logger.info("Launching additional NVT simulations for computing surface tension. Time steps: %i (eq) + %i (md)\n" % (self.nvt_eq_steps, self.nvt_md_steps))
 
+        # The adaptive finite-difference scheme depends on the optimizer iteration.
+        self.OptionDict['iteration'] = Counter()
         if AGrad and self.pure_num_grad:
             lp_dump((self.FF,mvals,self.OptionDict,False),'forcebalance.p')
         else:
@@ -579,8 +667,9 @@ class Liquid(Target):
                     os.remove(fn)
         self.last_traj = []
 
-        # submit jobs using the external API
-        def submit_one_setm():
+        # Stage all simulations first, then launch them as one batch.
+        jobs = []
+        def stage_one_setm():
             snum = 0
             for label, pt in zip(self.Labels, self.PhasePoints):
                 T = pt[0]
@@ -591,17 +680,16 @@ class Liquid(Target):
                 if not os.path.exists(label):
                     os.makedirs(label)
                 os.chdir(label)
-                self.npt_simulation(T,P,snum)
+                job = self.npt_simulation(T,P,snum)
+                if job is not None:
+                    jobs.append(job)
                 if 'surf_ten' in self.RefData and pt in self.RefData['surf_ten']:
                     self.nvt_simulation(T)
                 os.chdir('..')
                 snum += 1
-            
-            # wait for the directory to be created
-            time.sleep(30.0)
 
-        # Set up and run the simulations.
-        submit_one_setm()
+        # Set up the simulations.
+        stage_one_setm()
         # if pure_num_grad is set, submit additional simulations with AGrad=False
         if AGrad and self.pure_num_grad:
             logger.info("Running in Pure Numerical Gradient Mode! Two additional simulation will be submitted for each parameter.\n")
@@ -622,12 +710,30 @@ class Liquid(Target):
                     rundir_backup = self.rundir
                     # change the self.rundir temporarily so the new forcebalance.p will be used by npt_simulation() and nvt_simulation()
                     self.rundir = os.getcwd()
-                    # submit simulations
-                    submit_one_setm()
+                    # stage simulations
+                    stage_one_setm()
                     # change the self.rundir back
                     self.rundir = rundir_backup
                     os.chdir('..')
 
+        # Launch all simulations at once and wait until each has read its input.
+        self.npt_procs = []
+        if jobs:
+            procs = jobpool.launch(jobs)
+            jobpool.wait_for_start(procs, [os.path.join(workdir, 'npt.started') for workdir, cmdstr, outfile in jobs])
+            logger.info("%i simulations started\n" % len(jobs))
+            self.npt_procs = [(proc, os.path.join(workdir, 'npt_result.p')) for proc, (workdir, cmdstr, outfile) in zip(procs, jobs)]
+
+    def wait_jobs(self):
+        """
+        Block until the simulations launched by submit_jobs() have exited; called in a
+        separate thread by Objective.Target_Terms in asynchronous mode.
+        Simulations on the Work Queue are waited for by wq_complete() instead.
+        """
+        for proc, result in getattr(self, 'npt_procs', []):
+            proc.wait()
+            if not os.path.exists(result):
+                logger.warning("%s exited with code %i without writing %s\n" % (' '.join(proc.args), proc.returncode, result))
 
     def read(self, mvals, AGrad=True, AHess=True):
 
@@ -764,15 +870,18 @@ class Liquid(Target):
         mPoints = [] # These are the phase points to use for enthalpy of vaporization; if we're scanning pressure then set hvap_wt for higher pressures to zero.
         stResults = {} # Storing the results from the NVT run for surface tension
         tt = 0
+        # The simulations have exited once wait_jobs() (or wq_complete() on the Work Queue) returns,
+        # so their results are read directly; this returns at once if the jobs were already waited for.
+        self.wait_jobs()
         for label, PT in zip(self.Labels, self.PhasePoints):
             #modified by Chengwen Liu
-            while not os.path.exists('./%s/npt_result.p' % label):
-                time.sleep(30.0)
+            if not os.path.exists('./%s/npt_result.p' % label):
+                logger.error('The simulation in ./%s has finished without writing npt_result.p; see ./%s/npt.out\n' % (label, label))
+                raise RuntimeError('Missing npt_result.p in ./%s' % label)
 
             if os.path.exists('./%s/npt_result.p' % label):
                 os.system('echo > ./%s/liquid-md.arc' % label)
                 os.system('echo > ./%s/gas-md.arc' % label)
-                time.sleep(30.0)
                 logger.info('Reading information from ./%s/npt_result.p\n' % label)
                 Points.append(PT)
                 Results[tt] = lp_load('./%s/npt_result.p' % label)
@@ -906,45 +1015,17 @@ class Liquid(Target):
         BSims = len(BPoints)
         Shots = len(E[0])
         N_k = np.ones(BSims, dtype=int)*Shots
-        # Use the value of the energy for snapshot t from simulation k at potential m
-        U_kln = np.zeros([BSims,BSims,Shots])
-        for m, PT in enumerate(BPoints):
-            T = PT[0]
-            P = PT[1] / 1.01325 if PT[2] == 'bar' else PT[1]
-            beta = 1. / (kb * T)
-            for k in range(BSims):
-                # The correct Boltzmann factors include PV.
-                # Note that because the Boltzmann factors are computed from the conditions at simulation "m",
-                # the pV terms must be rescaled to the pressure at simulation "m".
-                kk = Points.index(BPoints[k])
-                U_kln[k, m, :]   = E[kk] + P*V[kk]*pvkj
-                U_kln[k, m, :]  *= beta
         W1 = None
         if len(BPoints) > 1:
+            # Use the value of the energy for snapshot t from simulation k at potential m
+            U_kln = reduced_potentials(E, V, [Points.index(PT) for PT in BPoints], BPoints, pvkj)
             logger.info("Running MBAR analysis on %i states...\n" % len(BPoints))
-            mbar = pymbar.MBAR(U_kln, N_k, verbose=mbar_verbose, relative_tolerance=5.0e-8)
-            W1 = mbar.getWeights()
+            W1 = self.mbar_weights(U_kln, N_k, BPoints, verbose=mbar_verbose, relative_tolerance=5.0e-8)
             logger.info("Done\n")
         elif len(BPoints) == 1:
             W1 = np.ones((Shots,1))
             W1 /= Shots
 
-        def fill_weights(weights, phase_points, mbar_points, snapshots):
-            """ Fill in the weight matrix with MBAR weights where MBAR was run,
-            and equal weights otherwise. """
-            new_weights = np.zeros([len(phase_points)*snapshots,len(phase_points)])
-            for m, PT in enumerate(phase_points):
-                if PT in mbar_points:
-                    mm = mbar_points.index(PT)
-                    for kk, PT1 in enumerate(mbar_points):
-                        k = phase_points.index(PT1)
-                        logger.debug("Will fill W2[%i:%i,%i] with W1[%i:%i,%i]\n" % (k*snapshots,k*snapshots+snapshots,m,kk*snapshots,kk*snapshots+snapshots,mm))
-                        new_weights[k*snapshots:(k+1)*snapshots,m] = weights[kk*snapshots:(kk+1)*snapshots,mm]
-                else:
-                    logger.debug("Will fill W2[%i:%i,%i] with equal weights\n" % (m*snapshots,(m+1)*snapshots,m))
-                    new_weights[m*snapshots:(m+1)*snapshots,m] = 1.0/snapshots
-            return new_weights
-
         W2 = fill_weights(W1, Points, BPoints, Shots)
 
         if len(mPoints) > 0:
@@ -954,17 +1035,10 @@ class Liquid(Target):
             if len(mBPoints) > 1:
                 mBSims = len(mBPoints)
                 mN_k = np.ones(mBSims, dtype=int)*mShots
-                mU_kln = np.zeros([mBSims,mBSims,mShots])
-                for m, PT in enumerate(mBPoints):
-                    T = PT[0]
-                    beta = 1. / (kb * T)
-                    for k in range(mBSims):
-                        mE_idx = mE_idx_dict[mBPoints[k]]
-                        mU_kln[k, m, :]  = mE[mE_idx]
-                        mU_kln[k, m, :] *= beta
+                mU_kln = reduced_potentials(mE, None, [mE_idx_dict[PT] for PT in mBPoints], mBPoints)
                 if np.abs(np.std(mE)) > 1e-6 and mBSims > 1:
-                    mmbar = pymbar.MBAR(mU_kln, mN_k, verbose=False, relative_tolerance=5.0e-8, method='self-consistent-iteration')
-                    mW1 = mmbar.getWeights()
+                    mW1 = self.mbar_weights(mU_kln, mN_k, ('gas', mBPoints), verbose=False, relative_tolerance=5.0e-8,
+                                            method='self-consistent-iteration')
             elif len(mBPoints) == 1:
                 mW1 = np.ones((mShots,1))
                 mW1 /= mShots
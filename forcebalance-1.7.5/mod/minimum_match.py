@@ -15,6 +15,9 @@ from forcebalance.nifty import col, eqcgmx, flat, floatornan, fqcgmx, invert_svd
 from forcebalance.target import Target
 from re import match, sub
 from forcebalance.finite_difference import fdwrap, f1d2p, f12d3p, in_fd
+from forcebalance.evalcache import EvalCache, digest
+from forcebalance import jobpool
+from forcebalance.executors import get_executor
 from collections import OrderedDict
 import sys
 from forcebalance.output import getLogger
@@ -30,6 +33,9 @@ class MinimumMatch(Target):
     self.set_option(None, None, 'energyscale', val=tgt_opts['energyscale'])
     self.set_option(None, None, 'bondscale', val=tgt_opts['bondscale'])
     self.set_option(None, None, 'anglescale', val=tgt_opts['anglescale'])
+    # backend running the minimize and analyze jobs
+    self.set_option(tgt_opts, 'executor', default='local')
+    self.set_option(tgt_opts, 'executor_workers')
 
     self.energyfile = os.path.join(self.tgtdir,"energy.txt")
     self.geometryfile = os.path.join(self.tgtdir,"geometry.txt")
@@ -151,22 +157,25 @@ class MinimumMatch(Target):
       cpstr = f'cp {os.path.join(self.root, self.tgtdir, dimer)} .'
       os.system(cpstr)
       
-    with open('run_opt.sh', 'w') as f:
-      for dimer in self.dimers:
-        thr = self.minthr.get(dimer, 0.01)
-        f.write(f'minimize {dimer} -k interactions.key {thr} > {dimer.replace("xyz", "out")}\n')
-      f.write('wait\n')
-   
-    with open('run_split.sh', 'w') as f:
-      for dimer in self.dimers:
-        f.write(f'lChemFileEditor.py -i {dimer} -m split\n')
-
-    with open('run_ana.sh', 'w') as f:
-      for mono in self.monomers:
-        f.write(f'analyze {mono} -k interactions.key E > {mono.replace("xyz", "log")}\n')
-      for dimer in self.dimers:
-        f.write(f'analyze {dimer} -k interactions.key E > {dimer.replace("xyz", "log")}\n')
-      f.write('wait\n')
+    # one job per dimer: minimize, split into the monomers, and analyze all three
+    shfiles = []
+    jobinputs = {}
+    joboutputs = {}
+    for dimer in self.dimers:
+      thr = self.minthr.get(dimer, 0.01)
+      mono1 = dimer.replace('.xyz', '_m01.xyz')
+      mono2 = dimer.replace('.xyz', '_m02.xyz')
+      shfile = dimer.replace('.xyz', '.sh')
+      jobpool.write_job_script(shfile, [f'minimize {dimer} -k interactions.key {thr} > {dimer.replace("xyz", "out")}',
+                                        f'mv -f {dimer}_2 {dimer}',
+                                        f'lChemFileEditor.py -i {dimer} -m split >/dev/null',
+                                        f'analyze {mono1} -k interactions.key E > {mono1.replace("xyz", "log")}',
+                                        f'analyze {mono2} -k interactions.key E > {mono2.replace("xyz", "log")}',
+                                        f'analyze {dimer} -k interactions.key E > {dimer.replace("xyz", "log")}'])
+      shfiles.append(shfile)
+      jobinputs[shfile] = self.FF.fnms + ['interactions.key', dimer]
+      joboutputs[shfile] = [dimer, mono1, mono2] + [f.replace("xyz", "log") for f in [mono1, mono2, dimer]]
+    executor = get_executor(self.executor, self.executor_workers)
    
     def CalculateBondAngle(txyz, bnd_idx, ang_idx):
       atom2coords = {}
@@ -194,6 +203,7 @@ class MinimumMatch(Target):
       
       return bond_length, angle_degree
     
+    cache = EvalCache()
     def callM(mvals_):
       logger.info("\r")
       MMs = []
@@ -201,10 +211,19 @@ class MinimumMatch(Target):
       bnds = []
       angs = []
       pvals = self.FF.make(mvals_)
-      os.system('sh run_opt.sh')
-      os.system('rename xyz_2 xyz *')
-      os.system('sh run_split.sh >/dev/null')
-      os.system('sh run_ana.sh')
+      # The result depends on the parameters, the scripts and the starting structures,
+      # which are replaced by the minimized ones below.
+      inputs = self.FF.fnms + ['interactions.key'] + shfiles + self.dimers
+      cachekey = digest(*[open(f, 'rb').read() for f in inputs])
+      cached = cache.get(cachekey)
+      if cached is not None:
+        for i, dimer in enumerate(self.dimers):
+          with open(dimer, 'wb') as f:
+            f.write(cached["dimer%i" % i].tobytes())
+        return cached["MMs"]
+      jobpool.clear_status(shfiles)
+      executor.submit(shfiles, "CPU", ncpu=1, batch=True, inputs=jobinputs, outputs=joboutputs)
+      executor.wait_all(shfiles, poll=0.2)
       
       for i in range(len(self.dimers)):
         dimer = self.dimers[i]
@@ -238,6 +257,10 @@ class MinimumMatch(Target):
         angs.append(ang)
       
       MMs = np.array([x*self.energyscale for x in emms] + [x*self.bondscale for x in bnds] + [x*self.anglescale for x in angs])
+      result = {"MMs": MMs}
+      for i, dimer in enumerate(self.dimers):
+        result["dimer%i" % i] = np.frombuffer(open(dimer, 'rb').read(), dtype=np.uint8)
+      cache.put(cachekey, result)
       return MMs 
     
     logger.info("Executing\r")
@@ -11,6 +11,7 @@ import sys
 import sysconfig
 import json
 from collections import OrderedDict, namedtuple, Counter
+from collections.abc import MutableSequence
 from ctypes import *
 from datetime import date
 from warnings import warn
@@ -655,6 +656,72 @@ class MolfileTimestep(Structure):
                 ("A",c_float), ("B",c_float), ("C",c_float), ("alpha",c_float),
                 ("beta",c_float), ("gamma",c_float), ("physical_time",c_double)]
 
+class ArcFrames(MutableSequence):
+    """ List of coordinate frames backed by a (n_frames, n_atoms, 3) array, usually a memory map.
+
+    Frames are copied out of the array when first accessed and kept, so that
+    in-place changes to a frame persist as they do for a list of arrays.
+    Operations that change the number of frames first load all of them.
+    """
+    def __init__(self, data):
+        self._data = data
+        self._frames = [None for i in range(len(data))]
+
+    def __len__(self):
+        return len(self._frames)
+
+    def _load(self, i):
+        if self._frames[i] is None:
+            self._frames[i] = np.array(self._data[i], dtype=float)
+        return self._frames[i]
+
+    def _fill(self):
+        for i in range(len(self)):
+            self._load(i)
+        self._data = None
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self._load(i) for i in range(len(self))[key]]
+        return self._load(range(len(self))[key])
+
+    def __setitem__(self, key, value):
+        if isinstance(key, slice):
+            self._fill()
+        self._frames[key] = value
+
+    def __delitem__(self, key):
+        self._fill()
+        del self._frames[key]
+
+    def insert(self, index, value):
+        self._fill()
+        self._frames.insert(index, value)
+
+    def __array__(self, dtype=None, copy=None):
+        if self._data is None:
+            return np.array(self._frames, dtype=dtype)
+        Answer = np.array(self._data, dtype=dtype or float)
+        for i, frame in enumerate(self._frames):
+            if frame is not None:
+                Answer[i] = frame
+        return Answer
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def __deepcopy__(self, memo):
+        New = ArcFrames(self._data if self._data is not None else [])
+        New._frames = [None if frame is None else frame.copy() for frame in self._frames]
+        return New
+
+    def __reduce__(self):
+        # Pickles hold the coordinates, not the memory map.
+        return (list, (list(self),))
+
 def both(A, B, key):
     return key in A.Data and key in B.Data
 
@@ -1467,10 +1534,10 @@ class Molecule(object):
                 Sum.Data[key] = copy.deepcopy(other.Data[key])
         for key in FrameVariableNames:
             if both(self, other, key):
-                if type(self.Data[key]) is not list:
+                if not isinstance(self.Data[key], (list, ArcFrames)):
                     logger.error('Key %s in self is a FrameKey, it must be a list\n' % key)
                     raise RuntimeError
-                if type(other.Data[key]) is not list:
+                if not isinstance(other.Data[key], (list, ArcFrames)):
                     logger.error('Key %s in other is a FrameKey, it must be a list\n' % key)
                     raise RuntimeError
                 if isinstance(self.Data[key][0], np.ndarray):
@@ -1509,10 +1576,10 @@ class Molecule(object):
         # FrameKeys must be a list.
         for key in FrameVariableNames:
             if both(self, other, key):
-                if type(self.Data[key]) is not list:
+                if not isinstance(self.Data[key], (list, ArcFrames)):
                     logger.error('Key %s in self is a FrameKey, it must be a list\n' % key)
                     raise RuntimeError
-                if type(other.Data[key]) is not list:
+                if not isinstance(other.Data[key], (list, ArcFrames)):
                     logger.error('Key %s in other is a FrameKey, it must be a list\n' % key)
                     raise RuntimeError
                 if isinstance(self.Data[key][0], np.ndarray):
@@ -1644,7 +1711,7 @@ class Molecule(object):
         else:
             selection = list(selection)
         Answer = self.Write_Tab[self.Funnel[ftype.lower()]](selection,**kwargs)
-        ## Any method that returns text will give us a list of lines, which we then write to the file.
+        ## Any method that returns text will give us a list (or a generator) of lines, which we then write to the file.
         if Answer is not None:
             if fnm is None or fnm == sys.stdout:
                 outfile = sys.stdout
@@ -1653,11 +1720,11 @@ class Molecule(object):
                 # thus we delete the link first.
                 if os.path.islink(fnm):
                     os.unlink(fnm)
-                outfile = open(fnm,'a')
+                outfile = open(fnm,'a',buffering=1<<20)
             else:
                 if os.path.islink(fnm):
                     os.unlink(fnm)
-                outfile = open(fnm,'w')
+                outfile = open(fnm,'w',buffering=1<<20)
             for line in Answer:
                 print(line, file=outfile)
             outfile.close()
@@ -1739,6 +1806,185 @@ class Molecule(object):
             else:
                 self.comms = [i.expandtabs() for i in self.comms]
 
+    def iterframes(self, fnm, ftype=None, chunk=100, boxes=False, **kwargs):
+        """ Iterate over the frames of a trajectory file in blocks, without loading the whole file.
+
+        Only one block of frames is held in memory at a time. TINKER .arc,
+        .xyz, .gro, .pdb, .mdcrd and .dcd files are read frame by frame;
+        other file types are read in full by their reader first. Reading
+        .mdcrd files requires the number of atoms, e.g. from Molecule(top).
+
+        Usage: for xyzs in Molecule().iterframes('liquid-md.arc', chunk=1000): ...
+
+        @param[in] fnm    The input file name
+        @param[in] ftype  The file type, determined from the extension by default
+        @param[in] chunk  Number of frames per block
+        @param[in] boxes  Also return the periodic boxes of the block
+        @return xyzs      Coordinates of a block of frames (Angstrom), shape (n_frames, n_atoms, 3);
+                          with boxes=True, also lengths and angles of the boxes, shape (n_frames, 6), NaN if absent
+
+        """
+        if ftype is None:
+            ftype = os.path.splitext(fnm)[1][1:]
+        if not os.path.exists(fnm):
+            logger.error('Tried to iterate over frames of a file that does not exist: %s\n' % fnm)
+            raise IOError
+        ftype = self.Funnel[ftype.lower()]
+        Iter_Tab = {'tinker'  : self._iter_arc,
+                    'xyz'     : self._iter_xyz,
+                    'gromacs' : self._iter_gro,
+                    'pdb'     : self._iter_pdb,
+                    'mdcrd'   : self._iter_mdcrd,
+                    'dcd'     : self._iter_dcd}
+        if ftype in Iter_Tab:
+            frames = Iter_Tab[ftype](fnm)
+        else:
+            frames = self._iter_parsed(fnm, ftype, **kwargs)
+        xyzs = []
+        boxs = []
+        for xyz, box in frames:
+            xyzs.append(xyz)
+            boxs.append(box if box is not None else [np.nan]*6)
+            if len(xyzs) == chunk:
+                yield (np.array(xyzs), np.array(boxs)) if boxes else np.array(xyzs)
+                xyzs = []
+                boxs = []
+        if len(xyzs) > 0:
+            yield (np.array(xyzs), np.array(boxs)) if boxes else np.array(xyzs)
+
+    def _iter_parsed(self, fnm, ftype, **kwargs):
+        """ Frames of a file type without a frame iterator, from its reader. """
+        Parsed = self.Read_Tab[ftype](fnm, **kwargs)
+        for i, xyz in enumerate(Parsed['xyzs']):
+            b = Parsed['boxes'][i] if 'boxes' in Parsed else None
+            yield xyz, (b.a, b.b, b.c, b.alpha, b.beta, b.gamma) if b is not None else None
+
+    def _iter_arc(self, fnm):
+        """ Frames of a TINKER .arc file: (xyz, box) for each frame. """
+        with open(fnm) as f:
+            for line in f:
+                if len(line.split()) == 0: continue
+                na = int(line.split()[0])
+                lines = list(itertools.islice(f, na))
+                box = None
+                sline = lines[0].split() if lines else []
+                if len(sline) == 6 and all([isfloat(i) for i in sline]):
+                    box = [float(i) for i in sline]
+                    lines = lines[1:] + list(itertools.islice(f, 1))
+                if len(lines) < na:
+                    break
+                yield np.array([l.split()[2:5] for l in lines], dtype=float), box
+
+    def _iter_xyz(self, fnm):
+        """ Frames of a .xyz file: (xyz, None) for each frame; TINKER-formatted files are read as .arc. """
+        with open(fnm) as f:
+            head = list(itertools.islice(f, 2))
+        if len(head) == 2:
+            sline = head[1].split()
+            if not isint(head[0].strip()) or (len(sline) == 6 and all([isfloat(word) for word in sline])) or \
+                    (len(sline) >= 5 and isint(sline[0]) and isfloat(sline[2]) and isfloat(sline[3]) and isfloat(sline[4])):
+                for frame in self._iter_arc(fnm):
+                    yield frame
+                return
+        with open(fnm) as f:
+            for line in f:
+                if len(line.strip()) == 0: continue
+                na = int(line.strip())
+                lines = list(itertools.islice(f, na + 1))[1:]
+                if len(lines) < na:
+                    break
+                yield np.array([re.sub(r"([0-9])(-[0-9])", r"\1 \2", l).split()[1:4] for l in lines], dtype=float), None
+
+    def _iter_gro(self, fnm):
+        """ Frames of a GROMACS .gro file: (xyz, box) for each frame. """
+        with open(fnm) as f:
+            for line in f:
+                na = int(f.readline().strip())
+                lines = list(itertools.islice(f, na))
+                sbox = f.readline().split()
+                if len(lines) < na or len(sbox) == 0:
+                    break
+                # Different frames may have different decimal precision
+                pdeci = [i for i, x in enumerate(lines[0]) if x == '.']
+                ndeci = pdeci[1] - pdeci[0] - 5
+                xyz = []
+                for l in lines:
+                    try:
+                        xyz.append([float(l[(pdeci[0]-4)+(5+ndeci)*(i-1):(pdeci[0]-4)+(5+ndeci)*i]) for i in range(1,4)])
+                    except ValueError:
+                        xyz.append([float(j) for j in l.split()[3:6]])
+                box = [float(i)*10 for i in sbox]
+                if len(box) == 9:
+                    b = BuildLatticeFromVectors(np.array([box[0], box[3], box[4]]), np.array([box[5], box[1], box[6]]), np.array([box[7], box[8], box[2]]))
+                    box = [b.a, b.b, b.c, b.alpha, b.beta, b.gamma]
+                else:
+                    box = box[:3] + [90.0, 90.0, 90.0]
+                yield np.array(xyz)*10, box
+
+    def _iter_pdb(self, fnm):
+        """ Frames of a .pdb file: (xyz, box) for each MODEL; models with a different number of atoms are skipped, as in read_pdb. """
+        box = None
+        xyz = []
+        na = None
+        with open(fnm) as f:
+            for line in f:
+                record = line[:6].strip()
+                if record in ['ATOM', 'HETATM']:
+                    xyz.append([float(line[30:38]), float(line[38:46]), float(line[46:54])])
+                elif record == 'CRYST1':
+                    box = [float(line[6:15]), float(line[15:24]), float(line[24:33]),
+                           float(line[33:40]), float(line[40:47]), float(line[47:54])]
+                elif record in ['END', 'ENDMDL'] and len(xyz) > 0:
+                    if na is None:
+                        na = len(xyz)
+                    if len(xyz) == na:
+                        yield np.array(xyz), box
+                    xyz = []
+        if len(xyz) > 0 and (na is None or len(xyz) == na):
+            yield np.array(xyz), box
+
+    def _iter_mdcrd(self, fnm):
+        """ Frames of an AMBER .mdcrd file: (xyz, box) for each frame. This requires the number of atoms. """
+        self.require('na')
+        xyz = []
+        # A frame is complete when its box line (written after the coordinates) or the next frame begins.
+        done = None
+        with open(fnm) as f:
+            f.readline()
+            for line in f:
+                sline = line.split()
+                if xyz == [] and len(sline) == 3:
+                    if done is not None:
+                        yield done, [float(i) for i in sline] + [90.0, 90.0, 90.0]
+                        done = None
+                else:
+                    if done is not None:
+                        yield done, None
+                        done = None
+                    xyz += [float(i) for i in sline]
+                    if len(xyz) == self.na * 3:
+                        done = np.array(xyz).reshape(-1,3)
+                        xyz = []
+        if done is not None:
+            yield done, None
+
+    def _iter_dcd(self, fnm):
+        """ Frames of a .dcd file: (xyz, box) for each frame. """
+        if _dcdlib.vmdplugin_init() != 0:
+            logger.error("Unable to init DCD plugin\n")
+            raise IOError
+        natoms = c_int(-1)
+        dcd       = _dcdlib.open_dcd_read(fnm, "dcd", byref(natoms))
+        ts        = MolfileTimestep()
+        _xyz      = c_float * (natoms.value * 3)
+        xyzvec    = _xyz()
+        ts.coords = xyzvec
+        try:
+            while _dcdlib.read_next_timestep(dcd, natoms, byref(ts)) != -1:
+                yield np.array(xyzvec, dtype=float).reshape(-1, 3), [ts.A, ts.B, ts.C, 90.0, 90.0, 90.0]
+        finally:
+            _dcdlib.close_file_read(dcd)
+
     def edit_qcrems(self, in_dict, subcalc = None):
         """ Edit Q-Chem rem variables with a dictionary.  Pass a value of None to delete a rem variable. """
         if subcalc is None:
@@ -3206,7 +3452,12 @@ class Molecule(object):
         @return comms   A single-element list for the comment.
         @return tinkersuf  The suffix that comes after lines in the XYZ coordinates; this is usually topology info
 
+        Pass arc_store=True to load the coordinates through read_arc_store() instead.
+
         """
+        if kwargs.get('arc_store', False):
+            return self.read_arc_store(fnm, **kwargs)
+        maxframes = kwargs.get('arc_maxframes', None)
         tinkersuf   = []
         boxes = []
         xyzs  = []
@@ -3266,6 +3517,8 @@ class Molecule(object):
                         title = True
                         xyzs.append(np.array(xyz))
                         xyz = []
+                        if nframes == maxframes:
+                            break
             ln += 1
         Answer = {'xyzs'   : xyzs,
                   'resid'  : resid,
@@ -3275,6 +3528,99 @@ class Molecule(object):
         if len(boxes) > 0: Answer['boxes'] = boxes
         return Answer
 
+    def read_arc_store(self, fnm, **kwargs):
+        """ Read a TINKER .arc file into a columnar store that is memory-mapped on later reads.
+
+        The coordinates of all frames are parsed once into a contiguous
+        (n_frames, n_atoms, 3) array and the periodic boxes into an
+        (n_frames, 6) array. Both are saved as .npy files next to the archive,
+        named after its size and modification time, so a later read of the
+        same archive only maps them into memory. xyzs is an ArcFrames view of
+        the map; the topology information is read from the first frame.
+
+        @param[in] fnm  The input file name
+        @return Same as read_arc()
+
+        """
+        Answer = self.read_arc(fnm, arc_maxframes=1)
+        st = os.stat(fnm)
+        prefix = os.path.join(os.path.dirname(fnm), '.%s.%i-%i' % (os.path.basename(fnm), st.st_size, st.st_mtime_ns))
+        if not os.path.exists(prefix + '.xyz.npy'):
+            stored = self._store_arc(fnm, prefix, Answer['tinkersuf'])
+            if stored is None:
+                # Not a fixed-format archive; read it the usual way.
+                return self.read_arc(fnm)
+        else:
+            stored = (np.load(prefix + '.xyz.npy', mmap_mode='r'),
+                      np.load(prefix + '.box.npy') if os.path.exists(prefix + '.box.npy') else None,
+                      json.load(open(prefix + '.json')))
+        xyzs, boxes, meta = stored
+        Answer['xyzs'] = ArcFrames(xyzs)
+        Answer['comms'] = meta['comms'] if len(meta['comms']) == len(xyzs) else meta['comms'] * len(xyzs)
+        if boxes is not None:
+            Answer['boxes'] = [BuildLatticeFromLengthsAngles(*box) for box in boxes]
+        return Answer
+
+    def _store_arc(self, fnm, prefix, tinkersuf, chunk=1000):
+        """ Parse an archive into the .npy files of read_arc_store() and return (xyzs, boxes, meta), or None if its frames are irregular. """
+        na = len(tinkersuf)
+        # A box line has six numbers; the second field of an atom line is its name.
+        with open(fnm) as f:
+            f.readline()
+            line = f.readline().split()
+            hasbox = len(line) == 6 and all(isfloat(i) for i in line)
+        stride = na + 1 + hasbox
+        nlines = 0
+        with open(fnm, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 24), b''):
+                nlines += block.count(b'\n')
+        if nlines == 0 or nlines % stride != 0:
+            return None
+        nframes = nlines // stride
+        # Position of the x coordinate of each atom in the split atom lines of one frame
+        ntoks = np.array([5 + len(suf.split()) for suf in tinkersuf])
+        xpos = np.concatenate([[0], np.cumsum(ntoks)[:-1]]) + 2
+        cols = (xpos[:, None] + np.arange(3)).flatten()
+        writable = os.access(os.path.dirname(os.path.abspath(fnm)), os.W_OK)
+        if writable:
+            xyzs = np.lib.format.open_memmap(prefix + '.xyz.npy.tmp', mode='w+', dtype=float, shape=(nframes, na, 3))
+        else:
+            xyzs = np.zeros((nframes, na, 3))
+        boxes = np.zeros((nframes, 6)) if hasbox else None
+        comms = []
+        with open(fnm) as f:
+            for start in range(0, nframes, chunk):
+                nchunk = min(chunk, nframes - start)
+                atomlines = []
+                for i in range(nchunk):
+                    comms.append(' '.join(f.readline().split()[1:]))
+                    if hasbox:
+                        boxes[start+i] = [float(j) for j in f.readline().split()]
+                    atomlines += itertools.islice(f, na)
+                toks = ' '.join(atomlines).split()
+                if len(toks) == nchunk * ntoks.sum():
+                    toks = np.array(toks).reshape(nchunk, -1)
+                    xyzs[start:start+nchunk] = toks[:, cols].astype(float).reshape(nchunk, na, 3)
+                else:
+                    xyzs[start:start+nchunk] = np.array([line.split()[2:5] for line in atomlines], dtype=float).reshape(nchunk, na, 3)
+        if len(set(comms)) == 1:
+            comms = comms[:1]
+        meta = {'comms' : comms}
+        if writable:
+            xyzs.flush()
+            del xyzs
+            # Remove the stores of older versions of the archive.
+            for old in os.listdir(os.path.dirname(prefix) or '.'):
+                if old.startswith('.%s.' % os.path.basename(fnm)) and not old.startswith(os.path.basename(prefix)):
+                    os.remove(os.path.join(os.path.dirname(prefix), old))
+            if hasbox:
+                np.save(prefix + '.box.npy', boxes)
+            with open(prefix + '.json', 'w') as f:
+                json.dump(meta, f)
+            os.replace(prefix + '.xyz.npy.tmp', prefix + '.xyz.npy')
+            xyzs = np.load(prefix + '.xyz.npy', mmap_mode='r')
+        return xyzs, boxes, meta
+
     def read_gro(self, fnm, **kwargs):
         """ Read a GROMACS .gro file.
 
@@ -4116,14 +4462,16 @@ class Molecule(object):
 
     def write_xyz(self, selection, **kwargs):
         self.require('elem','xyzs')
-        out = []
+        # The lines are generated frame by frame as they are written out.
+        return self._xyz_lines(selection)
+
+    def _xyz_lines(self, selection):
         for I in selection:
             xyz = self.xyzs[I]
-            out.append("%-5i" % self.na)
-            out.append(self.comms[I])
+            yield "%-5i" % self.na
+            yield self.comms[I]
             for i in range(self.na):
-                out.append(format_xyz_coord(self.elem[i],xyz[i]))
-        return out
+                yield format_xyz_coord(self.elem[i],xyz[i])
 
     def get_reaxff_atom_types(self):
         """
@@ -4256,18 +4604,37 @@ class Molecule(object):
 
     def write_arc(self, selection, **kwargs):
         self.require('elem','xyzs')
-        out = []
         if 'tinkersuf' not in self.Data:
             sys.stderr.write("Beware, this .arc file contains no atom type or topology info\n")
+        # The lines are generated frame by frame as they are written out.
+        return self._arc_lines(selection)
+
+    def _arc_lines(self, selection):
+        """ Generate the text of each frame as one string, by filling a template with all of its coordinates at once. """
+        template = self.arc_template()
         for I in selection:
             xyz = self.xyzs[I]
-            out.append("%6i  %s" % (self.na, self.comms[I]))
+            yield "%6i  %s" % (self.na, self.comms[I])
             if 'boxes' in self.Data:
                 b = self.boxes[I]
-                out.append(" %11.6f %11.6f %11.6f %11.6f %11.6f %11.6f" % (b.a, b.b, b.c, b.alpha, b.beta, b.gamma))
-            for i in range(self.na):
-                out.append("%6i  %s%s" % (i+1,format_xyz_coord(self.elem[i],xyz[i],tinker=True),self.tinkersuf[i] if 'tinkersuf' in self.Data else ''))
-        return out
+                yield " %11.6f %11.6f %11.6f %11.6f %11.6f %11.6f" % (b.a, b.b, b.c, b.alpha, b.beta, b.gamma)
+            yield template % tuple(np.asarray(xyz, dtype=float).ravel().tolist())
+
+    def arc_template(self):
+        """ Format string of the atom lines of a TINKER .arc frame, taking the 3*na coordinates.
+
+        The atom numbers, names and the tinkersuf columns are the same in
+        every frame, so they are formatted once and the template is kept
+        until they change.
+
+        """
+        suffix = tuple(self.tinkersuf) if 'tinkersuf' in self.Data else ('',)*self.na
+        key = (tuple(self.elem), suffix)
+        if self.__dict__.get('_arc_template_key') != key:
+            self._arc_template = '\n'.join(["%6i  %-3s" % (i+1, self.elem[i]) + " % 13.8f % 13.8f % 13.8f" + suffix[i].replace('%', '%%')
+                                             for i in range(self.na)])
+            self._arc_template_key = key
+        return self._arc_template
 
     def write_gro(self, selection, **kwargs):
         out = []
@@ -6,7 +6,9 @@ from __future__ import division
 from builtins import range
 from builtins import object
 import sys
+import queue
 import inspect
+import threading
 #from implemented import Implemented_Targets
 import numpy as np
 from collections import defaultdict, OrderedDict
@@ -135,6 +137,37 @@ Implemented_Targets = {
 ## This is the canonical lettering that corresponds to : objective function, gradient, Hessian.
 Letters = ['X','G','H']
 
+class Watchers(object):
+    """ Threads waiting for the jobs that targets started in stage(), so that their waits overlap. """
+
+    def __init__(self, targets):
+        self.done = queue.Queue()
+        self.pending = set([Tgt.name for Tgt in targets])
+        for Tgt in targets:
+            threading.Thread(target=self.watch, args=(Tgt,), daemon=True).start()
+
+    def watch(self, Tgt):
+        try:
+            Tgt.wait_jobs()
+            self.done.put((Tgt.name, None))
+        except Exception as e:
+            self.done.put((Tgt.name, e))
+
+    def finished(self, Tgt):
+        """ Whether the jobs of a target are done; targets without jobs are always done. """
+        return Tgt.name not in self.pending
+
+    def wait(self, timeout=None):
+        """ Block until the jobs of one more target are done, or the timeout expires. """
+        try:
+            name, error = self.done.get(timeout=timeout)
+        except queue.Empty:
+            return
+        self.pending.discard(name)
+        if error is not None:
+            logger.error("Waiting for the jobs of target %s failed\n" % name)
+            raise error
+
 class Objective(forcebalance.BaseClass):
     """ Objective function.
 
@@ -223,10 +256,13 @@ class Objective(forcebalance.BaseClass):
             # This ensures that the OrderedDict doesn't get out of order.
             for Tgt in self.Targets:
                 self.ObjDict[Tgt.name] = None
+            # Targets that started jobs in stage() (simulations, autoBAR) wait for them in a thread each;
+            # get() changes the working directory, so it always runs in this thread.
+            watchers = Watchers([Tgt for Tgt in self.Targets if hasattr(Tgt, 'wait_jobs')])
             # Loop through the targets and compute the objective function for ones that are finished.
             while len(Need2Evaluate) > 0:
                 for Tgt in Need2Evaluate:
-                    if Tgt.wq_complete():
+                    if watchers.finished(Tgt) and Tgt.wq_complete():
                         # List of functions that I can call.
                         Funcs   = [Tgt.get_X, Tgt.get_G, Tgt.get_H]
                         # Call the appropriate function
@@ -241,8 +277,10 @@ class Objective(forcebalance.BaseClass):
                             Objective[Letters[i]] += Ans[Letters[i]]*Tgt.weight/self.WTot
                         Need2Evaluate.remove(Tgt)
                         break
-                    else:
-                        pass
+                else:
+                    # Nothing to evaluate yet: sleep until a watcher finishes.  With a Work Queue,
+                    # wq_complete() has already waited on the queue, so only look briefly.
+                    watchers.wait(timeout=None if getWorkQueue() is None else 1.0)
         else:
             wq = getWorkQueue()
             if wq is not None:
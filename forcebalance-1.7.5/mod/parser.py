@@ -105,7 +105,7 @@ gen_opts_types = {
                  "constrain_h"      : (0, -150, 'Perform calculations with contrained hydrogen bond lengths.', 'Used in liquid-OpenMM', ['OPENMM']),
                  "vsite_bonds"      : (0, -150, 'Generate bonds from virtual sites to host atom bonded atoms.', 'Currently used in AMOEBA parameterization (advanced usage)', ['OPENMM','TINKER']),
                  "use_pvals"        : (0, -150, 'Bypass the transformation matrix and use the physical parameters directly', 'Creating the force field; advanced usage, be careful.'),
-                 "asynchronous"     : (0, 0, 'Execute Work Queue tasks and local calculations asynchronously for improved speed', 'Targets that use Work Queue (advanced usage)'),
+                 "asynchronous"     : (0, 0, 'Execute Work Queue tasks, liquid simulations, autoBAR runs and local calculations asynchronously, evaluating each target as soon as its jobs are done', 'Targets that use Work Queue or run jobs in stage (Liquid, Solvation)'),
                  "reevaluate"       : (None, 0, 'Re-evaluate the objective function and gradients when the step is rejected (for noisy objective functions).', 'Main Optimizer'),
                  "continue"         : (0, 140, 'Continue the current run from where we left off (supports mid-iteration recovery).', 'Main Optimizer'),
                  "duplicate_pnames" : (0, -150, 'Allow duplicate parameter names (only if you know what you are doing!', 'Force Field Parser'),
@@ -151,6 +151,7 @@ tgt_opts_types = {
                  "reassign_modes"        : (None, -180, 'Reassign modes before fitting frequencies, using either linear assignment "permute" or maximum overlap "overlap".', 'Vibrational frequency targets', 'vibration'),
                  "liquid_coords"         : (None, 0, 'Provide file name for condensed phase coordinates.', 'Condensed phase properties', 'Liquid'),
                  "gas_coords"            : (None, 0, 'Provide file name for gas phase coordinates.', 'Condensed phase properties', 'Liquid'),
+                 "fd_scheme"             : ('central', 0, 'Finite-difference scheme for the energy derivatives of TINKER liquid targets: central, forward (reusing the unperturbed analyze run) or adaptive (forward for the first fd_forward_iters iterations, then central)', 'Condensed phase properties', 'Liquid_TINKER'),
                  "nvt_coords"         : (None, 0, 'Provide file name for condensed phase NVT coordinates.', 'Condensed phase properties', 'Liquid'),
                  "lipid_coords"         : (None, 0, 'Provide file name for lipid coordinates.', 'Condensed phase properties', 'Lipid'),
                  "coords"                : (None, -10, 'Coordinates for single point evaluation; if not provided, will search for a default.', 'Energy/force matching, ESP evaluations, interaction energies'),
@@ -165,6 +166,7 @@ tgt_opts_types = {
                  "sfedata_txt"           : ('sfedata.txt', 0, 'Text file containing experimental data.', 'Solvation free energy target', 'Solvation'),
                  "autobar_path"           : (os.getenv("AUTOBARPATH"), 0, 'absolute path of autoBAR.py program', 'Solvation free energy target', 'Solvation'),
                  "run_dynamic_every_iter"  : (1, 0, 'whether run dynamic every iteration. 0 for No', 'Solvation free energy target', 'Solvation'),
+                 "executor"              : (None, 0, 'Backend running the jobs of the target: jobpool (Ren lab cluster through submitTinker.py), local (process pool on this machine) or workqueue (needs wq_port); defaults to jobpool for Liquid and local for Solvation, BindingEnergy and MinimumMatch', 'Job execution', 'Liquid_TINKER, Solvation, BindingEnergy, MinimumMatch'),
                  "hfemode"               : ('single', 0, 'Method for calculating hydration energies (single point, FEP, TI).', 'Hydration free energy target', 'hydration'),
                  "read"                  : (None, 50, 'Provide a temporary directory ".tmp" to read data from a previous calculation on the initial iteration (for instance, to restart an aborted run).', 'Liquid and Remote targets', 'Liquid, Remote'),
                  "remote_prefix"         : ('', 50, 'Specify an optional prefix script to run in front of rtarget.py, for loading environment variables', 'Remote targets', 'Remote'),
@@ -197,6 +199,8 @@ tgt_opts_types = {
                  "nvt_md_steps"       : (100000, 0, 'Number of time steps for the liquid NVT production run.', 'Condensed phase property targets', 'liquid'),
                  "nvt_eq_steps"       : (10000, 0, 'Number of time steps for the liquid NVT equilibration run.', 'Condensed phase property targets', 'liquid'),
                  "writelevel"         : (0, 0, 'Affects the amount of data being printed to the temp directory.', 'Energy + Force Matching', 'AbInitio'),
+                 "fd_forward_iters"   : (2, 0, 'Number of optimizer iterations using forward differences with fd_scheme adaptive', 'Condensed phase properties', 'Liquid_TINKER'),
+                 "executor_workers"   : (0, 0, 'Number of processes of the local executor (0 for one per core)', 'Job execution', 'Liquid_TINKER, Solvation, BindingEnergy, MinimumMatch'),
                  "md_threads"         : (6, 0, 'Set the number of threads used by Gromacs or TINKER processes in MD simulations', 'Condensed phase properties in GROMACS and TINKER', 'Liquid_GMX, Lipid_GMX, Liquid_TINKER'),
                  "save_traj"          : (0, -10, 'Whether to save trajectories.  0 = Never save; 1 = Delete if optimization step is good; 2 = Always save', 'Condensed phase properties', 'Liquid, Lipid'),
                  "eq_steps"           : (20000, 0, 'Number of time steps for the equilibration run.', 'Thermodynamic property targets', 'thermo'),
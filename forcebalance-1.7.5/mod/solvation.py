@@ -8,6 +8,7 @@ from __future__ import division
 
 from builtins import range
 import os
+import glob
 import shutil
 import time
 import numpy as np
@@ -17,6 +18,9 @@ from forcebalance.molecule import Molecule
 from re import match, sub
 from forcebalance.finite_difference import fdwrap, f1d2p, f12d3p, in_fd
 from collections import defaultdict, OrderedDict
+from forcebalance.evalcache import EvalCache, digest, file_hash
+from forcebalance import jobpool
+from forcebalance.executors import get_executor
 from forcebalance.nifty import getWorkQueue, queue_up, LinkFile, printcool, link_dir_contents, lp_dump, lp_load, _exec, kb, col, flat, uncommadash, statisticalInefficiency, isfloat
 
 from forcebalance.output import getLogger
@@ -43,8 +47,16 @@ class Solvation(Target):
         # set the run_dynamic_every_iter variable
         self.set_option(tgt_opts,'run_dynamic_every_iter','dynamicflag')
         self.dynamicflag = int(self.dynamicflag)
+        # backend running autoBAR
+        self.set_option(tgt_opts,'executor',default='local')
+        self.set_option(tgt_opts,'executor_workers')
         ## Read in the reference data
         self.read_reference_data()
+        ## Cache of the autoBAR results on the trajectories of iter_0000
+        self.cache = EvalCache()
+        ## autoBAR run started in stage(): parameters, and the cached result if there was one
+        self.staged = None
+        self.autobar_job = None
         ## logger info 
         logger.info("Solvation free energies from BAR simulation\n")
 
@@ -75,8 +87,27 @@ class Solvation(Target):
         logger.info('%12.4f%12.4f%12.4f\n'%(self.expsfe, self.calsfe, diff))
         logger.info(bar)
   
+    def cache_key(self):
+        """ Cache key of an autoBAR run on the trajectories of iter_0000: the input files, the parameter files and the trajectories. """
+        parts = [open(f, 'rb').read() for f in self.solvfiles if os.path.isfile(f)]
+        prmprefix = self.FF.fnms[0].split('.prm')[0]
+        for f in sorted(glob.glob(prmprefix + ".prm*")):
+          if not f.endswith(".prm.org"):
+            parts += [f, open(f, 'rb').read()]
+        for phase in ['gas', 'liquid']:
+          for f in sorted(glob.glob(os.path.join(phase, "*.arc"))):
+            parts += [f, file_hash(f)]
+        return digest(*parts)
+
     def solvation_driver_sp(self):
         """ Get SFE from BAR simulation result""" 
+        cached = self.launch_autobar()
+        if cached is not None:
+          return cached
+        return self.finish_autobar()
+
+    def launch_autobar(self):
+        """ Prepare the run directory and start autoBAR; return the cached (sfe0, sfe1) instead if there is one. """
         
         if os.path.isfile(os.path.join(self.root,self.rundir,"result.txt")):
           os.system(f'rm -f {os.path.join(self.root,self.rundir,"result.txt")}')
@@ -111,12 +142,32 @@ class Solvation(Target):
           os.system(f'cp {os.path.join(self.root, refdir, self.FF.fnms[0])} {os.path.join(self.root, self.rundir, iter0prm)}')
           os.system(f"cp {iter0prm} {self.FF.fnms[0]}")
 
+        # with the trajectories of iter_0000, the result only depends on the parameter files
+        cachekey = None
+        if (self.dynamicflag == 0) and ('iter_0000' not in self.rundir):
+          cachekey = self.cache_key()
+          cached = self.cache.get(cachekey)
+          if cached is not None:
+            logger.info("autoBAR result found in the evaluation cache\n")
+            return float(cached["sfe0"]), cached["sfe1"]
+
         # when run autoBAR, first step is to run minimize, which requires a prm file
 
         cmdstr = "python %s auto" %self.autobarpath
-        rtn = os.system(cmdstr)
-        if rtn != 0:
-          raise RuntimeError("autoBAR execution failed with return code %d." % rtn)
+        jobpool.write_job_script("autobar.sh", [cmdstr])
+        jobpool.clear_status(["autobar.sh"])
+        executor = get_executor(self.executor, self.executor_workers)
+        self.autobar_job = executor.submit(["autobar.sh"], "CPU", ncpu=1, inputs=[f for f in os.listdir('.') if os.path.isfile(f)], outputs=["result.txt"])[0]
+        self.autobar_cachekey = cachekey
+        return None
+
+    def finish_autobar(self):
+        """ Wait for the autoBAR run started by launch_autobar() and read its result. """
+        executor = get_executor(self.executor, self.executor_workers)
+        # raises if autoBAR fails
+        executor.wait_all([self.autobar_job], poll=5.0)
+        self.autobar_job = None
+        cachekey = self.autobar_cachekey
 
         sfe0 = 0.0
         sfe1 = np.zeros(self.FF.np)
@@ -142,18 +193,38 @@ class Solvation(Target):
         else:
           sfe1 = np.array(feps)
 
+        if cachekey is not None:
+          self.cache.put(cachekey, {"sfe0": sfe0, "sfe1": sfe1})
         return sfe0, sfe1
 
-    def get_sp(self, mvals, AGrad=False, AHess=False):
-        """ Get the SFE and its first derivative using finite difference method"""
-        
+    def make_prm(self, mvals):
+        """ Write the parameter file of the unperturbed autoBAR run. """
         if (self.dynamicflag == 0) and ('iter_0000' not in self.rundir):
           self.FF.make(mvals)
           os.rename(self.FF.fnms[0],  f"{self.FF.fnms[0]}_01")
         else:
           self.FF.make(mvals)
-          
-        f0, _ = self.solvation_driver_sp()  
+
+    def submit_jobs(self, mvals, AGrad=True, AHess=True):
+        """ Start the unperturbed autoBAR run when the target is staged, so that it runs while other targets are evaluated. """
+        self.make_prm(mvals)
+        self.staged = (np.array(mvals), self.launch_autobar())
+
+    def wait_jobs(self):
+        """ Block until the autoBAR run started by submit_jobs() has finished; called in a separate thread by Objective.Target_Terms in asynchronous mode. """
+        if self.staged is not None and self.staged[1] is None and self.executor.lower() != 'workqueue':
+          get_executor(self.executor, self.executor_workers).wait_all([self.autobar_job], poll=5.0)
+
+    def get_sp(self, mvals, AGrad=False, AHess=False):
+        """ Get the SFE and its first derivative using finite difference method"""
+        
+        staged, self.staged = self.staged, None
+        if staged is not None and np.allclose(staged[0], mvals):
+          # autoBAR with these parameters was started by submit_jobs()
+          f0, _ = staged[1] if staged[1] is not None else self.finish_autobar()
+        else:
+          self.make_prm(mvals)
+          f0, _ = self.solvation_driver_sp()  
         
         self.calsfe = f0
 
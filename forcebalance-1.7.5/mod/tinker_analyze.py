@@ -0,0 +1,305 @@
+""" @package forcebalance.tinker_analyze Fast reader of TINKER analyze output.
+
+The output of "analyze ... G,E,M" is scanned once with compiled regular
+expressions over a memory map of the file (or over the captured output of
+calltinker), and the records of all structures are returned as NumPy arrays.
+Energies are returned as printed by TINKER, in kcal/mol.
+
+Long trajectories can be analyzed in parallel: arc_shards() splits an archive
+into frame-contiguous byte ranges, each job extracts its range to local
+scratch with extract_command(), and merge_analyze() joins the results.
+arc_boxes() reads only the box lines of an archive, and box_volumes() turns
+them into volumes in one vectorized step.
+
+Running this module as a script benchmarks the parser against the
+line-by-line loops it replaces:
+
+    python -m forcebalance.tinker_analyze [analyze_output] [-n NFRAMES]
+
+@author Chengwen Liu
+@date 10/2026
+"""
+import os
+import re
+import sys
+import mmap
+import time
+import tempfile
+import numpy as np
+from collections import OrderedDict
+
+## All possible output from analyze's energy component breakdown.
+eckeys = ['Angle-Angle', 'Angle Bending', 'Atomic Multipoles', 'Bond Stretching', 'Charge-Charge',
+          'Charge-Dipole', 'Dipole-Dipole', 'Extra Energy Terms', 'Geometric Restraints', 'Implicit Solvation',
+          'Improper Dihedral', 'Improper Torsion', 'Metal Ligand Field', 'Out-of-Plane Bend', 'Out-of-Plane Distance',
+          'Pi-Orbital Torsion', 'Polarization', 'Reaction Field', 'Stretch-Bend', 'Stretch-Torsion',
+          'Torsional Angle', 'Torsion-Torsion', 'Urey-Bradley', 'Van der Waals', 'Charge Transfer']
+
+_energy_re = re.compile(rb'Total Potential Energy : +(\S+)')
+_dipole_re = re.compile(rb'Dipole X,Y,Z-Components : +(\S+) +(\S+) +(\S+)')
+_mass_re = re.compile(rb'Total System Mass[^\n]*?(\S+)[ \t\r]*$', re.M)
+# A component line holds the name, the energy and the number of interactions.
+_ecomp_re = re.compile(rb'^[ \t]*(' + b'|'.join(re.escape(k.encode()) for k in eckeys) + rb')[^\n]*?(\S+)[ \t]+\S+[ \t\r]*$', re.M)
+
+def _floats(values):
+    return np.array([float(v) for v in values])
+
+def _buffer(source):
+    """ Return a bytes-like view of an analyze output: a file name or a list of lines. """
+    if isinstance(source, (list, tuple)):
+        return '\n'.join(line.rstrip('\n') for line in source).encode('utf-8')
+    if os.path.getsize(source) == 0:
+        return b''
+    with open(source, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def read_analyze(source, dipole=True, ecomp=False):
+    """
+    Read the records of all structures in the output of TINKER analyze.
+
+    @param[in] source File name of the analyze output, or its lines as returned by calltinker
+    @param[in] dipole Read the dipole moments (M option)
+    @param[in] ecomp Read the energy component breakdown (E option)
+    @return Dictionary with
+    "Energy": total potential energies (kcal/mol), shape (N,)
+    "Dipole": dipoles (debye), shape (N, 3), if requested
+    "Ecomps": OrderedDict of energy components (kcal/mol), each shape (N,), if requested;
+              only the components printed for the first structure are kept
+    "Mass": total system mass (amu) or 0.0 if not printed (G option)
+    """
+    buf = _buffer(source)
+    try:
+        Result = OrderedDict()
+        Result["Energy"] = _floats(_energy_re.findall(buf))
+        if dipole:
+            Result["Dipole"] = _floats([v for xyz in _dipole_re.findall(buf) for v in xyz]).reshape(-1, 3)
+        if ecomp:
+            comps = OrderedDict()
+            havekeys = set()
+            first_shot = True
+            for m in _ecomp_re.finditer(buf):
+                if m.end() - m.start() < 60:
+                    continue
+                key = m.group(1).decode()
+                if first_shot:
+                    if key in havekeys:
+                        first_shot = False
+                    havekeys.add(key)
+                elif key not in havekeys:
+                    continue
+                comps.setdefault(key, []).append(m.group(2))
+            Result["Ecomps"] = OrderedDict((key, _floats(vals)) for key, vals in comps.items())
+        mass = _mass_re.findall(buf)
+        Result["Mass"] = float(mass[-1]) if mass else 0.0
+    finally:
+        if isinstance(buf, mmap.mmap):
+            buf.close()
+    return Result
+
+def merge_analyze(results):
+    """ Join the results of read_analyze() for consecutive shards of one trajectory. """
+    Result = OrderedDict()
+    for key in results[0]:
+        if key == "Mass":
+            Result[key] = results[0][key]
+        elif key == "Ecomps":
+            Result[key] = OrderedDict((k, np.concatenate([r[key][k] for r in results])) for k in results[0][key])
+        else:
+            Result[key] = np.concatenate([r[key] for r in results])
+    return Result
+
+def _is_box(line):
+    s = line.split()
+    if len(s) != 6:
+        return False
+    try:
+        [float(i) for i in s]
+    except ValueError:
+        return False
+    return True
+
+def arc_frame_offsets(arcfile):
+    """
+    Byte offsets of the structures in a TINKER archive.
+
+    TINKER writes all structures of a trajectory with the same fixed format,
+    so the offsets are normally multiples of the size of the first one; this
+    is checked against the header of every structure, and the archive is
+    scanned line by line if the check fails.
+
+    @param[in] arcfile Name of the archive
+    @return List of offsets, followed by the size of the file
+    """
+    size = os.path.getsize(arcfile)
+    if size == 0:
+        return [0]
+    with open(arcfile, 'rb') as f:
+        header = f.readline()
+        natoms = int(header.split()[0])
+        nlines = natoms + (2 if _is_box(f.readline().decode()) else 1)
+        f.seek(0)
+        framesize = sum(len(f.readline()) for i in range(nlines))
+        if size % framesize == 0:
+            offsets = list(range(0, size + 1, framesize))
+            for offset in offsets[:-1]:
+                f.seek(offset)
+                if f.read(len(header)) != header:
+                    break
+            else:
+                return offsets
+        f.seek(0)
+        offsets = []
+        offset = 0
+        for ln, line in enumerate(f):
+            if ln % nlines == 0:
+                offsets.append(offset)
+            offset += len(line)
+    return offsets + [size]
+
+def arc_atom_types(arcfile):
+    """ Atom types of the first structure in a TINKER archive (or .xyz file). """
+    with open(arcfile) as f:
+        natoms = int(f.readline().split()[0])
+        line = f.readline()
+        if _is_box(line):
+            line = f.readline()
+        types = []
+        for i in range(natoms):
+            types.append(int(line.split()[5]))
+            line = f.readline()
+    return types
+
+def arc_boxes(arcfile):
+    """
+    Periodic boxes of all structures in a TINKER archive.
+
+    Only the box line of each structure is read, by seeking to the offsets
+    from arc_frame_offsets(), so the coordinates are never loaded.
+
+    @param[in] arcfile Name of the archive
+    @return Lengths (Angstrom) and angles (degrees) of the boxes, shape (N, 6); shape (0, 6) without boxes
+    """
+    offsets = arc_frame_offsets(arcfile)[:-1]
+    boxes = []
+    with open(arcfile, 'rb') as f:
+        for offset in offsets:
+            f.seek(offset)
+            f.readline()
+            line = f.readline().decode()
+            if not _is_box(line):
+                return np.zeros((0, 6))
+            boxes.append(line)
+    return np.array(' '.join(boxes).split(), dtype=float).reshape(-1, 6)
+
+def box_volumes(boxes):
+    """ Volumes (cubic Angstrom) of triclinic boxes given as an (N, 6) array of lengths and angles (degrees). """
+    boxes = np.asarray(boxes, dtype=float).reshape(-1, 6)
+    cosa, cosb, cosg = np.cos(np.radians(boxes[:, 3:6])).T
+    return np.prod(boxes[:, :3], axis=1) * np.sqrt(1 - cosa**2 - cosb**2 - cosg**2 + 2*cosa*cosb*cosg)
+
+def arc_shards(arcfile, nshards):
+    """
+    Split a TINKER archive into frame-contiguous shards of nearly equal size.
+
+    @param[in] arcfile Name of the archive
+    @param[in] nshards Number of shards; fewer are returned for short trajectories
+    @return List of (byte offset, length in bytes) of the shards
+    """
+    offsets = arc_frame_offsets(arcfile)
+    nframes = len(offsets) - 1
+    nshards = max(1, min(nshards, nframes))
+    bounds = [offsets[n * nframes // nshards] for n in range(nshards + 1)]
+    return [(bounds[n], bounds[n+1] - bounds[n]) for n in range(nshards)]
+
+def extract_command(arcfile, shard, dest):
+    """ Shell command copying one shard of an archive to dest, reading only that shard. """
+    start, length = shard
+    return f"tail -c +{start + 1} {arcfile} | head -c {length} > {dest}"
+
+def shard_name(fnm, n):
+    """ Name of the output of shard n: liquid-md.ana -> liquid-md.00.ana """
+    root, ext = os.path.splitext(fnm)
+    return f"{root}.{n:02d}{ext}"
+
+def _read_analyze_loop(fnm):
+    """ The line-by-line loop used before this module, kept for the benchmark. """
+    eanl = []
+    dip = []
+    mass = 0.0
+    ecomp = OrderedDict()
+    havekeys = set()
+    first_shot = True
+    for line in open(fnm).readlines():
+        strip = line.strip()
+        s = line.split()
+        if 'Total System Mass' in line:
+            mass = float(s[-1])
+        if 'Total Potential Energy : ' in line:
+            eanl.append(float(s[4]))
+        if 'Dipole X,Y,Z-Components :' in line:
+            dip.append([float(s[i]) for i in range(-3,0)])
+        if first_shot:
+            for key in eckeys:
+                if strip.startswith(key) and (len(line) > 60):
+                    ecomp.setdefault(key, []).append(float(s[-2]))
+                    if key in havekeys:
+                        first_shot = False
+                    havekeys.add(key)
+        else:
+            for key in havekeys:
+                if strip.startswith(key) and (len(line) > 60):
+                    ecomp.setdefault(key, []).append(float(s[-2]))
+    return np.array(eanl), np.array(dip), OrderedDict((k, np.array(v)) for k, v in ecomp.items()), mass
+
+def _write_sample(fnm, nframes):
+    """ Write a synthetic analyze G,E,M output of a water box with nframes structures. """
+    rng = np.random.RandomState(0)
+    with open(fnm, 'w') as f:
+        f.write(" Total System Mass :                     3603.0528\n\n")
+        for i in range(nframes):
+            f.write(" Analysis for Archive Structure :         %i\n\n" % (i+1))
+            f.write(" Total Potential Energy :           %14.4f Kcal/mole\n\n" % rng.uniform(-2000, -1900))
+            f.write(" Energy Component Breakdown :           Kcal/mole        Interactions\n\n")
+            for key in ['Bond Stretching', 'Angle Bending', 'Urey-Bradley', 'Van der Waals', 'Atomic Multipoles', 'Polarization']:
+                f.write(" %-30s %16.4f %16i\n" % (key, rng.uniform(-1500, 500), 1000))
+            f.write("\n Total Electric Charge :                  0.00000 Electrons\n\n")
+            f.write(" Dipole Moment Magnitude :               %10.3f Debye\n\n" % rng.uniform(0, 10))
+            f.write(" Dipole X,Y,Z-Components :   %12.3f %12.3f %12.3f\n\n" % tuple(rng.uniform(-5, 5, 3)))
+            f.write(" Quadrupole Moment Tensor :    %12.3f %12.3f %12.3f\n" % tuple(rng.uniform(-5, 5, 3)))
+            f.write("      (Buckingham)               %12.3f %12.3f %12.3f\n" % tuple(rng.uniform(-5, 5, 3)))
+            f.write("                                 %12.3f %12.3f %12.3f\n\n" % tuple(rng.uniform(-5, 5, 3)))
+
+def benchmark(fnm=None, nframes=1000, repeat=3):
+    """ Compare read_analyze() against the line-by-line loop on one analyze output. """
+    if fnm is None:
+        fd, fnm = tempfile.mkstemp(prefix="tinker_analyze_benchmark.", suffix=".out")
+        os.close(fd)
+        _write_sample(fnm, nframes)
+        try:
+            benchmark(fnm, nframes, repeat)
+        finally:
+            os.remove(fnm)
+        return
+    t_loop = min(_timeit(_read_analyze_loop, fnm) for _ in range(repeat))
+    t_fast = min(_timeit(lambda f: read_analyze(f, dipole=True, ecomp=True), fnm) for _ in range(repeat))
+    E0, D0, C0, M0 = _read_analyze_loop(fnm)
+    R = read_analyze(fnm, dipole=True, ecomp=True)
+    same = (np.allclose(E0, R["Energy"]) and np.allclose(D0.reshape(-1, 3), R["Dipole"]) and M0 == R["Mass"] and
+            list(C0) == list(R["Ecomps"]) and all(np.allclose(C0[k], R["Ecomps"][k]) for k in C0))
+    print("%s: %i structures, %.1f MB" % (fnm, len(E0), os.path.getsize(fnm)/1e6))
+    print("line-by-line loop : %8.4f s" % t_loop)
+    print("read_analyze      : %8.4f s  (%.1fx)" % (t_fast, t_loop/t_fast))
+    print("results identical : %s" % same)
+
+def _timeit(func, fnm):
+    t0 = time.time()
+    func(fnm)
+    return time.time() - t0
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    nframes = 1000
+    if '-n' in args:
+        nframes = int(args.pop(args.index('-n') + 1))
+        args.remove('-n')
+    benchmark(args[0] if args else None, nframes)
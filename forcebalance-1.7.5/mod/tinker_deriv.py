@@ -0,0 +1,321 @@
+""" @package forcebalance.tinker_deriv Analytic parameter derivatives of TINKER energies.
+
+The energy of some valence terms is linear in the force constant, for example
+E_bond = K * (dr^2 + cubic * dr^3 + quartic * dr^4). The derivative with
+respect to the force constant K of one parameter line is therefore
+
+    dE/dK = E_line / K
+
+where E_line is the energy of the interactions using that line, and the two
+analyze runs over the trajectory per parameter of finite differences are not
+needed. The dipole moments do not depend on these force constants.
+
+E_line is found in one of two ways:
+
+- If a single parameter line supplies all interactions of the term in the
+  system (e.g. the O-H bond of a water model), E_line is the energy
+  component of the unperturbed analyze run (analyze ... E).
+- Otherwise, for bonds and angles (including in-plane and Fourier angles),
+  one valence-only analyze D run per trajectory shard lists the energy of
+  every interaction. Its output is summed per parameter
+  line on the node (python -m forcebalance.tinker_deriv) and is not stored.
+  The sums are checked against the energy components before they are used.
+
+Everything else is left to finite differences:
+- equilibrium values;
+- force constants of terms that have ring-specific lines (bond5, angle4, ...)
+  in the system;
+- out-of-plane bending and Urey-Bradley constants shared by several lines
+  (analyze D lists only the 1-3 atom pair of a Urey-Bradley interaction,
+  which does not identify its line);
+- evaluated parameters;
+- nonbonded parameters. vdW energies are not linear in the parameters
+  (combining rules mix them), and neither are multipole energies
+  (polarization, and interactions between atoms of the same type).
+
+@author Chengwen Liu
+@date 10/2026
+"""
+import os
+import sys
+import json
+import numpy as np
+from collections import OrderedDict
+from forcebalance import jobpool
+from forcebalance.tinker_analyze import arc_atom_types, arc_shards, extract_command, shard_name
+from forcebalance.output import getLogger
+logger = getLogger(__name__)
+
+## Parameter keywords of terms linear in the force constant:
+## energy component printed by analyze and field of the force constant (after the atom classes).
+linear_terms = OrderedDict([('bond', ('Bond Stretching', 3)), ('bond5', ('Bond Stretching', 3)),
+                            ('bond4', ('Bond Stretching', 3)), ('bond3', ('Bond Stretching', 3)),
+                            ('angle', ('Angle Bending', 4)), ('angle5', ('Angle Bending', 4)),
+                            ('angle4', ('Angle Bending', 4)), ('angle3', ('Angle Bending', 4)),
+                            ('anglep', ('Angle Bending', 4)), ('anglef', ('Angle Bending', 4)),
+                            ('ureybrad', ('Urey-Bradley', 4)), ('opbend', ('Out-of-Plane Bend', 5))])
+
+## Interaction labels of analyze D and the parameter keywords they come from.
+detail_labels = {'Bond': 'bond', 'Angle': 'angle', 'Angle-Lin': 'angle', 'Angle-IP': 'anglep',
+                 'Angle-Cos': 'anglef'}
+
+## Ring-specific keywords; their terms cannot be split per line, since the
+## interactions in rings are not told apart in the output.
+ring_terms = ['bond5', 'bond4', 'bond3', 'angle5', 'angle4', 'angle3']
+
+## Energy terms switched off in the analyze D runs, which then only list the bond and angle interactions.
+inactive_terms = ['ureyterm', 'strbndterm', 'opbendterm', 'opdistterm', 'improperterm', 'imptorterm', 'torsionterm',
+                  'pitorsterm', 'strtorterm', 'angtorterm', 'tortorterm', 'angangterm', 'vdwterm',
+                  'repulseterm', 'dispterm', 'chargeterm', 'chgdplterm', 'dipoleterm', 'mpoleterm',
+                  'polarizeterm', 'chgtrnterm', 'rxnfieldterm', 'solvateterm', 'metalterm',
+                  'restrainterm', 'extraterm']
+
+def parameter_lines(prmfile, keyfile):
+    """ Whitespace-split parameter lines of a TINKER parameter file and of the key file using it. """
+    lines = [line.split() for line in open(prmfile).readlines()]
+    lines += [line.split() for line in open(keyfile).readlines()]
+    return [s for s in lines if s and not s[0].startswith('#')]
+
+def key_parameters(keyfile):
+    """ Parameter file named by the parameters keyword of a key file, or None. """
+    prmfile = None
+    for line in open(keyfile).readlines():
+        s = line.split()
+        if len(s) > 1 and s[0].lower() == 'parameters':
+            prmfile = os.path.basename(s[1])
+            if not prmfile.endswith('.prm'):
+                prmfile += '.prm'
+    return prmfile
+
+def atom_classes(lines, types):
+    """ Atom classes of the atoms of a system, from the atom lines of its parameters. """
+    classes = dict((int(s[1]), int(s[2])) for s in lines if s[0].lower() == 'atom' and len(s) > 2)
+    return [classes.get(t, 0) for t in types]
+
+def line_label(keyword, classes):
+    """ Name of a valence parameter line from its keyword and atom classes, independent of the atom order. """
+    classes = [int(c) for c in classes]
+    if len(classes) == 2:
+        classes = sorted(classes)
+    elif len(classes) == 3:
+        classes = [min(classes[0], classes[2]), classes[1], max(classes[0], classes[2])]
+    return ' '.join([keyword] + [str(c) for c in classes])
+
+def active_lines(lines, types):
+    """
+    Parameter lines of the linear terms that can apply to a system, by energy component.
+
+    A line is active if all of its atom classes occur in the system. This may
+    include lines without any interaction in the system, which only makes the
+    tests in linear_parameters() stricter.
+
+    @param[in] lines Lines returned by parameter_lines()
+    @param[in] types Atom types of the system
+    @return Dictionary of lists of lines, by energy component
+    """
+    classes = set(str(c) for c in atom_classes(lines, types))
+    active = OrderedDict()
+    for s in lines:
+        if s[0].lower() not in linear_terms:
+            continue
+        comp, kfld = linear_terms[s[0].lower()]
+        if len(s) > kfld and all(c in classes for c in s[1:kfld]):
+            active.setdefault(comp, []).append(s)
+    return active
+
+def split_lines(active):
+    """ Labels of the active lines of the terms that analyze D can split per line, by energy component. """
+    split = OrderedDict()
+    for comp, lines in active.items():
+        keywords = [s[0].lower() for s in lines]
+        if any(k in ring_terms or k not in detail_labels.values() for k in keywords):
+            continue
+        split[comp] = list(OrderedDict.fromkeys([line_label(s[0].lower(), s[1:linear_terms[s[0].lower()][1]]) for s in lines]))
+    return split
+
+def linear_parameters(FF, mvals, pgrad, keyfile, arcfile):
+    """
+    Find the parameters whose energy derivatives follow from the energies of their lines.
+
+    @param[in] FF Force field object; FF.make(mvals) must have written the parameter file to the working directory
+    @param[in] mvals Mathematical parameters
+    @param[in] pgrad Indices of the mathematical parameters to differentiate
+    @param[in] keyfile Key file of the analyze runs, holding the parameters keyword
+    @param[in] arcfile Trajectory of the system
+    @return Dictionary of (energy component, line label or None, dK/dm / K) by mathematical parameter,
+            and the labels of all active lines of the energy components that are split per line.
+            dE/dm is the energy of the line (of the component if the label is None) times the factor.
+    """
+    # Evaluated parameters may follow any parameter, so their dependence is not known here.
+    if any(len(pfield) > 5 and pfield[5] is not None for pfield in FF.pfields):
+        return OrderedDict(), OrderedDict()
+    prmfile = key_parameters(keyfile)
+    if prmfile is None or prmfile not in FF.fnms:
+        return OrderedDict(), OrderedDict()
+    prmlines = [line.split() for line in open(prmfile).readlines()]
+    active = active_lines(parameter_lines(prmfile, keyfile), arc_atom_types(arcfile))
+    split = split_lines(active)
+    # Lines of the key file replace the lines of the parameter file for the same classes.
+    keylines = [line.split() for line in open(keyfile).readlines()]
+    keylabels = set(line_label(s[0].lower(), s[1:linear_terms[s[0].lower()][1]]) for s in keylines
+                    if s and s[0].lower() in linear_terms and len(s) > linear_terms[s[0].lower()][1])
+    # Derivatives of the physical parameters; create_pvals() is linear unless logarithmic_map is set.
+    dm = 1e-4
+    dpdm = np.zeros((FF.np, FF.np))
+    for i in pgrad:
+        mvals_p = np.array(mvals, dtype=float)
+        mvals_m = np.array(mvals, dtype=float)
+        mvals_p[i] += dm
+        mvals_m[i] -= dm
+        dpdm[i] = (FF.create_pvals(mvals_p) - FF.create_pvals(mvals_m)) / (2*dm)
+    Result = OrderedDict()
+    for i in pgrad:
+        fields = OrderedDict()
+        for pfield in FF.pfields:
+            pid, fnm, ln, fld, mult = pfield[:5]
+            deriv = dpdm[i][FF.map[pid]]
+            if abs(deriv) > 1e-10:
+                fields[(fnm, ln, fld)] = fields.get((fnm, ln, fld), 0.0) + mult*deriv
+        if len(fields) != 1:
+            continue
+        (fnm, ln, fld), dKdm = list(fields.items())[0]
+        s = prmlines[ln] if fnm == prmfile and ln < len(prmlines) else []
+        if not s or s[0].lower() not in linear_terms:
+            continue
+        comp, kfld = linear_terms[s[0].lower()]
+        if fld != kfld or s not in active.get(comp, []) or float(s[kfld]) == 0.0:
+            continue
+        label = line_label(s[0].lower(), s[1:kfld])
+        if label in keylabels:
+            continue
+        if len(active[comp]) == 1:
+            Result[i] = (comp, None, dKdm / float(s[kfld]))
+        elif comp in split:
+            Result[i] = (comp, label, dKdm / float(s[kfld]))
+    # Only run analyze D for the components that are needed.
+    split = OrderedDict((comp, labels) for comp, labels in split.items() if any(r[0] == comp and r[1] is not None for r in Result.values()))
+    return Result, split
+
+def line_energy_jobs(phase, keyfile, prmfile, labels, nshards=1):
+    """
+    Write the job scripts of the valence-only analyze D runs over the trajectory of a phase.
+
+    @param[in] phase "liquid" or "gas"
+    @param[in] keyfile Key file of the trajectory
+    @param[in] prmfile Parameter file of the key file
+    @param[in] labels Labels of the parameter lines whose energies are summed
+    @param[in] nshards Number of shards of the trajectory
+    @return List of job scripts, and the number of shards actually used
+    """
+    arcfile = f"{phase}-md.arc"
+    lines = parameter_lines(prmfile, keyfile)
+    with open(f"{phase}-lin.json", 'w') as f:
+        json.dump({"classes": atom_classes(lines, arc_atom_types(arcfile)), "labels": list(labels)}, f)
+    with open(f"{phase}-lin.key", 'w') as f:
+        f.write(open(keyfile).read())
+        for term in inactive_terms:
+            f.write(f"{term} none\n")
+    shfiles = []
+    shards = arc_shards(arcfile, nshards)
+    for n, shard in enumerate(shards):
+        shfile = shard_name(f"{phase}-lin.sh", n)
+        jobpool.write_job_script(shfile, ['set -o pipefail', '_scratch=$(mktemp -d)', extract_command(arcfile, shard, f"$_scratch/{arcfile}"),
+                                          f"analyze $_scratch/{arcfile} -k {phase}-lin.key D | python -m forcebalance.tinker_deriv {phase}-lin.json > {shard_name(f'{phase}-lin.dat', n)}; _status=$?",
+                                          'rm -rf $_scratch', 'test $_status -eq 0'])
+        shfiles.append(shfile)
+    return shfiles, len(shards)
+
+def read_line_energies(phase, nshards):
+    """ Energies (kcal/mol) of the parameter lines and numbers of interactions, by label, joined over the shards. """
+    columns = None
+    rows = []
+    for n in range(nshards):
+        with open(shard_name(f"{phase}-lin.dat", n)) as f:
+            columns = f.readline().split('\t')
+            rows += [[float(x) for x in line.split()] for line in f if line.strip()]
+    data = np.array(rows).reshape(-1, len(columns))
+    return OrderedDict((label.strip(), data[:, k]) for k, label in enumerate(columns))
+
+def linear_derivatives(FF, mvals, pgrad, phase, ecomps, executor=None, nshards=1):
+    """
+    Energy derivatives of the parameters of linear terms, without finite differences.
+
+    @param[in] FF Force field object; FF.make(mvals) must have written the parameter file to the working directory
+    @param[in] mvals Mathematical parameters
+    @param[in] pgrad Indices of the mathematical parameters to differentiate
+    @param[in] phase "liquid" or "gas"; the trajectory is <phase>-md.arc with the key file <phase>-md.key
+    @param[in] ecomps Energy components (kJ/mol) of the unperturbed analyze run over the trajectory
+    @param[in] executor Backend running the analyze D jobs (see forcebalance.executors), defaults to the job pool
+    @param[in] nshards Number of parallel analyze D jobs
+    @return Dictionary of (description, dE/dm in kJ/mol for each frame) by mathematical parameter
+    """
+    keyfile, arcfile = f"{phase}-md.key", f"{phase}-md.arc"
+    linear, split = linear_parameters(FF, mvals, pgrad, keyfile, arcfile)
+    energies = OrderedDict()
+    if split:
+        from forcebalance.executors import get_executor
+        prmfile = key_parameters(keyfile)
+        labels = [label for comp in split for label in split[comp]]
+        shfiles, nshards = line_energy_jobs(phase, keyfile, prmfile, labels, nshards)
+        executor = executor or get_executor()
+        executor.submit([shfile for shfile in shfiles if jobpool.job_status(shfile) is None], "CPU", ncpu=1, batch=True,
+                        inputs=[arcfile, f"{phase}-lin.key", f"{phase}-lin.json", prmfile],
+                        outputs=[shard_name(f"{phase}-lin.dat", n) for n in range(nshards)])
+        executor.wait_all(shfiles)
+        lines = read_line_energies(phase, nshards)
+        for comp, labels in split.items():
+            # Every interaction must come from one of the lines, and the lines must
+            # add up to the energy component, or the split is not trusted.
+            other = sum([np.abs(lines["other " + k]) for k in set(detail_labels.values()) if linear_terms[k][0] == comp])
+            total = sum([lines[label] for label in labels])
+            ref = ecomps.get(comp)
+            if (ref is not None and len(total) == len(ref) and np.max(other) == 0.0 and
+                np.allclose(total*4.184, ref, rtol=1e-4, atol=5e-5*4.184*(np.max(lines["count"])+1))):
+                energies.update((label, lines[label]*4.184) for label in labels)
+            else:
+                logger.warning("%s energies of the parameter lines do not add up to the energy component; using finite differences\n" % comp)
+    Result = OrderedDict()
+    for i, (comp, label, factor) in linear.items():
+        if label is None and comp in ecomps:
+            Result[i] = (comp, ecomps[comp]*factor)
+        elif label is not None and label in energies:
+            Result[i] = ("%s (%s)" % (comp, label), energies[label]*factor)
+    return Result
+
+def reduce_detail(stream, mapfile, out):
+    """
+    Sum the interaction energies listed by analyze D per parameter line and structure.
+
+    Writes a tab-separated header of the line labels, "other <keyword>" for
+    interactions without a listed line, and "count", then one row per structure.
+    """
+    spec = json.load(open(mapfile))
+    classes = spec["classes"]
+    columns = list(spec["labels"]) + ["other " + k for k in sorted(set(detail_labels.values()))] + ["count"]
+    index = dict((label, k) for k, label in enumerate(columns))
+    out.write('\t'.join(columns) + '\n')
+    row = None
+    for line in stream:
+        if 'Analysis for Archive Structure' in line:
+            if row is not None:
+                out.write(' '.join(['%.6f' % x for x in row]) + '\n')
+            row = [0.0 for c in columns]
+            continue
+        s = line.split()
+        if len(s) < 4 or s[0] not in detail_labels:
+            continue
+        keyword = detail_labels[s[0]]
+        natoms = 2 if keyword == 'bond' else 3
+        atoms = [a.split('-')[0] for a in s[1:1+natoms]]
+        if not all(a.isdigit() for a in atoms):
+            continue
+        if row is None:
+            row = [0.0 for c in columns]
+        label = line_label(keyword, [classes[int(a) - 1] for a in atoms])
+        row[index.get(label, index["other " + keyword])] += float(s[-1])
+        row[index["count"]] += 1
+    if row is not None:
+        out.write(' '.join(['%.6f' % x for x in row]) + '\n')
+
+if __name__ == "__main__":
+    reduce_detail(sys.stdin, sys.argv[1], sys.stdout)
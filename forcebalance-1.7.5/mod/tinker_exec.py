@@ -0,0 +1,88 @@
+""" @package forcebalance.tinker_exec Running TINKER programs and reading their output.
+
+Targets such as BindingEnergy, MinimumMatch and AbInitio call TINKER
+hundreds of times per iteration through TINKER.calltinker, which used to read
+the output of TINKER one byte at a time. run() reads it in large blocks and
+splits it into lines once, or writes it straight to a file for long outputs
+that are parsed from the file; scan_output() then finds the lines that
+calltinker checks without reading the whole file.
+
+@author Chengwen Liu
+@date 10/2026
+"""
+import os
+import mmap
+import subprocess
+from forcebalance.output import getLogger
+logger = getLogger(__name__)
+
+def run(argv, stdin="", outfile=None, persist=False, print_error=True):
+    """
+    Run a TINKER program.
+
+    The output is read in large blocks (or written straight to outfile) and
+    split into lines once, instead of being read one byte at a time.
+
+    @param[in] argv Command as a list of arguments
+    @param[in] stdin String passed to the standard input of the command
+    @param[in] outfile Write the standard output to this file instead of returning it
+    @param[in] persist Return the output even if the command fails
+    @param[in] print_error Log the standard error of a failed command
+    @return Lines of the standard output, as from nifty._exec, or outfile
+    """
+    try:
+        if outfile is not None:
+            with open(outfile, 'wb') as f:
+                p = subprocess.run(argv, input=(stdin or "").encode('utf-8'), stdout=f, stderr=subprocess.PIPE)
+            out = b''
+        else:
+            p = subprocess.run(argv, input=(stdin or "").encode('utf-8'), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out = p.stdout
+        result = {"code": p.returncode, "out": out.decode('utf-8', 'replace'), "err": p.stderr.decode('utf-8', 'replace')}
+    except OSError as e:
+        result = {"code": 127, "out": "", "err": str(e)}
+    return _finish(argv, result, outfile, persist, print_error)
+
+def _finish(argv, result, outfile, persist, print_error):
+    if result["code"] != 0:
+        if result["err"] and print_error:
+            logger.warning("Received an error message:\n%s\n" % result["err"])
+        if not persist:
+            logger.error("%s gave a return code of %i (it may have crashed)\n" % (' '.join(argv), result["code"]))
+            raise RuntimeError
+    if outfile is not None:
+        return outfile
+    out = result["out"].split('\n')
+    if out[-1] == '':
+        out = out[:-1]
+    return out
+
+def scan_output(fnm, nhead=10, ntail=10):
+    """
+    Lines checked by calltinker in an output written to a file, found without reading all of it.
+
+    @param[in] fnm Output file
+    @return First nhead lines, last ntail lines, and the lines holding 'D+' (very large numbers)
+    """
+    with open(fnm, 'rb') as f:
+        head = [f.readline() for i in range(nhead)]
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - 8192))
+        tail = f.read().split(b'\n')
+        dplus = []
+        if size > 0:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            pos = buf.find(b'D+')
+            while pos >= 0:
+                start = buf.rfind(b'\n', 0, pos) + 1
+                end = buf.find(b'\n', pos)
+                if end < 0:
+                    end = size
+                dplus.append(buf[start:end])
+                pos = buf.find(b'D+', end)
+            buf.close()
+    if tail and tail[-1] == b'':
+        tail = tail[:-1]
+    decode = lambda lines: [line.decode('utf-8', 'replace').rstrip('\n') for line in lines if line]
+    return decode(head), decode(tail[-ntail:]), decode(dplus)
@@ -16,6 +16,9 @@ import os, shutil
 from re import match, sub
 from forcebalance.nifty import *
 from forcebalance.nifty import _exec
+from forcebalance import jobpool, tinker_exec
+from forcebalance.executors import get_executor
+from forcebalance.tinker_analyze import eckeys, read_analyze, merge_analyze, arc_shards, arc_boxes, box_volumes, extract_command, shard_name
 import time
 import numpy as np
 import networkx as nx
@@ -48,13 +51,6 @@ allp = ['atom', 'vdw', 'vdw14', 'vdwpr', 'hbond', 'bond', 'bond5', 'bond4',
         'mmffpbci', 'mmffequiv', 'mmffdefstbn', 'mmffcovrad', 'mmffprop', 'mmffarom',
         'chgtrn', 'chgpen', 'delta-halgren', 'gamma-halgren', 'bndcflux', 'angcflux'] 
 
-# All possible output from analyze's energy component breakdown.
-eckeys = ['Angle-Angle', 'Angle Bending', 'Atomic Multipoles', 'Bond Stretching', 'Charge-Charge', 
-          'Charge-Dipole', 'Dipole-Dipole', 'Extra Energy Terms', 'Geometric Restraints', 'Implicit Solvation', 
-          'Improper Dihedral', 'Improper Torsion', 'Metal Ligand Field', 'Out-of-Plane Bend', 'Out-of-Plane Distance', 
-          'Pi-Orbital Torsion', 'Polarization', 'Reaction Field', 'Stretch-Bend', 'Stretch-Torsion', 
-          'Torsional Angle', 'Torsion-Torsion', 'Urey-Bradley', 'Van der Waals', 'Charge Transfer']
-
 from forcebalance.output import getLogger
 logger = getLogger(__name__)
 
@@ -320,6 +316,75 @@ def write_key(fout, options, fin=None, defaults={}, verbose=False, prmfnm=None,
         printcool_dictionary(options, title="%s -> %s with options:" % (fin, fout))
     file_out.close()
 
+class TinkerLogTail(object):
+    """ Incremental reader of a growing Tinker log (dynamic or analyze output).
+
+    Each call to update() reads only the bytes appended since the previous
+    call, keeps a running count of the 'Current Time' (dynamic) and 'Total
+    Potential Energy' (analyze) records, and collects the potential and
+    kinetic energies and temperatures of dynamic on the fly.
+    """
+
+    def __init__(self, fnm):
+        self.fnm = fnm
+        self.reset()
+
+    def reset(self):
+        self.offset = 0
+        self.partial = b''
+        ## Number of MD frames written so far ('Current Time' lines)
+        self.nframes = 0
+        ## Number of analyzed structures so far ('Total Potential Energy' lines)
+        self.nanalyzed = 0
+        ## Potential and kinetic energies (kcal/mol) and temperatures (K) of the MD frames
+        self.epot = []
+        self.ekin = []
+        self.temps = []
+
+    def update(self):
+        """ Read what has been appended to the log; return True if anything new was read. """
+        # Read to the end of the file rather than up to a size from stat(): the log is
+        # written on another node, and opening the file revalidates it on NFS.
+        try:
+            f = open(self.fnm, 'rb')
+        except (IOError, OSError):
+            return False
+        with f:
+            if os.fstat(f.fileno()).st_size < self.offset:
+                # The log has been restarted.
+                self.reset()
+            f.seek(self.offset)
+            data = f.read()
+        if not data:
+            return False
+        self.offset += len(data)
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self.feed(line.decode('utf-8', errors='replace'))
+        return True
+
+    def finish(self):
+        """ Read the rest of the log once the job has finished, including a last line without a newline. """
+        self.update()
+        if self.partial:
+            self.feed(self.partial.decode('utf-8', errors='replace'))
+            self.partial = b''
+
+    def feed(self, line):
+        if 'Current Time' in line:
+            self.nframes += 1
+        elif 'Total Potential Energy' in line:
+            self.nanalyzed += 1
+        elif 'Current Potential' in line:
+            self.epot.append(float(line.split()[2]))
+        elif 'Current Kinetic' in line:
+            self.ekin.append(float(line.split()[2]))
+        elif 'Temperature' in line:
+            s = line.split()
+            if len(s) > 2 and s[0] == 'Temperature' and s[2] == 'Kelvin':
+                self.temps.append(float(s[1]))
+
 class TINKER(Engine):
 
     """ Engine for carrying out general purpose TINKER calculations. """
@@ -358,9 +423,17 @@ class TINKER(Engine):
             crdfile = onefile(kwargs.get('coords'), 'arc', err=True)
             self.mol = Molecule(crdfile)
 
-    def calltinker(self, command, stdin=None, print_to_screen=False, print_command=False, **kwargs):
+    def calltinker(self, command, stdin=None, print_to_screen=False, print_command=False, outfile=None, **kwargs):
+
+        """ Call TINKER; prepend the tinkerpath to calling the TINKER program.
 
-        """ Call TINKER; prepend the tinkerpath to calling the TINKER program. """
+        The output is read in large blocks (see tinker_exec.run); with
+        print_to_screen it is streamed through nifty._exec instead.
+
+        @param[in] outfile Write the output to this file and return its name instead
+        of the lines, for long outputs that are parsed from the file (e.g. by read_analyze)
+
+        """
 
         csplit = command.split()
         # Sometimes the engine changes dirs and the key goes missing, so we link it.
@@ -368,10 +441,21 @@ class TINKER(Engine):
             LinkFile(self.abskey, "%s.key" % self.name)
         prog = os.path.join(self.tinkerpath, csplit[0])
         csplit[0] = prog
-        #o = _exec(' '.join(csplit), stdin=stdin, print_to_screen=print_to_screen, print_command=print_command, rbytes=1024, **kwargs)
-        o = _exec(' '.join(csplit), stdin=stdin, print_to_screen=print_to_screen, print_command=print_command, rbytes=1, **kwargs)
+        if print_to_screen and outfile is None:
+            o = _exec(' '.join(csplit), stdin=stdin, print_to_screen=print_to_screen, print_command=print_command, rbytes=1024, **kwargs)
+        else:
+            if print_command:
+                logger.info("Executing process: %s\n" % ' '.join(csplit))
+            o = tinker_exec.run(csplit, stdin=stdin, outfile=outfile, persist=kwargs.get('persist', False),
+                                   print_error=kwargs.get('print_error', True))
+        # The version is printed at the top, a crash at the bottom; large numbers anywhere.
+        if outfile is None:
+            head, tail = o[:10], o[-10:]
+            dplus = [line for line in o if 'D+' in line]
+        else:
+            head, tail, dplus = tinker_exec.scan_output(outfile)
         # Determine the TINKER version number.
-        for line in o[:10]:
+        for line in head:
             if "Version" in line:
                 vw = line.split()[2]
                 if len(vw.split('.')) <= 2:
@@ -387,19 +471,18 @@ class TINKER(Engine):
                 except:
                     logger.error("Unable to determine TINKER version number!\n")
                     raise RuntimeError
-        for line in o[-10:]:
+        for line in tail:
             # Catch exceptions since TINKER does not have exit status.
             if "TINKER is Unable to Continue" in line:
-                for l in o:
+                for l in (o if outfile is None else tail):
                     logger.error("%s\n" % l)
                 time.sleep(1)
                 logger.error("TINKER may have crashed! (See above output)\nThe command was: %s\nThe directory was: %s\n" % (' '.join(csplit), os.getcwd()))
                 raise RuntimeError
                 break
-        for line in o:
-            if 'D+' in line:
-                logger.info(line+'\n')
-                warn_press_key("TINKER returned a very large floating point number! (See above line; will give error on parse)")
+        for line in dplus:
+            logger.info(line+'\n')
+            warn_press_key("TINKER returned a very large floating point number! (See above line; will give error on parse)")
         return o
 
     def prepare(self, pbc=False, **kwargs):
@@ -658,17 +741,9 @@ class TINKER(Engine):
         if dipole or (not force):
             oanl = self.calltinker("analyze %s -k %s" % (xyzin, self.name), stdin="G,E,M", print_to_screen=False)
             # Read potential energy and dipole from file.
-            eanl = []
-            dip = []
-            for line in oanl:
-                s = line.split()
-                if 'Total Potential Energy : ' in line:
-                    eanl.append(float(s[4]) * 4.184)
-                if dipole:
-                    if 'Dipole X,Y,Z-Components :' in line:
-                        dip.append([float(s[i]) for i in range(-3,0)])
-            Result["Energy"] = np.array(eanl)
-            Result["Dipole"] = np.array(dip)
+            anl = read_analyze(oanl, dipole=dipole)
+            Result["Energy"] = anl["Energy"] * 4.184
+            Result["Dipole"] = anl["Dipole"] if dipole else np.array([])
         # If we want forces, then we need to call testgrad.
         if force:
             E = []
@@ -890,7 +965,7 @@ class TINKER(Engine):
         # Interaction energy needs to be in kcal/mol.
         return (self.energy() - self.A.energy() - self.B.energy()) / 4.184
 
-    def molecular_dynamics(self, nsteps, timestep, temperature=None, pressure=None, nequil=0, nsave=1000, minimize=True, anisotropic=False, threads=6, verbose=False, **kwargs):
+    def molecular_dynamics(self, nsteps, timestep, temperature=None, pressure=None, nequil=0, nsave=1000, minimize=True, anisotropic=False, threads=6, anashards=1, executor=None, verbose=False, **kwargs):
         
         """
         Method for running a molecular dynamics simulation.  
@@ -904,6 +979,8 @@ class TINKER(Engine):
         nsave       = (int)   Step interval for saving and printing data
         minimize    = (bool)  Perform an energy minimization prior to dynamics
         threads     = (int)   Specify how many OpenMP threads to use
+        anashards   = (int)   Number of parallel jobs analyzing the liquid trajectory
+        executor    = (Executor) Backend running the dynamics and analyze jobs, defaults to the job pool
 
         Returns simulation data:
         Rhos        = (array)     Density in kilogram m^-3
@@ -912,6 +989,7 @@ class TINKER(Engine):
         Volumes     = (array)     Box volumes
         Dips        = (3xN array) Dipole moments
         EComps      = (dict)      Energy components
+        AnaEnergies = (array)     Potential energies from analyze
         """
 
         md_defs = OrderedDict()
@@ -958,122 +1036,65 @@ class TINKER(Engine):
             os.system("mv %s.xyz_2 %s.xyz" % (self.name, self.name))
             if verbose: logger.info("Done\n")
 
-        # store some variables for later use 
-        workingdir = os.getcwd()
-        hoststr = os.getenv('HOSTNAME').split('.')[0]
-        timestr = str(time.time()).replace('.', '')
-        jobpooldir = os.environ["JOBPOOL"]
-        fbbashrc = os.environ["FBBASHRC"]
-        scriptfile = f"{jobpooldir}/{hoststr}-{timestr}.sh"
+        # GPU dynamics in the condensed phase, 4 cores per job in the gas phase
+        executor = executor or get_executor(tinkerpath=self.tinkerpath)
+        mdtype, mdcpu = ("GPU", None) if self.pbc else ("CPU", 4)
+        mdinputs = [f for f in os.listdir('.') if os.path.isfile(f)]
 
         # Run equilibration.
         if nequil > 0:
             write_key("%s-eq.key" % self.name, eq_opts, "%s.key" % self.name, md_defs)
             if verbose: printcool("Running equilibration dynamics", color=0)
-            with open(f"{self.name}-eq.sh", 'w') as eq:
-                eq.write(f"source {fbbashrc}\n")
-                if self.pbc and pressure is not None:
-                    eq.write("$DYNAMIC %s -k %s-eq %i %f %f 4 %f %f > %s-eq.log \n" % (self.name, self.name, nequil, timestep, float(nsave*timestep)/1000, temperature, pressure, self.name))
-                else:
-                    eq.write("dynamic %s -k %s-eq %i %f %f 2 %f > %s-eq.log \n" % (self.name, self.name, nequil, timestep, float(nsave*timestep)/1000, temperature, self.name))
+            if self.pbc and pressure is not None:
+                eqcmd = "$DYNAMIC %s -k %s-eq %i %f %f 4 %f %f > %s-eq.log " % (self.name, self.name, nequil, timestep, float(nsave*timestep)/1000, temperature, pressure, self.name)
+            else:
+                eqcmd = "dynamic %s -k %s-eq %i %f %f 2 %f > %s-eq.log " % (self.name, self.name, nequil, timestep, float(nsave*timestep)/1000, temperature, self.name)
+            jobpool.write_job_script(f"{self.name}-eq.sh", [eqcmd])
             # Check if liquid-eq finishes.
             # liquid-eq finishes then liquid-md.key written
-            if self.pbc:
-              if not os.path.isfile(f"{self.name}-eq.log"):
-                shstr = f"python {self.tinkerpath}/submitTinker.py -x {self.name}-eq.sh -t GPU -p {workingdir}"
-              else:
-                shstr = 'echo CPU'
-            else:
-              if not os.path.isfile(f"{self.name}-eq.log"):
-                shstr = f"python {self.tinkerpath}/submitTinker.py -x {self.name}-eq.sh -n 4 -t CPU -p {workingdir}"
-              else:
-                shstr = 'echo CPU'
-            
-            # put the command in jobpool
-            # there is a script responsible for submitting these jobs
-            with open(scriptfile, 'w') as f:
-                f.write(shstr)
+            # put the command in jobpool unless it has already finished (a log alone may be left by a killed run)
+            if jobpool.job_status(f"{self.name}-eq.sh") is None:
+              executor.submit([f"{self.name}-eq.sh"], mdtype, ncpu=mdcpu, priority=jobpool.PRIORITY_DYNAMIC, inputs=mdinputs,
+                              outputs=[f"{self.name}-eq.log", f"{self.name}.arc", f"{self.name}.dyn"])
             
             #Check whether dynamic job finishes 
-            neqtraj = int(nequil/nsave)
-            iFinish = False 
-            while not iFinish:
-              if not os.path.isfile(f"{self.name}-eq.log"):
-                time.sleep(15.0)
-              else:
-                cmdstr = f"grep 'Current Time' {self.name}-eq.log > tmp-eq.dat"
-                os.system(cmdstr)
-                nLines = sum(1 for line in open("tmp-eq.dat"))
-                if (nLines == neqtraj):
-                  iFinish = True 
-                  break
-                else:
-                  time.sleep(15.0)
+            eqlog = TinkerLogTail(f"{self.name}-eq.log")
+            def eq_progress():
+                if eqlog.update() and verbose:
+                    logger.debug("%s-eq: %i/%i frames\n" % (self.name, eqlog.nframes, int(nequil/nsave)))
+            executor.wait_all([f"{self.name}-eq.sh"], callback=eq_progress)
             os.system("rm -f %s.arc" % (self.name))
 
         # Run production.
-        time.sleep(30.0)
         if verbose: printcool("Running production dynamics", color=0)
         write_key("%s-md.key" % self.name, md_opts, "%s.key" % self.name, md_defs)
-        with open(f"{self.name}-md.sh", 'w') as md:
-            md.write(f"source {fbbashrc}\n")
-            if self.pbc and pressure is not None:
-                md.write("$DYNAMIC %s -k %s-md %i %f %f 4 %f %f > %s-md.log \n" % (self.name, self.name, nsteps, timestep, float(nsave*timestep)/1000, temperature, pressure, self.name))
-            else:
-                md.write("dynamic %s -k %s-md %i %f %f 2 %f > %s-md.log \n" % (self.name, self.name, nsteps, timestep, float(nsave*timestep)/1000, temperature, self.name))
-        
-        if self.pbc:
-          if not os.path.isfile(f"{self.name}-md.log"):
-            shstr = f"python {self.tinkerpath}/submitTinker.py -x {self.name}-md.sh -t GPU -p {workingdir}"
-          else:
-            shstr = 'echo CPU'
+        if self.pbc and pressure is not None:
+            mdcmd = "$DYNAMIC %s -k %s-md %i %f %f 4 %f %f > %s-md.log " % (self.name, self.name, nsteps, timestep, float(nsave*timestep)/1000, temperature, pressure, self.name)
         else:
-          if not os.path.isfile(f"{self.name}-md.log"):
-            shstr = f"python {self.tinkerpath}/submitTinker.py -x {self.name}-md.sh -n 4 -t CPU -p {workingdir}"
-          else:
-            shstr = 'echo CPU'
-           
-        hoststr = os.getenv('HOSTNAME').split('.')[0]
-        timestr = str(time.time()).replace('.', '')
-        jobpooldir = os.environ["JOBPOOL"]
-        scriptfile = f"{jobpooldir}/{hoststr}-{timestr}.sh"
+            mdcmd = "dynamic %s -k %s-md %i %f %f 2 %f > %s-md.log " % (self.name, self.name, nsteps, timestep, float(nsave*timestep)/1000, temperature, self.name)
+        jobpool.write_job_script(f"{self.name}-md.sh", [mdcmd])
+        
         # put the command in jobpool
-        # there is a script responsible for submitting these jobs
-        with open(scriptfile, 'w') as f:
-            f.write(shstr)
+        if jobpool.job_status(f"{self.name}-md.sh") is None:
+          executor.submit([f"{self.name}-md.sh"], mdtype, ncpu=mdcpu, priority=jobpool.PRIORITY_DYNAMIC,
+                          inputs=[f for f in os.listdir('.') if os.path.isfile(f)],
+                          outputs=[f"{self.name}-md.log", f"{self.name}.arc", f"{self.name}.dyn"])
         
         #Check whether dynamic job finishes 
-        nmdtraj = int(nsteps/nsave)
-        iFinish = False 
-        while not iFinish:
-          if not os.path.isfile(f"{self.name}-md.log"):
-            time.sleep(5.0)
-          else:
-            cmdstr = f"grep 'Current Time' {self.name}-md.log > tmp-md.dat"
-            os.system(cmdstr)
-            nLines = sum(1 for line in open("tmp-md.dat"))
-            if (nLines == nmdtraj):
-              iFinish = True 
-              break
-            else:
-              time.sleep(5.0)
+        mdlog = TinkerLogTail(f"{self.name}-md.log")
+        def md_progress():
+            if mdlog.update() and verbose:
+                logger.debug("%s-md: %i/%i frames\n" % (self.name, mdlog.nframes, int(nsteps/nsave)))
+        executor.wait_all([f"{self.name}-md.sh"], callback=md_progress)
+        mdlog.finish()
         
-        odyn = open(f"{self.name}-md.log").readlines()
         # Gather information.
         if os.path.isfile(f'{self.name}.arc'):
             os.system("mv %s.arc %s-md.arc" % (self.name, self.name))
         self.md_trajectory = "%s-md.arc" % self.name
-        edyn = []
-        kdyn = []
-        temps = []
-        for line in odyn:
-            s = line.split()
-            if 'Current Potential' in line:
-                edyn.append(float(s[2]))
-            if 'Current Kinetic' in line:
-                kdyn.append(float(s[2]))
-            if len(s) > 0 and s[0] == 'Temperature' and s[2] == 'Kelvin':
-                temps.append(float(s[1]))
+        edyn = mdlog.epot
+        kdyn = mdlog.ekin
+        temps = mdlog.temps
 
         # Potential and kinetic energies converted to kJ/mol.
         edyn = np.array(edyn) * 4.184
@@ -1082,103 +1103,57 @@ class TINKER(Engine):
     
         if verbose: logger.info("Post-processing to get the dipole moments\n")
         if self.name == 'liquid':
-          with open('liquid-ana.sh', 'w') as f:
-            if not os.path.isfile('liquid-md.ana'):
-              f.write(f"source {fbbashrc}\n")
-              f.write("analyze liquid-md.arc -k liquid-md.key G,E,M >liquid-md.ana\n")
-            else:
-              f.write("echo CPU\n")
+          # analyze frame-contiguous shards of the trajectory in parallel
+          shards = arc_shards("liquid-md.arc", anashards)
+          anafiles = [shard_name("liquid-md.ana", n) for n in range(len(shards))]
+          shfiles = [shard_name("liquid-ana.sh", n) for n in range(len(shards))]
+          for shard, anafile, shfile in zip(shards, anafiles, shfiles):
+            jobpool.write_job_script(shfile, ["_scratch=$(mktemp -d)",
+                                              extract_command("liquid-md.arc", shard, "$_scratch/liquid-md.arc"),
+                                              f"analyze $_scratch/liquid-md.arc -k liquid-md.key G,E,M > {anafile}; _status=$?",
+                                              "rm -rf $_scratch", "test $_status -eq 0"])
           #submit
-          workingdir = os.getcwd()
-          shstr = f"python {self.tinkerpath}/submitTinker.py -x liquid-ana.sh -t CPU -n 4 -p {workingdir}"
-          hoststr = os.getenv('HOSTNAME').split('.')[0]
-          timestr = str(time.time()).replace('.', '')
-          jobpooldir = os.environ["JOBPOOL"]
-          scriptfile = f"{jobpooldir}/{hoststr}-{timestr}.sh"
-          # put the command in jobpool
-          # there is a script responsible for submitting these jobs
-          with open(scriptfile, 'w') as f:
-              f.write(shstr)
+          executor.submit([shfile for shfile in shfiles if jobpool.job_status(shfile) is None], "CPU", ncpu=4,
+                          inputs=["liquid-md.arc", "liquid-md.key"] + [f for f in mdinputs if f.endswith('.prm')],
+                          outputs=dict(zip(shfiles, [[anafile] for anafile in anafiles])))
           #check finish
-          nmdtraj = int(nsteps/nsave)
-          iFinish = False 
-          while not iFinish:
-            if not os.path.isfile("liquid-md.ana"):
-              time.sleep(5.0)
-            else:
-              cmdstr = "grep 'Total Potential Energy' liquid-md.ana > tmp-ana.dat"
-              os.system(cmdstr)
-              nLines = sum(1 for line in open("tmp-ana.dat"))
-              if (nLines == nmdtraj):
-                iFinish = True 
-                break
-              else:
-                time.sleep(5.0)
-          oanl = open("liquid-md.ana").readlines()
+          analogs = [TinkerLogTail(anafile) for anafile in anafiles]
+          def ana_progress():
+              if any([analog.update() for analog in analogs]) and verbose:
+                  logger.debug("liquid-md.ana: %i/%i frames\n" % (sum([analog.nanalyzed for analog in analogs]), int(nsteps/nsave)))
+          executor.wait_all(shfiles, callback=ana_progress)
+          # Read potential energy, dipole and energy components from file.
+          anl = merge_analyze([read_analyze(anafile, dipole=True, ecomp=True) for anafile in anafiles])
         if self.name == 'gas':
-          oanl = self.calltinker("analyze %s-md.arc" % self.name, stdin="G,E,M", print_to_screen=False)
-
-        # Read potential energy and dipole from file.
-        eanl = []
-        dip = []
-        mass = 0.0
-        ecomp = OrderedDict()
-        havekeys = set()
-        first_shot = True
-        
-        for ln, line in enumerate(oanl):
-            strip = line.strip()
-            s = line.split()
-            if 'Total System Mass' in line:
-                mass = float(s[-1])
-            if 'Total Potential Energy : ' in line:
-                eanl.append(float(s[4]))
-            if 'Dipole X,Y,Z-Components :' in line:
-                dip.append([float(s[i]) for i in range(-3,0)])
-            if first_shot:
-                for key in eckeys:
-                    if strip.startswith(key) and (len(line) > 60):
-                        if key in ecomp:
-                            ecomp[key].append(float(s[-2])*4.184)
-                        else:
-                            ecomp[key] = [float(s[-2])*4.184]
-                        if key in havekeys:
-                            first_shot = False
-                        havekeys.add(key)
-            else:
-                for key in havekeys:
-                    if strip.startswith(key) and (len(line) > 60):
-                        if key in ecomp:
-                            ecomp[key].append(float(s[-2])*4.184)
-                        else:
-                            ecomp[key] = [float(s[-2])*4.184]
-        for key in ecomp:
-            ecomp[key] = np.array(ecomp[key])
+          oanl = self.calltinker("analyze %s-md.arc" % self.name, stdin="G,E,M", print_to_screen=False, outfile="%s-md.ana" % self.name)
+          anl = read_analyze(oanl, dipole=True, ecomp=True)
+
+        mass = anl["Mass"]
+        ecomp = OrderedDict((key, val * 4.184) for key, val in anl["Ecomps"].items())
         ecomp["Potential Energy"] = edyn
         ecomp["Kinetic Energy"] = kdyn
         ecomp["Temperature"] = temps
         ecomp["Total Energy"] = edyn+kdyn
 
         # Energies in kilojoules per mole
-        eanl = np.array(eanl) * 4.184
+        eanl = anl["Energy"] * 4.184
         # Dipole moments in debye
-        dip = np.array(dip)
+        dip = anl["Dipole"]
         # Volume of simulation boxes in cubic nanometers
         # Conversion factor derived from the following:
         # In [22]: 1.0 * gram / mole / (1.0 * nanometer)**3 / AVOGADRO_CONSTANT_NA / (kilogram/meter**3)
         # Out[22]: 1.6605387831627252
         conv = 1.6605387831627252
         if self.pbc:
-            vol = np.array([BuildLatticeFromLengthsAngles(*[float(j) for j in line.split()]).V \
-                                for line in open("%s-md.arc" % self.name).readlines() \
-                                if (len(line.split()) == 6 and isfloat(line.split()[1]) \
-                                        and all([isfloat(i) for i in line.split()[:6]]))]) / 1000
+            vol = box_volumes(arc_boxes("%s-md.arc" % self.name)) / 1000
             rho = conv * mass / vol
         else:
             vol = None
             rho = None
         prop_return = OrderedDict()
         prop_return.update({'Rhos': rho, 'Potentials': edyn, 'Kinetics': kdyn, 'Volumes': vol, 'Dips': dip, 'Ecomps': ecomp})
+        # Potential energies from analyze, the unperturbed reference for finite differences
+        prop_return['AnaEnergies'] = eanl
         return prop_return
 
 class Liquid_TINKER(Liquid):
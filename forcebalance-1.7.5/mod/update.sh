@@ -9,3 +9,9 @@ $action $libdir/tinkerio.py     $curdir/tinkerio.py
 $action $libdir/data/npt.py     $curdir/data/npt.py
 $action $libdir/minimum_match.py      $curdir/minimum_match.py
 $action $libdir/solvation.py      $curdir/solvation.py
+$action $libdir/jobpool.py      $curdir/jobpool.py
+$action $libdir/tinker_analyze.py      $curdir/tinker_analyze.py
+$action $libdir/evalcache.py      $curdir/evalcache.py
+$action $libdir/tinker_deriv.py      $curdir/tinker_deriv.py
+$action $libdir/tinker_exec.py      $curdir/tinker_exec.py
+$action $libdir/executors.py      $curdir/executors.py